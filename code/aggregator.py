@@ -0,0 +1,428 @@
+import contextlib
+import math
+from collections import Counter
+
+from rollups import fold_sections
+from sketches import SpaceSaving
+
+"""
+    Incremental per-second traffic statistics, so the scheduled jobs don't
+    have to rescan the raw records on every tick.
+"""
+
+# how many sections a summary read by rollup_window() holds, when the
+# buckets count every section exactly
+SUMMARY_SIZE = 1000
+
+
+class TrafficAggregator:
+    """
+    Keeps a ring of per-second buckets, each holding that second's total
+    request count and its per-section counts. A record is counted into its
+    bucket once as it's ingested, and each bucket is retired once as it
+    expires, so nothing ever looks at the raw records again.
+
+    On top of the buckets sit SlidingWindows, one per window length anyone
+    asks about, (1s, 10s, 2min, 10min...). Each keeps running sums that are
+    updated as records arrive and as seconds slide out of the window, so
+    reading a window's totals costs the same whatever its length.
+
+    Windows are made of whole seconds, and only cover complete ones: the
+    10 second window at 12:00:05.7 is 11:59:55 up to the end of 12:00:04.
+
+    With top_k set, the per-section counts are approximate instead: each
+    bucket keeps a SpaceSaving summary of at most top_k sections, and a
+    window's summary is merged from its buckets' when it's read. That keeps
+    memory fixed however many distinct sections show up, (say, a scanner
+    requesting millions of made up paths), at the cost of the counts
+    carrying an error bound.
+
+    With rollups, each second's bucket is rolled into the Rollups' coarser
+    tiers once it's done with, for windows longer than the retention.
+
+    Like the RecordStore that feeds it, it's not thread-safe, so callers
+    hold the records lock. The reads that merge a lot of buckets take the
+    lock themselves instead, and only hold it while they copy the buckets,
+    so the ingest loop isn't held up by the merging.
+    """
+
+    def __init__(self, retention, top_k=None, clients=None, rollups=None):
+        """
+        @param retention: in seconds, how far back buckets are kept. No
+        window can be longer than this.
+        @param top_k: None to count every section exactly, or the number of
+        sections each second's SpaceSaving summary holds
+        @param clients: an optional ClientStats, which gets every record's
+        source IP passed on to it
+        @param rollups: an optional rollups.Rollups, which gets each second's
+        counts rolled into it
+        """
+        self.top_k = top_k
+        self.clients = clients
+        self.rollups = rollups
+        # seconds before this have been rolled up
+        self.rolled = 0
+        self.retention = int(math.ceil(retention))
+        # a couple of spare buckets so the current, partial, second never
+        # lands on top of the oldest one still in use
+        self.size = self.retention + 2
+        self.seconds = [None] * self.size
+        self.totals = [0] * self.size
+        self.sections = [None] * self.size
+        self.windows = {}
+        # seconds before this have been expired
+        self.cutoff = 0
+
+    def bucket_index(self, second):
+        """
+        @param second: a whole second, as from int(time)
+        @return: the index of that second's bucket, if it's still held, or
+        None
+        """
+        index = second % self.size
+        if self.seconds[index] != second:
+            return None
+        return index
+
+    def add(self, t, section, src_ip=None):
+        """
+        Counts a record. This is called once per record at ingest.
+        @param t: the record's time
+        @param section: its section name
+        @param src_ip: its source IP as an integer, for the ClientStats
+        @return: None
+        """
+        if self.clients is not None and src_ip is not None:
+            self.clients.add(t, src_ip)
+        second = int(t)
+        if second < self.cutoff:
+            return
+        index = second % self.size
+        held = self.seconds[index]
+        if held != second:
+            if held is not None and held > second:
+                # older than anything we keep, it's already expired
+                return
+            if held is not None:
+                self.retire(held)
+            self.seconds[index] = second
+            self.totals[index] = 0
+            self.sections[index] = SpaceSaving(self.top_k) if self.top_k \
+                else Counter()
+
+        self.totals[index] += 1
+        if self.top_k:
+            self.sections[index].add(section)
+        else:
+            self.sections[index][section] += 1
+        if second < self.rolled and self.rollups is not None:
+            # late, after its second was rolled up
+            self.rollups.add(second, 1, {section: 1})
+        for window in self.windows.values():
+            if second >= window.low:
+                window.total += 1
+                if window.sections is not None:
+                    window.sections[section] += 1
+
+    def retire(self, second):
+        """
+        Retires a bucket, moving any window still holding it past it first.
+        @param second: the bucket's second
+        @return: None
+        """
+        for window in self.windows.values():
+            if window.low <= second:
+                window.advance_to(second + 1)
+        self.roll_through(second)
+        index = self.bucket_index(second)
+        if index is not None:
+            self.seconds[index] = None
+            self.totals[index] = 0
+            self.sections[index] = None
+
+    def expire_before(self, t):
+        """
+        Retires all the buckets older than t
+        @param t: a time
+        @return: None
+        """
+        cutoff = int(t)
+        self.cutoff = max(self.cutoff, cutoff)
+        held = [second for second in self.seconds
+                if second is not None and second < cutoff]
+        for second in sorted(held):
+            self.retire(second)
+
+    def roll_through(self, last):
+        """
+        Rolls the seconds up to and including last into the rollups, in
+        order, if they haven't been already
+        @param last: a whole second
+        @return: None
+        """
+        if self.rollups is None or last < self.rolled:
+            return
+        if last - self.rolled < self.size:
+            seconds = range(self.rolled, last + 1)
+        else:
+            # a long way to go, (like the first time), so just the held ones
+            seconds = sorted(second for second in self.seconds
+                             if second is not None and
+                             self.rolled <= second <= last)
+        for second in seconds:
+            index = self.bucket_index(second)
+            if index is not None:
+                self.rollups.add(second, self.totals[index],
+                                 self.sections[index])
+        self.rolled = last + 1
+
+    def roll_up(self, now, delay=2):
+        """
+        Rolls the seconds that are done with into the rollups. This is
+        called every tick, (the seconds are rolled up as they're retired
+        anyway, but that's 10 minutes later).
+        @param now: the current time
+        @param delay: in seconds, how long after a second's over to wait for
+        its late records
+        @return: None
+        """
+        self.roll_through(int(now) - delay)
+
+    def rollup_window(self, n_secs, now, lock=None):
+        """
+        Reads a window of any length up to the rollups' retention, from the
+        coarsest tier that fits it, (see rollups.Rollups.tier_for), or from
+        the per-second buckets for the windows too short for any tier.
+        Unlike window(), nothing's set up to keep running sums, so asking
+        for any number of different lengths costs nothing at ingest.
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @param lock: the records lock, held only while the buckets are
+        copied, or None if the caller holds it
+        @return: (total, summary, seconds) - the request count, a SpaceSaving
+        summary of the sections, and how many seconds it covers
+        """
+        tier = self.rollups.tier_for(n_secs) if self.rollups else None
+        if tier is not None:
+            return tier.read(n_secs, now, lock)
+        n_secs = int(math.ceil(n_secs))
+        if n_secs > self.retention:
+            longest = self.rollups.retention() if self.rollups else \
+                self.retention
+            raise ValueError(f"Window of {n_secs}s is longer than the "
+                             f"{longest}s kept")
+        # the complete seconds, like the sliding windows
+        total = 0
+        buckets = []
+        current = int(now)
+        with lock if lock is not None else contextlib.nullcontext():
+            for second in range(current - n_secs, current):
+                index = self.bucket_index(second)
+                if index is not None:
+                    total += self.totals[index]
+                    buckets.append(self.sections[index].copy())
+        summary = SpaceSaving(self.top_k or SUMMARY_SIZE)
+        for sections in buckets:
+            fold_sections(summary, sections)
+        return total, summary, n_secs
+
+    def window(self, n_secs, sections=False):
+        """
+        Gets the sliding window for a length of time, setting it up from the
+        buckets the first time it's asked for.
+        @param n_secs: the window's length in seconds, rounded up to whole
+        seconds
+        @param sections: whether the window needs per-section counts
+        @return: a SlidingWindow
+        """
+        n_secs = int(math.ceil(n_secs))
+        if sections and self.top_k:
+            raise ValueError("Section counts are approximate, use "
+                             "section_summary() instead")
+        if n_secs > self.retention:
+            raise ValueError(f"Window of {n_secs}s is longer than the "
+                             f"{self.retention}s of buckets kept")
+        window = self.windows.get(n_secs)
+        if window is None or (sections and window.sections is None):
+            window = SlidingWindow(self, n_secs, sections)
+            self.windows[n_secs] = window
+        return window
+
+    def total(self, n_secs, now):
+        """
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @return: the number of requests in the last n_secs complete seconds
+        """
+        return self.window(n_secs).read_total(now)
+
+    def section_counts(self, n_secs, now):
+        """
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @return: a dict of section name to request count, over the last
+        n_secs complete seconds
+        """
+        return self.window(n_secs, sections=True).read_sections(now)
+
+    def section_count(self, n_secs, now, section):
+        """
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @param section: a section name
+        @return: the section's request count over the last n_secs complete
+        seconds
+        """
+        return self.window(n_secs, sections=True).read_section(now,
+                                                               section)
+
+    def section_summary(self, n_secs, now, lock=None):
+        """
+        Merges the buckets' section summaries, when the counts are
+        approximate. That's up to n_secs merges of top_k sections each.
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @param lock: the records lock, held only while the summaries are
+        copied, or None if the caller holds it
+        @return: a SpaceSaving summary of the sections over the last
+        n_secs complete seconds
+        """
+        n_secs = int(math.ceil(n_secs))
+        if not self.top_k:
+            raise ValueError("Section counts are exact, use "
+                             "section_counts() instead")
+        if n_secs > self.retention:
+            raise ValueError(f"Window of {n_secs}s is longer than the "
+                             f"{self.retention}s of buckets kept")
+        buckets = []
+        current = int(now)
+        # late records can still be counted into these seconds, so they're
+        # copied, which is far quicker than merging them
+        with lock if lock is not None else contextlib.nullcontext():
+            for second in range(current - n_secs, current):
+                index = self.bucket_index(second)
+                if index is not None:
+                    buckets.append(self.sections[index].copy())
+        summary = SpaceSaving(self.top_k)
+        for sections in buckets:
+            summary.merge(sections)
+        return summary
+
+
+class SlidingWindow:
+    """
+    The running totals over the last n seconds of buckets. It counts every
+    second from 'low' on, including the current, partial, one, which is
+    taken back out when it's read.
+    """
+
+    def __init__(self, aggregator, n_secs, sections):
+        """
+        @param aggregator: the TrafficAggregator this window belongs to
+        @param n_secs: the window length, in whole seconds
+        @param sections: whether to keep per-section counts
+        """
+        self.aggregator = aggregator
+        self.n_secs = n_secs
+        self.total = 0
+        self.sections = Counter() if sections else None
+
+        # start from whatever the buckets hold
+        held = [second for second in aggregator.seconds if second is not None]
+        self.low = min(held) if held else 0
+        for second in held:
+            self.include(second, 1)
+
+    def include(self, second, sign):
+        """
+        Adds a bucket to, (sign 1), or takes it out of, (sign -1), the sums
+        @param second: the bucket's second
+        @param sign: 1 or -1
+        @return: None
+        """
+        aggregator = self.aggregator
+        index = aggregator.bucket_index(second)
+        if index is None:
+            return
+        self.total += sign * aggregator.totals[index]
+        if self.sections is not None:
+            if sign > 0:
+                self.sections.update(aggregator.sections[index])
+            else:
+                self.sections.subtract(aggregator.sections[index])
+                # keep the counter from filling up with zeros
+                for section in aggregator.sections[index]:
+                    if self.sections[section] <= 0:
+                        del self.sections[section]
+
+    def advance_to(self, low):
+        """
+        Slides the start of the window forward, taking out the seconds that
+        fell out of it
+        @param low: the window's new first second
+        @return: None
+        """
+        if low <= self.low:
+            return
+        if low - self.low > self.aggregator.size:
+            # everything we held is long gone, start over from the buckets
+            # from low on, (a replay's clock can jump a long way at once)
+            self.total = 0
+            if self.sections is not None:
+                self.sections.clear()
+            for second in self.aggregator.seconds:
+                if second is not None and second >= low:
+                    self.include(second, 1)
+        else:
+            for second in range(self.low, low):
+                self.include(second, -1)
+        self.low = low
+
+    def current_bucket(self, now):
+        """
+        @param now: the current time
+        @return: the index of the current second's bucket, or None
+        """
+        return self.aggregator.bucket_index(int(now))
+
+    def read_total(self, now):
+        """
+        @param now: the current time
+        @return: the request count over the window's complete seconds
+        """
+        self.advance_to(int(now) - self.n_secs)
+        index = self.current_bucket(now)
+        partial = self.aggregator.totals[index] if index is not None else 0
+        return self.total - partial
+
+    def read_section(self, now, section):
+        """
+        @param now: the current time
+        @param section: a section name
+        @return: the section's request count over the window's complete
+        seconds
+        """
+        self.advance_to(int(now) - self.n_secs)
+        hits = self.sections.get(section, 0)
+        index = self.current_bucket(now)
+        if index is not None:
+            hits -= self.aggregator.sections[index].get(section, 0)
+        return hits
+
+    def read_sections(self, now):
+        """
+        @param now: the current time
+        @return: a dict of section name to request count over the window's
+        complete seconds
+        """
+        self.advance_to(int(now) - self.n_secs)
+        counts = dict(self.sections)
+        index = self.current_bucket(now)
+        if index is not None:
+            for section, hits in self.aggregator.sections[index].items():
+                remaining = counts[section] - hits
+                if remaining > 0:
+                    counts[section] = remaining
+                else:
+                    del counts[section]
+        return counts
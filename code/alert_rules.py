@@ -0,0 +1,374 @@
+import collections
+import contextlib
+import json
+import time
+
+from record_store import int_to_ip, ip_to_int
+
+"""
+    The alert rules, and the engine that checks them all every second.
+"""
+
+
+class AlertRule:
+    """
+    An alert on some count of requests over a period of time. Like the
+    original traffic alert, the threshold is either an average rate per
+    second over the period, or a total number of hits in it.
+
+    Rules don't look at the records. They read the counts from an
+    AlertCounts, which gets them from the TrafficAggregator's running sums,
+    so checking a rule costs the same however much traffic is in its period.
+    """
+    kind = None
+
+    def __init__(self, threshold, period, per_second=True, target=None):
+        """
+        @param threshold: requests per second, or total requests, over the
+        period
+        @param period: in seconds
+        @param per_second: whether the threshold is a rate or a total
+        @param target: what the rule watches, for the kinds that watch
+        something in particular
+        """
+        if threshold <= 0:
+            raise ValueError("An alert threshold has to be more than 0")
+        if period < 1:
+            raise ValueError("An alert period has to be at least a second")
+        self.threshold = threshold
+        self.period = period
+        self.per_second = per_second
+        self.target = target
+
+    def is_over(self, hits):
+        """
+        @param hits: the number of requests in the period
+        @return: whether that's at or over the threshold
+        """
+        if self.per_second:
+            return hits / self.period >= self.threshold
+        return hits >= self.threshold
+
+    def check(self, counts):
+        """
+        @param counts: an AlertCounts
+        @return: a dict of the things over the threshold, to their hits. A
+        rule watching a single thing uses None as its key.
+        """
+        raise NotImplementedError
+
+    def name(self, key):
+        """
+        @param key: one of the keys check() returns
+        @return: how the alert messages refer to it
+        """
+        raise NotImplementedError
+
+    def windows(self):
+        """
+        @return: the window lengths, in seconds, the rule reads
+        """
+        return [self.period]
+
+    def __repr__(self):
+        unit = '/s' if self.per_second else ' hits'
+        target = f' {self.target}' if self.target else ''
+        return f'<{self.kind}{target} {self.threshold}{unit} ' \
+               f'over {self.period}s>'
+
+
+class TotalRule(AlertRule):
+    """
+    All the traffic, the original traffic alert
+    """
+    kind = 'total'
+
+    def check(self, counts):
+        hits = counts.total(self.period)
+        return {None: hits} if self.is_over(hits) else {}
+
+    def name(self, key):
+        return "High traffic"
+
+
+class SectionRule(AlertRule):
+    """
+    The traffic to one section, like '/api'
+    """
+    kind = 'section'
+
+    def check(self, counts):
+        hits = counts.section(self.period, self.target)
+        return {None: hits} if self.is_over(hits) else {}
+
+    def name(self, key):
+        return f"Section {self.target} traffic"
+
+
+class ClientRule(AlertRule):
+    """
+    The traffic from one client, (source ip), or with no target, from each
+    of the busiest clients
+    """
+    kind = 'client'
+
+    def __init__(self, threshold, period, per_second=True, target=None):
+        super().__init__(threshold, period, per_second, target)
+        self.src_ip = ip_to_int(target) if target else None
+
+    def check(self, counts):
+        if self.src_ip is not None:
+            hits = counts.client(self.period, self.src_ip)
+            return {self.target: hits} if self.is_over(hits) else {}
+        return {int_to_ip(src_ip): hits for src_ip, hits in
+                counts.busiest_clients(self.period) if self.is_over(hits)}
+
+    def name(self, key):
+        return f"Client {key}"
+
+
+class ChangeRule(AlertRule):
+    """
+    A sudden jump in traffic: the hits in the last period are at least
+    'factor' times the hits in the period before it. The threshold is a
+    floor, so going from 1 hit to 3 doesn't count as a jump.
+    """
+    kind = 'change'
+
+    def __init__(self, threshold, period, per_second=True, target=None,
+                 factor=2):
+        """
+        @param factor: how many times busier the last period has to be than
+        the one before it
+        """
+        super().__init__(threshold, period, per_second, target)
+        if factor <= 1:
+            raise ValueError("A change alert's factor has to be more than 1")
+        self.factor = factor
+
+    def check(self, counts):
+        hits = counts.total(self.period)
+        before = counts.total(2 * self.period) - hits
+        if self.is_over(hits) and hits >= self.factor * before:
+            return {None: hits}
+        return {}
+
+    def name(self, key):
+        return f"Traffic jump (x{self.factor:g})"
+
+    def windows(self):
+        return [self.period, 2 * self.period]
+
+
+RULE_KINDS = {rule.kind: rule for rule in
+              (TotalRule, SectionRule, ClientRule, ChangeRule)}
+
+
+def rule_from_dict(spec):
+    """
+    Makes a rule from its description, the form rules take in a rules file:
+        {"kind": "section", "target": "/api", "rate": 50, "period": 60}
+
+    kind is one of 'total', 'section', 'client' or 'change'. The threshold
+    is given as either 'rate', requests per second, or 'hits', total
+    requests, over 'period' seconds, (default 120). 'section' rules need a
+    target, 'client' rules may have one, (without, every client is watched),
+    and 'change' rules may have a 'factor', (default 2).
+
+    @param spec: a dict, like the above
+    @return: an AlertRule
+    """
+    spec = dict(spec)
+    kind = spec.pop('kind', None)
+    rule_class = RULE_KINDS.get(kind)
+    if rule_class is None:
+        raise ValueError(f"Unknown alert rule kind {kind!r}, it should be "
+                         f"one of {', '.join(RULE_KINDS)}")
+    if ('rate' in spec) == ('hits' in spec):
+        raise ValueError(f"A {kind} rule needs either a rate or a hits "
+                         f"threshold")
+    per_second = 'rate' in spec
+    threshold = float(spec.pop('rate')) if per_second \
+        else int(spec.pop('hits'))
+    period = float(spec.pop('period', 120))
+    target = spec.pop('target', None)
+    if kind == 'section' and not target:
+        raise ValueError("A section rule needs a target section, like /api")
+    if kind in ('total', 'change') and target:
+        raise ValueError(f"A {kind} rule doesn't take a target")
+    extra = {}
+    if kind == 'change' and 'factor' in spec:
+        extra['factor'] = float(spec.pop('factor'))
+    if spec:
+        raise ValueError(f"Unknown settings for a {kind} rule: "
+                         f"{', '.join(spec)}")
+    return rule_class(threshold, period, per_second, target, **extra)
+
+
+def parse_rule(text):
+    """
+    Makes a rule from the command line form, the kind, (with its target if
+    it has one), then the settings:
+        "section=/api rate=50 period=60"
+        "client=10.0.0.5 hits=1000 period=600"
+        "client rate=5"
+        "change factor=3 rate=1 period=30"
+    See rule_from_dict for what the settings mean.
+    @param text: the rule
+    @return: an AlertRule
+    """
+    words = text.split()
+    if not words:
+        raise ValueError("Empty alert rule")
+    kind, _, target = words[0].partition('=')
+    spec = {'kind': kind}
+    if target and target != '*':
+        spec['target'] = target
+    for word in words[1:]:
+        key, equals, value = word.partition('=')
+        if not equals:
+            raise ValueError(f"Alert rule setting {word!r} should look "
+                             f"like name=value")
+        spec[key] = value
+    return rule_from_dict(spec)
+
+
+def load_rules(path):
+    """
+    @param path: a JSON file holding a list of rule descriptions, see
+    rule_from_dict
+    @return: a list of AlertRules
+    """
+    with open(path) as rules_file:
+        specs = json.load(rules_file)
+    if not isinstance(specs, list):
+        raise ValueError(f"{path} should hold a list of alert rules")
+    return [rule_from_dict(spec) for spec in specs]
+
+
+class AlertCounts:
+    """
+    The counts the rules read, for one check of all of them. It's just a
+    front for the TrafficAggregator and its ClientStats, but the few reads
+    that aren't constant time, (the busiest clients, and approximate section
+    counts), are done once per window and shared by all the rules that need
+    them.
+    """
+
+    def __init__(self, store, now, lock=None):
+        """
+        @param store: the RecordStore, with an aggregator
+        @param now: the current time
+        @param lock: the records lock, taken for each read, (and only while
+        the buckets are copied for the ones that merge them), or None if the
+        caller holds it
+        """
+        self.store = store
+        self.aggregator = store.aggregator
+        self.now = now
+        self.lock = lock
+        self.held = lock if lock is not None else contextlib.nullcontext()
+        self.cache = {}
+
+    def total(self, n_secs):
+        with self.held:
+            return self.aggregator.total(n_secs, self.now)
+
+    def section(self, n_secs, section):
+        """
+        @param n_secs: the window length
+        @param section: a section name
+        @return: the hits to the section in the window
+        """
+        if not self.aggregator.top_k:
+            with self.held:
+                return self.aggregator.section_count(n_secs, self.now,
+                                                     section)
+        key = ('sections', n_secs)
+        if key not in self.cache:
+            self.cache[key] = self.aggregator.section_summary(
+                n_secs, self.now, self.lock)
+        return self.cache[key].counts.get(section, 0)
+
+    def client(self, n_secs, src_ip):
+        """
+        @param n_secs: the window length
+        @param src_ip: a source ip, as an integer
+        @return: the (estimated) hits from the client in the window
+        """
+        clients = self.aggregator.clients
+        with self.held:
+            return clients.window(n_secs, self.now).estimate(src_ip)
+
+    def busiest_clients(self, n_secs):
+        """
+        @param n_secs: the window length
+        @return: a list of (src_ip, hits) of the busiest clients in the window
+        """
+        key = ('clients', n_secs)
+        if key not in self.cache:
+            self.cache[key] = self.aggregator.clients.top_clients(
+                n_secs, self.now, None, self.lock)
+        return self.cache[key]
+
+
+class AlertEngine:
+    """
+    Checks a list of rules, and keeps the alert messages as they fire and
+    recover. It replaces TrafficAlert for the running program, which only
+    had the one rule, (the TotalRule), and recounted its records every time.
+    """
+
+    def __init__(self, rules):
+        """
+        @param rules: a list of AlertRules
+        """
+        self.rules = list(rules)
+        # for each rule, the keys whose alerts are in progress
+        self.engaged = {rule: {} for rule in self.rules}
+        self.msg_deque = collections.deque()
+
+    def windows(self):
+        """
+        @return: the set of window lengths, in seconds, the rules read
+        """
+        return {n_secs for rule in self.rules for n_secs in rule.windows()}
+
+    def client_windows(self):
+        """
+        @return: the set of window lengths the client rules read, which the
+        ClientStats has to be set up with
+        """
+        return {rule.period for rule in self.rules
+                if isinstance(rule, ClientRule)}
+
+    def evaluate(self, store, lock, now=None):
+        """
+        Checks every rule, adding a message for each alert that fires or
+        recovers.
+        @param store: the RecordStore, with an aggregator
+        @param lock: the records lock
+        @param now: the time to check at, or None for now
+        @return: the message deque
+        """
+        if now is None:
+            now = time.time()
+        counts = AlertCounts(store, now, lock)
+        results = [(rule, rule.check(counts)) for rule in self.rules]
+
+        msg_time = time.strftime('%d %b %H:%M:%S', time.localtime(now))
+        for rule, over in results:
+            engaged = self.engaged[rule]
+            for key, hits in over.items():
+                if key not in engaged:
+                    self.msg_deque.append(
+                        f"{rule.name(key)} generated an alert - hits = "
+                        f"{hits} triggered at {msg_time}")
+            for key in engaged.keys() - over.keys():
+                self.msg_deque.append(
+                    f"{rule.name(key)} alert recovered at {msg_time}")
+            self.engaged[rule] = over
+
+        while len(self.msg_deque) > 500:
+            self.msg_deque.popleft()
+        return self.msg_deque
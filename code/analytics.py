@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+"""
+    The analytics tick. Every statistic the program shows, (the sections,
+    the clients, the rate, the alerts...), is worked out by one thread, on
+    one fixed tick, instead of each by a scheduler job of its own. On each
+    tick the jobs that are due all see the same 'now', so everything shown
+    together was worked out for the same moment, (and the windows only
+    cover complete seconds, so from the same records, but for any that
+    arrive late). Their view updates are then published together.
+
+    The jobs take the records lock themselves, each just long enough to
+    copy what it reads, and work out their numbers after letting it go, so
+    the ingest loop is never held up for a whole tick.
+
+    The tick also keeps track of how long it takes. If it takes longer than
+    the interval, the ticks it ran into are skipped, (rather than run late,
+    one after another), and counted as overruns, which means the analysis
+    can't keep up.
+"""
+
+log = logging.getLogger(__name__)
+
+
+class TickJob:
+    """
+    A job, and when it's next due
+    """
+
+    def __init__(self, func, every):
+        """
+        @param func: called with 'now', returns a list of view updates, (or
+        None)
+        @param every: run every this many ticks
+        """
+        self.func = func
+        self.every = every
+        self.next_tick = 0
+
+
+class AnalyticsTick:
+    """
+    Runs jobs on a fixed tick, from a thread of its own
+    """
+
+    def __init__(self, lock, time_source, publish, interval=1.0):
+        """
+        @param lock: the records lock, held while the tick's 'now' is read.
+        The jobs take it themselves.
+        @param time_source: returns the current time, (clock.time)
+        @param publish: called with each tick's view updates, a list, when
+        there are any
+        @param interval: the tick length, in seconds
+        """
+        self.lock = lock
+        self.time_source = time_source
+        self.publish = publish
+        self.interval = interval
+        self.jobs = []
+        self.ticks = 0
+        self.overruns = 0
+        self.errors = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def add(self, func, every=1):
+        """
+        Adds a job, which first runs on the next tick
+        @param func: called with 'now', returns a list of view updates, (or
+        None)
+        @param every: run every this many ticks
+        @return: None
+        """
+        self.jobs.append(TickJob(func, every))
+
+    def run_once(self, number):
+        """
+        Runs the jobs that are due, then publishes their updates
+        @param number: the tick's number, counting from 0 at the start
+        @return: None
+        """
+        began = time.perf_counter()
+        updates = []
+        with self.lock:
+            now = self.time_source()
+        for job in self.jobs:
+            if number < job.next_tick:
+                continue
+            job.next_tick = number + job.every
+            try:
+                updates.extend(job.func(now) or [])
+            except Exception:
+                # like the scheduler did, a failing job is logged and the
+                # rest carry on
+                self.errors += 1
+                log.exception("Analytics job %r failed", job.func)
+        if updates:
+            self.publish(updates)
+        self.last_duration = time.perf_counter() - began
+        self.max_duration = max(self.max_duration, self.last_duration)
+        self.ticks += 1
+
+    def run(self):
+        """
+        Ticks until stop() is called
+        @return: None
+        """
+        start = time.monotonic()
+        number = 0
+        while not self.stopping.is_set():
+            self.run_once(number)
+            number += 1
+            behind = time.monotonic() - (start + number * self.interval)
+            if behind >= 0:
+                # the tick ran into the next one, so skip the ticks there
+                # wasn't time for, (the jobs due in them run on the next)
+                skipped = int(behind // self.interval) + 1
+                self.overruns += skipped
+                number += skipped
+            self.stopping.wait(start + number * self.interval -
+                               time.monotonic())
+
+    def start(self):
+        """
+        Starts ticking in a daemon thread
+        @return: None
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the ticking, after the tick in progress
+        @return: None
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        """
+        The tick's numbers, for the view
+        @return: a dict with the last 'tick ms', the slowest, ('max tick
+        ms'), and the ticks skipped because one ran too long, ('overruns')
+        """
+        return {'tick ms': round(self.last_duration * 1000, 1),
+                'max tick ms': round(self.max_duration * 1000, 1),
+                'overruns': self.overruns}
@@ -0,0 +1,6 @@
+"""
+    Benchmarks for the parts of traffic watch that have to keep up with the
+    traffic. Run them from the code folder, like:
+
+        python -m benchmarks.bench_sections
+"""
@@ -0,0 +1,109 @@
+import argparse
+import collections
+import random
+import time
+import timeit
+from contextlib import nullcontext
+
+import traffic_watch
+from aggregator import TrafficAggregator
+from alert_rules import AlertEngine, ChangeRule, ClientRule, SectionRule, \
+    TotalRule
+from client_stats import ClientStats
+from record_store import RecordStore, int_to_ip
+
+"""
+    Compares the cost of an alert check: the original traffic alert, which
+    collected its whole period of record dicts every second to count them,
+    against the AlertEngine reading the aggregator's running counts, with
+    one rule and with a hundred.
+"""
+
+RETENTION = 600
+ALERT_PERIOD = 120
+SECTION_COUNT = 50
+CLIENT_COUNT = 1000
+
+
+def make_rows(rate, now, seed=0):
+    """
+    @param rate: requests per second
+    @param now: the time of the newest record
+    @param seed: for the random number generator, so runs are comparable
+    @return: a list of (time, src_ip, section) rows covering the retention
+    period, oldest first
+    """
+    rng = random.Random(seed)
+    count = rate * RETENTION
+    start = now - RETENTION
+    return [(start + i / rate, 0x0a000000 + rng.randrange(CLIENT_COUNT),
+             f'/section{rng.randrange(SECTION_COUNT)}')
+            for i in range(count)]
+
+
+def make_rules(count):
+    """
+    @param count: the number of rules
+    @return: a mix of all the kinds of rule, starting with the traffic alert
+    """
+    rules = [TotalRule(20, ALERT_PERIOD)]
+    for i in range(1, count):
+        kind = i % 4
+        if kind == 0:
+            rules.append(TotalRule(10 + i, 60))
+        elif kind == 1:
+            rules.append(SectionRule(5, 60, target=f'/section{i % 50}'))
+        elif kind == 2:
+            rules.append(ClientRule(5, 60, target=int_to_ip(0x0a000000 + i)))
+        else:
+            rules.append(ChangeRule(1, 60, factor=2 + i % 3))
+    rules.append(ClientRule(2, 60))
+    return rules[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks an alert check')
+    parser.add_argument('--rate', type=int, default=1000,
+                        help='Requests per second of made up traffic')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Checks per method, the best one is reported')
+    args = parser.parse_args()
+
+    now = time.time()
+    rows = make_rows(args.rate, now)
+
+    # the original: a deque of dicts, recounted every check
+    records = collections.deque({'time': t, 'src_ip': int_to_ip(src_ip),
+                                 'path': section}
+                                for t, src_ip, section in rows)
+
+    def original():
+        # what traffic_alert did before it counted with the aggregator
+        found, _ = traffic_watch.get_last_n_seconds_records(records,
+                                                            ALERT_PERIOD)
+        return len(found)
+
+    store = RecordStore(aggregator=TrafficAggregator(
+        RETENTION, clients=ClientStats([60, ALERT_PERIOD])))
+    store.append_batch(rows)
+
+    print(f'{len(rows)} records, {args.rate} a second')
+    print(f"{'method':<34}{'best ms':>10}")
+    results = [('original traffic alert', original)]
+    for count in (1, 10, 100):
+        engine = AlertEngine(make_rules(count))
+        # the first check sets up the running windows, which only happens
+        # once
+        engine.evaluate(store, nullcontext(), now)
+        results.append((f'AlertEngine, {count} rules',
+                        lambda engine=engine:
+                        engine.evaluate(store, nullcontext(), now)))
+
+    for name, method in results:
+        best = min(timeit.repeat(method, number=1, repeat=args.repeat))
+        print(f'{name:<34}{best * 1000:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
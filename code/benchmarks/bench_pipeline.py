@@ -0,0 +1,465 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import queue
+import random
+import socket
+import subprocess
+import sys
+import time
+from contextlib import nullcontext
+from struct import pack
+
+import traffic_watch
+from aggregator import TrafficAggregator
+from alert_rules import AlertEngine
+from benchmarks.bench_alerts import make_rules
+from benchmarks.bench_http_parser import OTHER, REQUESTS
+from client_stats import ClientStats
+from clock import ReplayClock
+from record_store import RecordStore
+from sniffers.bare_socket_based_sniffer import BareSocketSniffer
+from sniffers.reassembly import FlowTable
+from transport import make_transport
+from view_manager import ViewManager
+
+try:
+    from scapy.layers.inet import IP
+    from scapy.layers.http import HTTPRequest
+    from sniffers.scapy_based_sniffer import ScapySniffer
+except ImportError:
+    ScapySniffer = None
+
+"""
+    Times each stage between a packet arriving and the screen showing it, on
+    made up packets and without root, at several sizes: parsing the packets,
+    getting the records to the main process, adding them to the record
+    store, the window queries, counting the sections, checking the alerts
+    and drawing the screen.
+
+    The results are printed and written out as JSON, and an earlier run's
+    JSON can be given with --compare to see what got faster or slower.
+"""
+
+DEFAULT_SIZES = (10_000, 100_000)
+RETENTION = traffic_watch.RECORD_RETENTION_PERIOD
+# when the made up traffic ends
+END = 1_700_000_000.0
+DEST_PORT = 8080
+FLOW_COUNT = 1000
+SECTION_COUNT = 50
+CLIENT_COUNT = 1000
+# scapy manages a few thousand packets a second, so it gets fewer of them
+SCAPY_MAX_PACKETS = 5000
+
+
+def make_packets(count, request_share=0.5, seed=0):
+    """
+    Makes IP packets headed for DEST_PORT, spread over FLOW_COUNT
+    connections, with each connection's sequence numbers following on so the
+    reassembler sees ordinary in-order streams.
+    @param count: the number of packets
+    @param request_share: the fraction of them that start with a request
+    @param seed: for the random number generator, so runs are comparable
+    @return: a list of packets, as bytes starting at the IP header
+    """
+    rng = random.Random(seed)
+    destination = socket.inet_aton('127.0.0.1')
+    sequences = [1] * FLOW_COUNT
+    packets = []
+    for i in range(count):
+        flow = i % FLOW_COUNT
+        pool = REQUESTS if rng.random() < request_share else OTHER
+        payload = rng.choice(pool)
+        tcp = pack('!HHLLBBHHH', 10000 + flow, DEST_PORT, sequences[flow], 0,
+                   5 << 4, 0x18, 65535, 0, 0)
+        source = pack('!I', 0x0a000000 + flow % CLIENT_COUNT)
+        packets.append(pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0,
+                            0, 64, 6, 0, source, destination) + tcp + payload)
+        sequences[flow] = (sequences[flow] + len(payload)) & 0xffffffff
+    return packets
+
+
+def make_rows(count, seed=0):
+    """
+    @param count: the number of records
+    @param seed: for the random number generator, so runs are comparable
+    @return: a list of (time, src_ip, section) rows spread evenly over the
+    retention period up to END, oldest first, with the sections' popularity
+    falling off like real traffic
+    """
+    rng = random.Random(seed)
+    names = [f'/section{i}' for i in range(SECTION_COUNT)]
+    weights = [1 / (i + 1) for i in range(SECTION_COUNT)]
+    sections = rng.choices(names, weights, k=count)
+    start = END - RETENTION
+    return [(start + RETENTION * i / count,
+             0x0a000000 + rng.randrange(CLIENT_COUNT), section)
+            for i, section in enumerate(sections)]
+
+
+def make_store(rows, aggregator=True):
+    """
+    @param rows: the records to put in it
+    @param aggregator: whether it keeps running counts, like the app's does,
+    with the clients tracked over the windows the alert rules use
+    @return: a RecordStore holding the rows
+    """
+    client_windows = sorted({RETENTION} |
+                            set(AlertEngine(make_rules(10)).client_windows()))
+    store = RecordStore(aggregator=TrafficAggregator(
+        RETENTION, clients=ClientStats(client_windows))
+        if aggregator else None)
+    for i in range(0, len(rows), 256):
+        store.append_batch(rows[i:i + 256])
+    return store
+
+
+def best_time(run, repeat, setup=None):
+    """
+    @param run: the thing to time, called with whatever setup returns
+    @param repeat: how many times to run it, the fastest is kept
+    @param setup: called before each run, untimed, for runs that need fresh
+    state, or None
+    @return: the fastest run, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        run(*args)
+        taken = time.perf_counter() - start
+        best = taken if best is None else min(best, taken)
+    return best
+
+
+def parse_stage(packets, reassemble):
+    sniffer = BareSocketSniffer(reassemble=reassemble)
+
+    def setup():
+        sniffer.flow_table = FlowTable() if reassemble else None
+        return ()
+
+    def run():
+        parse_requests = sniffer.parse_requests
+        for packet in packets:
+            parse_requests(packet, '127.0.0.1', DEST_PORT, END)
+
+    return run, setup
+
+
+def scapy_stage(packets):
+    sniffer = ScapySniffer()
+    packets = packets[:SCAPY_MAX_PACKETS]
+
+    # the_packet() puts on a queue, a list's append stands in for it
+    sent_queue = type('ListQueue', (list,), {'put': list.append})
+
+    def run():
+        # what scapy's sniff() does with each packet, after the capture
+        sent = sent_queue()
+        for raw in packets:
+            packet = IP(raw)
+            if packet.haslayer(HTTPRequest):
+                sniffer.the_packet(packet, sent)
+
+    return run, len(packets)
+
+
+def scapy_fast_stage(packets):
+    sniffer = ScapySniffer(fast=True)
+    # the L2ListenSocket hands over whole frames, ethernet header and all
+    header = bytes(12) + pack('!H', 0x0800)
+    frames = [(header + raw, END) for raw in packets[:SCAPY_MAX_PACKETS]]
+    batches = [frames[i:i + sniffer.batch_size]
+               for i in range(0, len(frames), sniffer.batch_size)]
+
+    def run():
+        # what the fast mode does with each batch read off the socket
+        for batch in batches:
+            sniffer.requests_in(batch)
+
+    return run, len(frames)
+
+
+def send_records(sender, count):
+    """
+    The sniffer process's side of the transport stage
+    @param sender: the transport's sender
+    @param count: how many records to send
+    @return: None
+    """
+    for i in range(count):
+        sender.put({'time': END + i * 1e-6, 'src_ip': '10.0.0.1',
+                    'path': f'/section{i % SECTION_COUNT}'})
+    sender.flush()
+
+
+def transport_stage(kind, count):
+    """
+    Times records going from a sender in another process to the receiver in
+    this one, from the sender starting to the last record arriving
+    @param kind: 'queue' or 'shm'
+    @param count: how many records
+    @return: (seconds, dropped), with dropped the records lost because a
+    shared memory ring was full
+    """
+    senders, receiver = make_transport(kind, 1)
+    try:
+        process = multiprocessing.Process(target=send_records,
+                                          args=(senders[0], count),
+                                          daemon=True)
+        start = time.perf_counter()
+        process.start()
+        received = 0
+        while received + receiver.stats().get('overflows', 0) < count:
+            try:
+                received += len(receiver.get(timeout=1))
+            except queue.Empty:
+                if not process.is_alive():
+                    break
+        taken = time.perf_counter() - start
+        process.join()
+        return taken, count - received
+    finally:
+        receiver.close()
+
+
+class StandInTerminal:
+    """
+    Enough of a blessed Terminal for the ViewManager, with the same cursor
+    moves and styles a real terminal gets
+    """
+    width = 120
+    height = 40
+
+    def move_xy(self, x, y):
+        return f'\x1b[{y + 1};{x + 1}H'
+
+    def underline(self, text):
+        return f'\x1b[4m{text}\x1b[m'
+
+
+def render_frame(view, sections, clients, alerts, rate, capture, pipeline):
+    """
+    Makes one frame of updates, like a second of the jobs' updates, and
+    draws it
+    @return: the text for the terminal
+    """
+    view.update_section_activity(list(sections), 'VW_SA_1')
+    view.update_section_activity(list(sections), 'VW_SA_2')
+    view.update_top_clients(clients, 'VW_CL_1')
+    view.update_traffic_alert(alerts, 'VW_TFC_1')
+    view.update_request_rate(rate, 'VW_RATE_1')
+    view.update_capture_stats(capture, 'VW_CAP_1')
+    view.update_pipeline_stats(pipeline, 'VW_PIPE_1')
+    return view.screen.render()
+
+
+def run_stages(size, repeat, stages):
+    """
+    @param size: the number of packets or records
+    @param repeat: runs per stage, the best one is reported
+    @param stages: the names of the stages to run
+    @return: a list of result dicts: 'stage', 'size', 'items', 'unit',
+    'seconds', 'rate', (items a second), for the transport, 'dropped', and
+    for the render, 'bytes_per_frame'
+    """
+    results = []
+
+    def add(stage, items, unit, seconds, **extra):
+        results.append(dict(stage=stage, size=size, items=items, unit=unit,
+                            seconds=seconds, rate=items / seconds, **extra))
+
+    if {'parse', 'parse-reassembly', 'parse-scapy',
+            'parse-scapy-fast'} & stages:
+        packets = make_packets(size)
+        if 'parse' in stages:
+            run, setup = parse_stage(packets, reassemble=False)
+            add('parse', size, 'packets', best_time(run, repeat, setup))
+        if 'parse-reassembly' in stages:
+            run, setup = parse_stage(packets, reassemble=True)
+            add('parse-reassembly', size, 'packets',
+                best_time(run, repeat, setup))
+        if 'parse-scapy' in stages and ScapySniffer is not None:
+            run, count = scapy_stage(packets)
+            add('parse-scapy', count, 'packets', best_time(run, repeat))
+        if 'parse-scapy-fast' in stages and ScapySniffer is not None:
+            run, count = scapy_fast_stage(packets)
+            add('parse-scapy-fast', count, 'packets', best_time(run, repeat))
+        del packets
+
+    for kind in ('queue', 'shm'):
+        if f'transport-{kind}' in stages:
+            timings = [transport_stage(kind, size) for _ in range(repeat)]
+            seconds, dropped = min(timings)
+            add(f'transport-{kind}', size, 'records', seconds,
+                dropped=dropped)
+
+    rows = make_rows(size)
+    if 'ingest' in stages:
+        def ingest(store):
+            for i in range(0, size, 256):
+                store.append_batch(rows[i:i + 256])
+
+        add('ingest', size, 'records',
+            best_time(ingest, repeat, lambda: (make_store([]),)))
+
+    # the queries read the time from the app's clock, so pin it to the end
+    # of the made up traffic
+    replay_clock = ReplayClock()
+    replay_clock.advance(END)
+    traffic_watch.clock = replay_clock
+    store = make_store(rows)
+    plain_store = make_store(rows, aggregator=False)
+
+    if 'window' in stages:
+        # what the view's jobs did every second before the aggregator: find
+        # the last 10 minutes and copy out its columns
+        def window():
+            found, _ = traffic_watch.get_last_n_seconds_records(plain_store,
+                                                                RETENTION)
+            found.column('times')
+            found.section_ids()
+
+        add('window', size, 'records', best_time(window, repeat))
+
+    if 'sections' in stages:
+        add('sections', size, 'records', best_time(
+            lambda: traffic_watch.recent_section_activity(store, RETENTION,
+                                                          top_n=5), repeat))
+        add('sections-recount', size, 'records', best_time(
+            lambda: traffic_watch.recent_section_activity(plain_store,
+                                                          RETENTION,
+                                                          top_n=5), repeat))
+
+    if 'alerts' in stages:
+        engine = AlertEngine(make_rules(10))
+        # the first check sets up the running windows, which only happens
+        # once
+        engine.evaluate(store, nullcontext(), END)
+        add('alerts', size, 'records', best_time(
+            lambda: engine.evaluate(store, nullcontext(), END), repeat))
+
+    if 'render' in stages:
+        frames = 100
+        sections = traffic_watch.recent_section_activity(store, 10, top_n=5)
+        clients = traffic_watch.client_activity(store, RETENTION)
+        alerts = [f'High traffic generated an alert - hits = {i}'
+                  for i in range(10)]
+        view = ViewManager(StandInTerminal())
+
+        sent = []
+
+        def render():
+            # the counters move on every frame, like they do live
+            sent[:] = [len(render_frame(
+                view, sections, clients, alerts, 42 + frame,
+                {'packets': size + frame, 'drops': 0},
+                {'depth': frame % 10, 'records': size + frame}))
+                for frame in range(frames)]
+
+        # and how much is written to the terminal for each frame
+        add('render', frames, 'frames', best_time(render, repeat),
+            bytes_per_frame=round(sum(sent) / frames))
+
+    traffic_watch.clock = traffic_watch.WallClock()
+    return results
+
+
+STAGES = ('parse', 'parse-reassembly', 'parse-scapy', 'parse-scapy-fast',
+          'transport-queue', 'transport-shm', 'ingest', 'window', 'sections',
+          'alerts', 'render')
+
+
+def version():
+    """
+    @return: the git commit being benchmarked, or None outside a checkout
+    """
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_path):
+    """
+    Prints how each result's rate changed since an earlier run
+    @param results: this run's results
+    @param old_path: the earlier run's JSON file
+    @return: None
+    """
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    old_rates = {(result['stage'], result['size']): result['rate']
+                 for result in old['results']}
+    print(f"\ncompared to {old.get('version')}:")
+    print(f"{'stage':<20}{'size':>10}{'was /s':>14}{'now /s':>14}"
+          f"{'change':>9}")
+    if not old_rates.keys() & {(result['stage'], result['size'])
+                               for result in results}:
+        print('no stages and sizes in common')
+    for result in results:
+        was = old_rates.get((result['stage'], result['size']))
+        if was:
+            print(f"{result['stage']:<20}{result['size']:>10}{was:>14,.0f}"
+                  f"{result['rate']:>14,.0f}"
+                  f"{result['rate'] / was - 1:>+9.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks each stage of the capture to view pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help='Numbers of packets or records to run with')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=list(STAGES),
+                        help='The stages to run, all of them by default')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per stage, the best one is reported')
+    parser.add_argument('--output', default='bench_pipeline.json',
+                        help="Where to write the results as JSON, '-' for "
+                             "nowhere")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="An earlier run's results to compare with")
+    args = parser.parse_args()
+
+    stages = set(args.stages)
+    if {'parse-scapy', 'parse-scapy-fast'} & stages and ScapySniffer is None:
+        print('scapy is not installed, skipping the scapy parsing')
+
+    print(f"{'stage':<20}{'size':>10}{'items':>10}{'unit':>9}"
+          f"{'best ms':>11}{'per sec':>17}")
+    results = []
+    for size in args.sizes:
+        for result in run_stages(size, args.repeat, stages):
+            results.append(result)
+            note = f"  ({result['dropped']} dropped)" \
+                if result.get('dropped') else ''
+            if 'bytes_per_frame' in result:
+                note = f"  ({result['bytes_per_frame']} bytes a frame)"
+            print(f"{result['stage']:<20}{result['size']:>10}"
+                  f"{result['items']:>10}{result['unit']:>9}"
+                  f"{result['seconds'] * 1000:>11.3f}"
+                  f"{result['rate']:>17,.0f}{note}")
+
+    if args.output != '-':
+        with open(args.output, 'w') as output:
+            json.dump({'version': version(),
+                       'when': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'python': sys.version.split()[0],
+                       'platform': platform.platform(),
+                       'cpus': multiprocessing.cpu_count(),
+                       'repeat': args.repeat,
+                       'results': results}, output, indent=2)
+        print(f'\nwrote {args.output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import random
+import timeit
+from array import array
+
+import section_counter
+
+try:
+    from pandas import DataFrame
+except ImportError:
+    DataFrame = None
+
+"""
+    Compares the ways of counting section hits for the 'most popular
+    sections' list: the pandas groupby it used to be, against
+    section_counter's Counter and numpy paths, over record dicts and over the
+    RecordStore's interned section ids.
+"""
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+SECTION_COUNT = 50
+
+
+def make_records(size, seed=0):
+    """
+    Makes some records, with the sections' popularity falling off like real
+    traffic does rather than being uniform.
+    @param size: the number of records
+    @param seed: for the random number generator, so runs are comparable
+    @return: (dicts, section_ids, section_names) - the records as a list of
+    dicts, and as an array of interned section ids with the names they map to
+    """
+    rng = random.Random(seed)
+    section_names = [f'/section{i}' for i in range(SECTION_COUNT)]
+    weights = [1 / (i + 1) for i in range(SECTION_COUNT)]
+    section_ids = array('I', rng.choices(range(SECTION_COUNT), weights,
+                                         k=size))
+    dicts = [{'time': float(i), 'src_ip': '127.0.0.1',
+              'path': section_names[section_id]}
+             for i, section_id in enumerate(section_ids)]
+    return dicts, section_ids, section_names
+
+
+def pandas_dicts(dicts, section_ids, section_names):
+    vals = DataFrame(dicts).groupby(['path']).size() \
+        .sort_values(ascending=False)
+    return list(zip(vals.index, vals.values))
+
+
+def pandas_ids(dicts, section_ids, section_names):
+    vals = DataFrame({'path': section_ids}).groupby(['path']).size() \
+        .sort_values(ascending=False)
+    return [(section_names[i], hits) for i, hits in zip(vals.index,
+                                                        vals.values)]
+
+
+def counter_dicts(dicts, section_ids, section_names):
+    return section_counter.count_paths(dicts)
+
+
+def counter_ids(dicts, section_ids, section_names):
+    numpy = section_counter.numpy
+    section_counter.numpy = None
+    try:
+        counts = section_counter.count_section_ids(section_ids)
+    finally:
+        section_counter.numpy = numpy
+    return [(section_names[i], hits) for i, hits in counts]
+
+
+def numpy_ids(dicts, section_ids, section_names):
+    counts = section_counter.count_section_ids(section_ids)
+    return [(section_names[i], hits) for i, hits in counts]
+
+
+def methods():
+    """
+    @return: a list of (name, function) of the counting methods available
+    """
+    available = []
+    if DataFrame is not None:
+        available += [('pandas, dicts', pandas_dicts),
+                      ('pandas, ids', pandas_ids)]
+    available += [('Counter, dicts', counter_dicts),
+                  ('Counter, ids', counter_ids)]
+    if section_counter.load_numpy() is not None:
+        available.append(('numpy bincount, ids', numpy_ids))
+    return available
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the section hit counting')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='The record counts to try')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per method, the best one is reported')
+    args = parser.parse_args()
+
+    if DataFrame is None:
+        print('pandas is not installed, skipping the pandas methods')
+    if section_counter.load_numpy() is None:
+        print('numpy is not installed, skipping the numpy method')
+
+    print(f"{'records':>10}  {'method':<22}{'best ms':>10}{'vs pandas':>11}")
+    for size in args.sizes:
+        data = make_records(size)
+        expected = None
+        baseline = None
+        for name, method in methods():
+            result = method(*data)
+            # the order of equal counts differs between methods, compare the
+            # counts themselves
+            counts = {section: int(hits) for section, hits in result}
+            if expected is None:
+                expected = counts
+            elif counts != expected:
+                raise AssertionError(f'{name} counted differently')
+
+            best = min(timeit.repeat(lambda: method(*data), number=1,
+                                     repeat=args.repeat))
+            if baseline is None and DataFrame is not None:
+                baseline = best
+            speedup = f'{baseline / best:.1f}x' if baseline else '-'
+            print(f'{size:>10}  {name:<22}{best * 1000:>10.2f}{speedup:>11}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+    How long the monitor takes from being started to having its first
+    request: the python start up and imports, setting up the sniffer, and the
+    first captured packet getting through the sniffer process and the
+    transport. Every run is a fresh interpreter, the way a restart during a
+    deploy is, with requests being sent to a local server the whole time.
+
+    Capturing needs root, so without it only the start up and imports are
+    timed.
+"""
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What each fresh interpreter runs: traffic_watch's imports, then the sniffer
+# started like traffic_watch starts it, with the default batching, until the
+# first batch of records comes through. It prints when it got to each.
+CHILD = """
+import sys, time
+import traffic_watch
+print('imported', time.time(), flush=True)
+if len(sys.argv) > 1:
+    import sniffers
+    from multiprocessing import Process
+    from transport import make_transport
+    sniffer = sniffers.get_sniffer(sys.argv[1])
+    senders, receiver = make_transport('queue', 1, 256, 0.05, 65536)
+    process = Process(target=sniffer.run_sniffer, daemon=True,
+                      args=('127.0.0.1', int(sys.argv[2]), senders[0]))
+    process.start()
+    while True:
+        try:
+            receiver.get(timeout=0.1)
+            break
+        except Exception:
+            if not process.is_alive():
+                sys.exit('The sniffer stopped')
+    print('first', time.time(), flush=True)
+"""
+
+
+class Quiet(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def send_requests(port, stop):
+    """
+    Sends requests to the local server, a few a millisecond, until stopped
+    @param port: the server's port
+    @param stop: a threading.Event
+    @return: None
+    """
+    while not stop.is_set():
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/startup',
+                                   timeout=1).read()
+        except OSError:
+            pass
+        stop.wait(0.005)
+
+
+def start_up(args):
+    """
+    Runs a fresh interpreter
+    @param args: the arguments for CHILD, none for just the imports
+    @return: a dict of the seconds from starting it to each point it
+    printed
+    """
+    began = time.time()
+    output = subprocess.run([sys.executable, '-c', CHILD] + args,
+                            cwd=CODE_DIR, capture_output=True, text=True,
+                            timeout=120, check=True).stdout
+    return {point: float(when) - began for point, when in
+            (line.split() for line in output.splitlines())}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the start up, to the first captured request')
+    parser.add_argument('--backends', nargs='+',
+                        default=['socket', 'mmap', 'scapy'],
+                        help='The sniffer backends to time')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Start ups for each, the best one is reported')
+    args = parser.parse_args()
+
+    print(f"{'start up':<28}{'imported s':>12}{'first request s':>17}")
+    bare = min(start_up([])['imported'] for _ in range(args.repeat))
+    print(f"{'imports only':<28}{bare:>12.3f}")
+    if os.geteuid() != 0:
+        print("Capturing needs root, so that's all")
+        return
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Quiet)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    stop = threading.Event()
+    threading.Thread(target=send_requests, args=(port, stop),
+                     daemon=True).start()
+    try:
+        for backend in args.backends:
+            try:
+                runs = [start_up([backend, str(port)])
+                        for _ in range(args.repeat)]
+            except subprocess.CalledProcessError as e:
+                print(f"{backend:<28}failed, "
+                      f"{e.stderr.strip().splitlines()[-1]}")
+                continue
+            imported = min(run['imported'] for run in runs)
+            first = min(run['first'] for run in runs)
+            print(f"{backend:<28}{imported:>12.3f}{first:>17.3f}")
+    finally:
+        stop.set()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+import contextlib
+from collections import Counter
+
+from sketches import CountMinSketch, HyperLogLog, SpaceSaving, mix64
+
+"""
+    Source IP statistics, the top clients and the number of unique clients,
+    kept in fixed memory however many clients show up.
+"""
+
+
+class ClientStats:
+    """
+    Tracks the clients, (source IPs), over a few windows of time. Each
+    window has a count-min sketch for how many requests each client sent, a
+    HyperLogLog for how many different clients there were, and a short list
+    of candidates for the top clients. See ClientWindow.
+
+    The records of the current second are tallied exactly first, and handed
+    to the windows once the second is over, so a client sending a burst of
+    requests costs one sketch update a second rather than one a request,
+    and the second's clients go into the sketches in one batch.
+    That tally only ever holds one second's clients, and windows only cover
+    complete seconds anyway, so it's never needed for a read.
+
+    Like the TrafficAggregator that feeds it, it's not thread-safe, so
+    callers hold the records lock, or for the top and unique clients, which
+    merge a window's buckets, pass it in to be held just while the sketches
+    are copied.
+    """
+
+    def __init__(self, windows, width=2048, depth=4, precision=12,
+                 candidates=16):
+        """
+        @param windows: the window lengths to track, in seconds. Windows have
+        to be set up before the traffic arrives, since the sketches can't be
+        rebuilt from each other afterward.
+        @param width: counters per row of the count-min sketches
+        @param depth: rows of the count-min sketches
+        @param precision: the HyperLogLog precision
+        @param candidates: top client candidates kept per bucket
+        """
+        self.windows = {}
+        for n_secs in windows:
+            n_secs = int(n_secs)
+            self.windows[n_secs] = ClientWindow(n_secs, width, depth,
+                                                precision, candidates)
+        self.second = None
+        self.pending = Counter()
+
+    def add(self, t, src_ip):
+        """
+        Counts a request from a client. This is called once per record at
+        ingest.
+        @param t: the record's time
+        @param src_ip: the IPv4 source address, as an integer
+        @return: None
+        """
+        second = int(t)
+        if second != self.second:
+            self.flush()
+            self.second = second
+        self.pending[src_ip] += 1
+
+    def flush(self):
+        """
+        Hands the tallied second over to the windows
+        @return: None
+        """
+        if not self.pending:
+            return
+        src_ips = list(self.pending)
+        hashes = [mix64(src_ip) for src_ip in src_ips]
+        counts = list(self.pending.values())
+        for window in self.windows.values():
+            window.add(self.second, src_ips, hashes, counts)
+        self.pending.clear()
+
+    def window(self, n_secs, now):
+        """
+        @param n_secs: one of the window lengths being tracked
+        @param now: the current time
+        @return: the ClientWindow, brought up to date
+        """
+        window = self.windows.get(int(n_secs))
+        if window is None:
+            raise ValueError(f"Clients aren't being tracked over {n_secs}s")
+        if self.second is not None and self.second < int(now):
+            self.flush()
+        window.advance(now)
+        return window
+
+    def top_clients(self, n_secs, now, n=5, lock=None):
+        """
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @param n: the number of clients wanted
+        @param lock: the records lock, held only while the window's
+        candidates and sketches are copied, or None if the caller holds it
+        @return: a list of (src_ip, requests) tuples, most requests first,
+        over the window's complete seconds. The counts are count-min
+        estimates, never lower than the real count.
+        """
+        with lock if lock is not None else contextlib.nullcontext():
+            candidates, running, partial = \
+                self.window(n_secs, now).top_snapshot()
+        return rank_clients(candidates, running, partial, n)
+
+    def unique_clients(self, n_secs, now, lock=None):
+        """
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @param lock: the records lock, held only while the window's
+        HyperLogLogs are copied, or None if the caller holds it
+        @return: the estimated number of different clients over the window's
+        complete seconds
+        """
+        with lock if lock is not None else contextlib.nullcontext():
+            window = self.window(n_secs, now)
+            distinct = [bucket_distinct.copy() for _, bucket_distinct, _
+                        in window.complete_buckets()]
+        return count_unique(distinct, window.precision)
+
+
+def complete_estimate(running, partial, src_ip):
+    """
+    @param running: a window's running CountMinSketch
+    @param partial: its current bucket's CountMinSketch, or None
+    @param src_ip: a client
+    @return: the estimated number of requests from the client over the
+    window's complete buckets
+    """
+    h = mix64(src_ip)
+    if partial is None:
+        return running.estimate_hashed(h)
+    # the sketches are linear, so the partial bucket comes straight back
+    # out, counter by counter
+    running_table = running.table
+    partial_table = partial.table
+    return min(running_table[index] - partial_table[index]
+               for index in running.indexes(h))
+
+
+def rank_clients(candidates, running, partial, n):
+    """
+    @param candidates: the clients that might be among the busiest
+    @param running: a window's running CountMinSketch
+    @param partial: its current bucket's CountMinSketch, or None
+    @param n: the number of clients wanted, or None for all of them
+    @return: a list of (src_ip, requests), most requests first
+    """
+    estimates = [(src_ip, complete_estimate(running, partial, src_ip))
+                 for src_ip in candidates]
+    estimates.sort(key=lambda item: item[1], reverse=True)
+    return estimates[:n]
+
+
+def count_unique(distinct, precision):
+    """
+    @param distinct: the HyperLogLogs of a window's buckets
+    @param precision: their precision
+    @return: the estimated number of different clients over all of them
+    """
+    merged = HyperLogLog(precision)
+    for bucket_distinct in distinct:
+        merged.merge(bucket_distinct)
+    return merged.count()
+
+
+class ClientWindow:
+    """
+    The client sketches for one window length. The window is made of a ring
+    of buckets, each covering 'resolution' seconds, (1/60th of the window,
+    so memory doesn't grow with its length). Each bucket has its own
+    count-min sketch, HyperLogLog and a small SpaceSaving summary of its
+    busiest clients.
+
+    The window also keeps a running count-min sketch, the sum of its
+    buckets'. Count-min sketches can be subtracted, so a bucket sliding out
+    of the window is simply taken back out of it. HyperLogLogs can't, so the
+    unique client count merges the buckets' when it's read, as does the list
+    of top client candidates, whose counts then come from the running
+    sketch.
+
+    Like the TrafficAggregator, the window covers whole, complete buckets,
+    so its start moves in steps of 'resolution' seconds.
+    """
+
+    def __init__(self, n_secs, width, depth, precision, candidates):
+        """
+        @param n_secs: the window length, in seconds
+        @param width: counters per row of the count-min sketches
+        @param depth: rows of the count-min sketches
+        @param precision: the HyperLogLog precision
+        @param candidates: top client candidates kept per bucket
+        """
+        self.resolution = max(1, n_secs // 60)
+        self.span = max(1, n_secs // self.resolution)
+        self.width = width
+        self.depth = depth
+        self.precision = precision
+        self.candidates = candidates
+
+        # one spare bucket for the current, partial, one
+        self.size = self.span + 2
+        self.keys = [None] * self.size
+        self.buckets = [None] * self.size
+        self.running = CountMinSketch(width, depth)
+        # buckets from this key on are in the running sketch
+        self.low = None
+        # the current bucket's key, as of the last advance()
+        self.now_key = None
+
+    def add(self, second, src_ips, hashes, counts):
+        """
+        Counts a second's clients
+        @param second: the second the requests came in
+        @param src_ips: a list of the clients
+        @param hashes: a list of their mix64 hashes
+        @param counts: a list of their numbers of requests
+        @return: None
+        """
+        key = second // self.resolution
+        if self.low is None:
+            self.low = key
+        elif key < self.low:
+            # too old, it's already slid out of the window
+            return
+        index = key % self.size
+        if self.keys[index] != key:
+            if self.keys[index] is not None:
+                if self.keys[index] > key:
+                    return
+                self.advance_to(self.keys[index] + 1)
+            self.keys[index] = key
+            self.buckets[index] = (CountMinSketch(self.width, self.depth),
+                                   HyperLogLog(self.precision),
+                                   SpaceSaving(self.candidates))
+
+        sketch, distinct, busiest = self.buckets[index]
+        sketch.add_many(hashes, counts)
+        self.running.add_many(hashes, counts)
+        for h in hashes:
+            distinct.add_hashed(h)
+        for src_ip, count in zip(src_ips, counts):
+            busiest.add(src_ip, count)
+
+    def bucket(self, key):
+        """
+        @param key: a bucket's key, its second // resolution
+        @return: the bucket's (sketch, distinct, busiest), or None
+        """
+        index = key % self.size
+        if self.keys[index] != key:
+            return None
+        return self.buckets[index]
+
+    def advance_to(self, low):
+        """
+        Slides the window's start forward, taking the buckets that slid out
+        back out of the running sketch, and dropping them
+        @param low: the key of the window's new first bucket
+        @return: None
+        """
+        if self.low is None or low <= self.low:
+            return
+        if low - self.low > self.size:
+            self.running = CountMinSketch(self.width, self.depth)
+            self.keys = [None] * self.size
+            self.buckets = [None] * self.size
+        else:
+            for key in range(self.low, low):
+                bucket = self.bucket(key)
+                if bucket is not None:
+                    self.running.merge(bucket[0], sign=-1)
+                    index = key % self.size
+                    self.keys[index] = None
+                    self.buckets[index] = None
+        self.low = low
+
+    def advance(self, now):
+        """
+        Slides the window along to the current time
+        @param now: the current time
+        @return: None
+        """
+        self.now_key = int(now) // self.resolution
+        self.advance_to(self.now_key - self.span)
+
+    def complete_buckets(self):
+        """
+        @return: the buckets in the window, leaving out the current one
+        """
+        buckets = []
+        for key in range(self.now_key - self.span, self.now_key):
+            bucket = self.bucket(key)
+            if bucket is not None:
+                buckets.append(bucket)
+        return buckets
+
+    def partial_sketch(self):
+        """
+        Call advance() first.
+        @return: the current bucket's count-min sketch, or None
+        """
+        current = self.bucket(self.now_key)
+        return current[0] if current is not None else None
+
+    def estimate(self, src_ip):
+        """
+        Call advance() first.
+        @param src_ip: a client
+        @return: the estimated number of requests from the client over the
+        window's complete buckets
+        """
+        return complete_estimate(self.running, self.partial_sketch(), src_ip)
+
+    def top_snapshot(self):
+        """
+        Call advance() first. Copies what the top clients are worked out
+        from, which is quick next to working them out, so it's all that's
+        done with the records lock held.
+        @return: (candidates, running, partial) - a set of the clients that
+        might be among the busiest, and copies of the running count-min
+        sketch and the current bucket's, (or None), for rank_clients
+        """
+        candidates = set()
+        for _, _, busiest in self.complete_buckets():
+            candidates.update(busiest.counts)
+        partial = self.partial_sketch()
+        return (candidates, self.running.copy(),
+                partial.copy() if partial is not None else None)
+
@@ -0,0 +1,71 @@
+import time
+
+"""
+    Where the program gets the current time from. Usually that's the wall
+    clock, but when replaying a capture file it's the capture's own time, so
+    the windows, rates and alerts come out the way they would have live.
+"""
+
+
+class WallClock:
+    """
+    The real time, for live capture
+    """
+
+    def time(self):
+        """
+        @return: the current time, like time.time()
+        """
+        return time.time()
+
+
+class ReplayClock:
+    """
+    The time in a capture being replayed, following the timestamps of the
+    records as they're ingested.
+
+    When the replay is paced, (speed above 0), the clock also moves on by
+    itself once no records have come in for 'hold' seconds, at 'speed'
+    capture seconds per real second, so quiet parts of the capture, and the
+    time after it ends, pass the way they would have. Records arrive in
+    batches, so it waits that long first rather than running on ahead of
+    records that are just waiting in a batch. As fast as possible, it stays
+    on the newest record's time.
+    """
+
+    def __init__(self, speed=0, hold=1):
+        """
+        @param speed: capture seconds per real second, or 0 for as fast as
+        the records can be read
+        @param hold: in real seconds, how long the clock waits on the newest
+        record before moving on by itself
+        """
+        self.speed = speed
+        self.hold = hold
+        # the newest capture time ingested, and the real time it was
+        self.capture_time = None
+        self.wall_time = None
+
+    def advance(self, t):
+        """
+        Moves the clock up to a record's time. Records are ingested in time
+        order, but the clock never goes backward regardless.
+        @param t: the record's capture time
+        @return: None
+        """
+        if self.capture_time is not None:
+            # a paced clock may have already run on past it
+            t = max(t, self.time())
+        self.capture_time = t
+        self.wall_time = time.time()
+
+    def time(self):
+        """
+        @return: the current capture time, or 0 before the first record
+        """
+        if self.capture_time is None:
+            return 0.0
+        idle = time.time() - self.wall_time - self.hold
+        if not self.speed or idle <= 0:
+            return self.capture_time
+        return self.capture_time + idle * self.speed
@@ -0,0 +1,124 @@
+import threading
+
+"""
+    For running without a terminal, (--headless): the numbers the screen
+    would show, served over HTTP in the Prometheus text format for a
+    Prometheus server, (or curl), to scrape.
+
+    The numbers are worked out by a job in the main process, which takes the
+    records lock like the view's jobs do, and the text is kept ready. A
+    scrape only ever gets the last text that was made, so however often
+    it's scraped, it never waits on the lock or holds up the ingest.
+"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value):
+    """
+    @param value: a label's value
+    @return: the value with backslashes, quotes and newlines escaped
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class MetricsText:
+    """
+    Builds up the text of a scrape, a metric at a time
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, help_text, samples):
+        """
+        Adds a metric, with its HELP and TYPE lines
+        @param name: the metric's name
+        @param kind: 'gauge' or 'counter'
+        @param help_text: what it is
+        @param samples: a list of (labels, value), with labels a dict, (empty
+        for none). A metric with no samples still gets its HELP and TYPE.
+        @return: None
+        """
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            if labels:
+                label_text = ','.join(f'{key}="{escape_label(label)}"'
+                                      for key, label in labels.items())
+                self.lines.append(f'{name}{{{label_text}}} {value}')
+            else:
+                self.lines.append(f'{name} {value}')
+
+    def text(self):
+        """
+        @return: the scrape's text, as bytes
+        """
+        return ('\n'.join(self.lines) + '\n').encode()
+
+
+class MetricsExporter:
+    """
+    Serves the last published metrics text over HTTP, on /metrics, from a
+    thread of its own
+    """
+
+    def __init__(self):
+        # replaced whole by publish(), so a scrape always sees one complete
+        # snapshot without any locking
+        self.snapshot = b''
+        self.server = None
+
+    def publish(self, text):
+        """
+        @param text: the new metrics text, as bytes
+        @return: None
+        """
+        self.snapshot = text
+
+    def serve(self, address, port):
+        """
+        Starts the HTTP server in a daemon thread
+        @param address: the address to listen on, like '127.0.0.1'
+        @param port: the port, or 0 for any free one
+        @return: the (address, port) it's listening on
+        @raise OSError: if it can't listen there
+        """
+        # only --headless serves, so the rest don't load the HTTP server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = exporter.snapshot
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # a request line for every scrape is just noise
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self.server.server_address[:2]
+
+    def close(self):
+        """
+        Stops the HTTP server, if it was started
+        @return: None
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,329 @@
+import errno
+import ipaddress
+import itertools
+import multiprocessing
+import queue
+import random
+import socket
+import time
+from struct import Struct, pack
+
+"""
+    Writes made up HTTP request packets straight to the loopback address,
+    without a server or any connections, to push the sniffers much harder
+    than a real client and server pair can. It needs root.
+
+    Every packet is a TCP segment carrying one request, from one of a number
+    of flows, (source ip and port), with each flow's sequence numbers
+    following on, so the reassembler sees ordinary in-order streams. A packet
+    is built once for each section, then for every packet only the fields
+    that change are patched in place: the IP id, the source ip, the source
+    port and the sequence number, with both checksums worked out from sums
+    taken once when the packet was built.
+
+    There's no connection behind the packets, so the kernel answers each
+    one with a reset, which the sniffers ignore, (they only look at traffic
+    to the port).
+
+    The packets go out through a raw IP socket, rather than as frames
+    written to the interface with a packet socket: a frame written to the
+    loopback comes back in needing a route, and the kernel drops anything
+    arriving with a loopback source as a martian, so only the packet
+    sniffers would see it.
+"""
+
+# where the TCP header starts, after the IP header
+TCP_OFFSET = 20
+
+# the fields patched for each packet
+IP_ID = Struct('!H')
+IP_CHECKSUM_SOURCE = Struct('!H4s')
+TCP_PORTS_SEQUENCE = Struct('!HHI')
+TCP_CHECKSUM = Struct('!H')
+
+# TCP flags, PSH and ACK like a client's request segment
+TCP_PSH_ACK = 0x18
+
+# how often, in seconds, the sender checks the time and sends what's due
+TICK = 0.001
+
+# the most packets sent before looking at the time again, so a sender
+# that's fallen behind stays behind, rather than sending in a rush what
+# was due earlier and running on past the end
+BATCH = 1000
+
+# how many (section, flow) picks are made up front, and then cycled through
+PICKS = 1 << 16
+
+
+def ones_complement_sum(data):
+    """
+    @param data: bytes
+    @return: the 16 bit words of data added up, not yet folded, (an odd
+    last byte counts as the high half of a word)
+    """
+    if len(data) % 2:
+        data += b'\0'
+    return sum(word for word, in Struct('!H').iter_unpack(data))
+
+
+def fold(total):
+    """
+    @param total: a sum of 16 bit words
+    @return: the internet checksum of them
+    """
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class FrameTemplate:
+    """
+    An IP packet carrying a request for one section, ready to have each
+    packet's changing fields filled in
+    """
+
+    def __init__(self, payload, dest_ip, dest_port):
+        """
+        @param payload: the HTTP request
+        @param dest_ip: the destination ip, as 4 bytes
+        @param dest_port: the destination port
+        """
+        self.dest_port = dest_port
+        ip_header = pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0,
+                         0x4000, 64, socket.IPPROTO_TCP, 0, bytes(4),
+                         dest_ip)
+        tcp_header = pack('!HHLLBBHHH', 0, dest_port, 0, 1, 5 << 4,
+                          TCP_PSH_ACK, 65535, 0, 0)
+        self.packet = bytearray(ip_header + tcp_header + payload)
+        self.payload_length = len(payload)
+        # the checksums' sums with the changing fields left as zeros, which
+        # are added in for each packet
+        self.ip_sum = ones_complement_sum(ip_header)
+        pseudo_header = pack('!4sBBH', dest_ip, 0, socket.IPPROTO_TCP,
+                             20 + len(payload))
+        self.tcp_sum = ones_complement_sum(pseudo_header + tcp_header +
+                                           payload)
+
+    def fill(self, ident, source, source_port, sequence):
+        """
+        Patches one packet's fields in
+        @param ident: the IP id
+        @param source: the source ip, as an integer
+        @param source_port: the source port
+        @param sequence: the TCP sequence number
+        @return: the packet, a bytearray that's changed again by the next
+        fill()
+        """
+        packet = self.packet
+        source_words = (source >> 16) + (source & 0xffff)
+        IP_ID.pack_into(packet, 4, ident)
+        IP_CHECKSUM_SOURCE.pack_into(
+            packet, 10, fold(self.ip_sum + ident + source_words),
+            source.to_bytes(4, 'big'))
+        TCP_PORTS_SEQUENCE.pack_into(packet, TCP_OFFSET, source_port,
+                                     self.dest_port, sequence)
+        TCP_CHECKSUM.pack_into(packet, TCP_OFFSET + 16, fold(
+            self.tcp_sum + source_words + source_port + (sequence >> 16) +
+            (sequence & 0xffff)))
+        return packet
+
+
+def make_templates(profile, dest_ip, dest_port):
+    """
+    @param profile: a traffic_generator.LoadProfile, for its sections
+    @param dest_ip: the destination ip
+    @param dest_port: the destination port
+    @return: a FrameTemplate for each of the profile's sections
+    """
+    dest = socket.inet_aton(dest_ip)
+    return [FrameTemplate(f'GET /{section}/index.html HTTP/1.1\r\n'
+                          f'Host: {dest_ip}:{dest_port}\r\n'
+                          f'User-Agent: traffic_generator\r\n\r\n'.encode(),
+                          dest, dest_port)
+            for section in profile.sections]
+
+
+def make_flows(profile, flow_count, first_port, rng):
+    """
+    @param profile: a traffic_generator.LoadProfile, for its clients
+    @param flow_count: the number of flows
+    @param first_port: the first source port, each flow gets its own
+    @param rng: a random.Random
+    @return: a list of [source ip as an integer, source port, next sequence
+    number] for each flow, the clients picked with the profile's weights
+    """
+    clients = [int(ipaddress.IPv4Address(client or '127.0.0.1'))
+               for client in profile.clients]
+    picked = rng.choices(clients, cum_weights=profile.client_weights,
+                         k=flow_count)
+    return [[client, first_port + i, rng.getrandbits(32)]
+            for i, client in enumerate(picked)]
+
+
+def inject(profile, dest_ip, dest_port, share, flow_count,
+           first_port, seed, report):
+    """
+    Sends one process's share of a profile's packets
+    @param profile: a traffic_generator.LoadProfile, for the rates, the
+    sections and the clients
+    @param dest_ip: the destination ip
+    @param dest_port: the destination port
+    @param share: the fraction of the profile's rate this process sends
+    @param flow_count: how many flows to spread the packets over
+    @param first_port: the first of this process's source ports
+    @param seed: for the random number generator
+    @param report: called with (second, target, sent) as each second of the
+    run is over
+    @return: None
+    """
+    rng = random.Random(seed)
+    templates = make_templates(profile, dest_ip, dest_port)
+    flows = make_flows(profile, flow_count, first_port, rng)
+    # the random picks are made up front, a random choice per packet would
+    # cost more than building it
+    sections = rng.choices(templates, cum_weights=profile.section_weights,
+                           k=PICKS)
+    picks = itertools.cycle(zip(sections,
+                                (rng.choice(flows) for _ in range(PICKS))))
+    ident = itertools.cycle(range(1 << 16))
+
+    # IPPROTO_RAW sends the headers as they are, (apart from the checksum,
+    # which the kernel works out again anyway)
+    s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+    send = s.sendto
+    address = (dest_ip, 0)
+
+    start = time.perf_counter()
+    last = 0.0
+    expected = 0.0
+    sent = 0
+    second = 0
+    target = 0.0
+    second_sent = 0
+    while True:
+        now = min(time.perf_counter() - start, profile.duration)
+        due = profile.requests_between(last, now) * share
+        if now >= second + 1 and second + 1 < profile.duration:
+            # a tick running past the end of a second shares its target
+            before = profile.requests_between(last, second + 1) * share
+            report(second, target + before, second_sent)
+            second += 1
+            target = due - before
+            second_sent = 0
+        else:
+            target += due
+        expected += due
+        last = now
+
+        behind = int(expected + 1e-6) - sent
+        count = min(behind, BATCH)
+        for template, flow in itertools.islice(picks, count):
+            source, source_port, sequence = flow
+            try:
+                send(template.fill(next(ident), source, source_port,
+                                   sequence), address)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # the loopback's queue is full, the packet is lost
+                continue
+            flow[2] = (sequence + template.payload_length) & 0xffffffff
+            second_sent += 1
+        sent += count
+
+        if now >= profile.duration:
+            # what's still due when the time's up is never sent
+            break
+        # flat out, the loop only sleeps when it's caught up
+        if behind < 2:
+            time.sleep(TICK)
+    if target or second_sent:
+        report(second, target, second_sent)
+    s.close()
+
+
+def run_injector(profile, dest_ip, dest_port, share, flow_count,
+                 first_port, seed, results):
+    """
+    An injector process
+    @param results: a multiprocessing.Queue, for ('second', second, target,
+    sent) as each second is over, then ('done',)
+    @return: None
+    """
+    try:
+        inject(profile, dest_ip, dest_port, share, flow_count,
+               first_port, seed,
+               lambda second, target, sent:
+               results.put(('second', second, target, sent)))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        results.put(('error', str(e)))
+    finally:
+        results.put(('done',))
+
+
+def run(profile, dest_ip, dest_port, processes, flow_count, quiet):
+    """
+    Runs a profile as raw packets, split evenly over a number of processes,
+    printing each second's numbers
+    @return: the summary, a dict of the 'target', the packets 'sent' and
+    how far 'short' of the target that was
+    """
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(
+        target=run_injector,
+        args=(profile, dest_ip, dest_port, 1 / processes,
+              flow_count, 10000 + i * flow_count, i, results),
+        daemon=True) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    seconds = {}
+    reports = {}
+    total_target = 0.0
+    total_sent = 0
+    done = 0
+    error = None
+    try:
+        while done < processes:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            if message[0] == 'done':
+                done += 1
+                continue
+            if message[0] == 'error':
+                error = message[1]
+                continue
+            _, second, target, sent = message
+            totals = seconds.setdefault(second, [0.0, 0])
+            totals[0] += target
+            totals[1] += sent
+            total_target += target
+            total_sent += sent
+            reports[second] = reports.get(second, 0) + 1
+            if reports[second] == processes and not quiet:
+                print_second(second, *seconds.pop(second))
+    except KeyboardInterrupt:
+        pass
+    for worker in workers:
+        worker.join(timeout=1)
+    if error:
+        raise OSError(error)
+    if not quiet:
+        for second in sorted(seconds):
+            print_second(second, *seconds[second])
+    return {'target': round(total_target), 'sent': total_sent,
+            'short': max(1 - total_sent / total_target, 0)
+            if total_target else 0}
+
+
+def print_second(second, target, sent):
+    short = max(1 - sent / target, 0) if target else 0
+    print(f'{second:>5}s  target {target:>10.0f}  sent {sent:>10}  '
+          f'short {short:>6.1%}', flush=True)
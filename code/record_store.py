@@ -0,0 +1,376 @@
+import contextlib
+import socket
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+
+"""
+    The columnar store for the traffic records.
+"""
+
+# In seconds of record time, how long a section id stays unused after the
+# last record with it expires, before it's handed out for another name. A
+# window being read a chunk at a time, (see RecordWindow), can still hold
+# the id after its records expire, and looks its name up afterwards.
+RECYCLE_DELAY = 10
+
+
+class RecordStore:
+    """
+    Holds the traffic records as three parallel columns instead of a deque of
+    dicts: float64 timestamps, uint32 IPv4 source addresses and integer
+    section ids, where each distinct section name is stored once and
+    interned to an id. That's 16 bytes a record instead of a few hundred for
+    a dict and its strings, which matters at thousands of requests a second
+    over a 10 minute retention period.
+
+    The columns are circular buffers. New records go in at the end and old
+    ones are expired from the front, both without moving anything, and the
+    buffers double in size when they fill up. Records have to be appended in
+    time order, (the ReorderBuffer takes care of that when there are several
+    sniffers), which is what lets the time lookups be binary searches.
+
+    A section's id, and its name, are only kept while there are records
+    with it in the store, (and for RECYCLE_DELAY seconds after), and the
+    TrafficAggregator counts the sections by name. So a scanner making up
+    millions of paths doesn't leave millions of names behind once its
+    records expire, and the ids stay small enough to count with an array.
+
+    Positions in the store, (lo and hi below), are logical: 0 is the oldest
+    record still held. Like the deque it replaces, it's not thread-safe, so
+    callers hold the records lock. Every record also has an absolute
+    sequence number, its logical position plus the number of records ever
+    expired, which stays put as old records are expired. RecordWindows use
+    those, so they can be read a piece at a time without holding the lock
+    for the whole window.
+
+    The old dict interface, (append(), iteration and indexing yielding
+    {'time', 'src_ip', 'path'} dicts), is still there for compatibility, but
+    building those dicts is exactly the cost this class exists to avoid.
+    """
+
+    def __init__(self, capacity=1024, aggregator=None):
+        """
+        @param capacity: the initial number of records the columns hold,
+        rounded up to a power of two
+        @param aggregator: an optional TrafficAggregator, which gets every
+        record counted into it as it's appended, and its buckets retired as
+        records are expired
+        """
+        self.aggregator = aggregator
+        self.capacity = 1 << max(capacity - 1, 1).bit_length()
+        self.times = array('d', [0.0]) * self.capacity
+        self.src_ips = array('I', [0]) * self.capacity
+        self.sections = array('I', [0]) * self.capacity
+        # the physical position of the oldest record, and the record count
+        self.start = 0
+        self.count = 0
+        self.newest = 0
+        # the number of records expired so far, the sequence number of the
+        # oldest record still held
+        self.expired_total = 0
+
+        # the name of each section id, None for the ids not in use, and the
+        # number of records held with each
+        self.section_names = []
+        self.section_ids = {}
+        self.section_refs = []
+        # (record time it was freed, id) of the unused ids, oldest first
+        self.free_ids = deque()
+
+    def __len__(self):
+        return self.count
+
+    def intern_section(self, name):
+        """
+        @param name: a section name, like '/foo'
+        @return: the name's section id
+        """
+        section_id = self.section_ids.get(name)
+        if section_id is None:
+            free_ids = self.free_ids
+            if free_ids and free_ids[0][0] <= self.newest - RECYCLE_DELAY:
+                section_id = free_ids.popleft()[1]
+                self.section_names[section_id] = name
+            else:
+                section_id = len(self.section_names)
+                self.section_names.append(name)
+                self.section_refs.append(0)
+            self.section_ids[name] = section_id
+        return section_id
+
+    def release_sections(self, section_ids):
+        """
+        Counts records out of their sections, freeing the ids that no
+        record's using any more
+        @param section_ids: the section ids of the records going
+        @return: None
+        """
+        section_refs = self.section_refs
+        for section_id, count in Counter(section_ids).items():
+            section_refs[section_id] -= count
+            if not section_refs[section_id]:
+                del self.section_ids[self.section_names[section_id]]
+                self.section_names[section_id] = None
+                self.free_ids.append((self.newest, section_id))
+
+    def append_batch(self, rows):
+        """
+        Adds records to the end of the store.
+
+        @param rows: an iterable of (time, src_ip, section name) tuples, with
+        src_ip the IPv4 address as an integer. They should be in time order.
+        A record older than the newest one already stored is stamped with
+        the newest time instead, so the timestamps never run backward.
+        @return: None
+        """
+        rows = list(rows)
+        if self.count + len(rows) > self.capacity:
+            self.grow(self.count + len(rows))
+
+        intern_section = self.intern_section
+        section_refs = self.section_refs
+        aggregate = self.aggregator.add if self.aggregator else None
+        mask = self.capacity - 1
+        position = self.start + self.count
+        newest = self.newest
+        for t, src_ip, section in rows:
+            if t < newest:
+                t = newest
+            newest = t
+            section_id = intern_section(section)
+            section_refs[section_id] += 1
+            slot = position & mask
+            self.times[slot] = t
+            self.src_ips[slot] = src_ip
+            self.sections[slot] = section_id
+            if aggregate:
+                aggregate(t, section, src_ip)
+            position += 1
+        self.count += len(rows)
+        self.newest = newest
+
+    def append(self, record):
+        """
+        Compatibility with the deque of dicts
+        @param record: a dict with the 'time', 'src_ip' and 'path'
+        @return: None
+        """
+        self.append_batch([(record['time'], ip_to_int(record['src_ip']),
+                            record['path'])])
+
+    def grow(self, needed):
+        """
+        Doubles the columns until they can hold 'needed' records, unwrapping
+        them so the oldest record is at the front again.
+        @param needed: the number of records to make room for
+        @return: None
+        """
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        for name in ('times', 'src_ips', 'sections'):
+            column = getattr(self, name)
+            unwrapped = self.column_slice(column, 0, self.count)
+            unwrapped.extend(array(column.typecode, [0]) *
+                             (capacity - self.count))
+            setattr(self, name, unwrapped)
+        self.capacity = capacity
+        self.start = 0
+
+    def column_slice(self, column, lo, hi):
+        """
+        Copies part of a column out in logical order
+        @param column: one of the column arrays
+        @param lo: the first logical position
+        @param hi: one past the last logical position
+        @return: an array of the values
+        """
+        if hi <= lo:
+            return array(column.typecode)
+        first = (self.start + lo) & (self.capacity - 1)
+        last = first + (hi - lo)
+        if last <= self.capacity:
+            return column[first:last]
+        return column[first:] + column[:last - self.capacity]
+
+    def search(self, t, bisect):
+        """
+        Binary searches the timestamps, minding the wrap around.
+        @param t: the time to look for
+        @param bisect: bisect_left or bisect_right
+        @return: the logical position bisect would give for a plain list
+        """
+        if self.count == 0:
+            return 0
+        front_length = min(self.count, self.capacity - self.start)
+        back_length = self.count - front_length
+        # The records that wrapped around to the front of the columns are the
+        # newest ones. Search them if t is past the ones at the back.
+        if back_length and \
+                bisect([self.times[self.capacity - 1]], t) > 0:
+            return front_length + bisect(self.times, t, 0, back_length)
+        return bisect(self.times, t, self.start,
+                      self.start + front_length) - self.start
+
+    def index_after(self, t):
+        """
+        @param t: a time
+        @return: the logical position of the first record newer than t
+        """
+        return self.search(t, bisect_right)
+
+    def expire_before(self, t):
+        """
+        Drops the records older than t from the front of the store
+        @param t: a time
+        @return: the number of records dropped
+        """
+        expired = self.search(t, bisect_left)
+        self.release_sections(self.column_slice(self.sections, 0, expired))
+        self.start = (self.start + expired) & (self.capacity - 1)
+        self.count -= expired
+        self.expired_total += expired
+        if self.aggregator:
+            self.aggregator.expire_before(t)
+        return expired
+
+    def window(self, since, lock=None):
+        """
+        Finds the records newer than 'since' with a binary search, without
+        copying any of them. Call this with the records lock held.
+
+        @param since: a time
+        @param lock: the records lock, which the window takes while it reads
+        each piece of the records, or None if nothing else touches the store
+        @return: a RecordWindow of the records from 'since' to the newest
+        """
+        first = self.expired_total + self.index_after(since)
+        return RecordWindow(self, first, self.expired_total + self.count, lock)
+
+    def section_ids_between(self, lo, hi):
+        """
+        @param lo: the first logical position
+        @param hi: one past the last logical position
+        @return: an array of the section ids of those records
+        """
+        return self.column_slice(self.sections, lo, hi)
+
+    def records(self, lo, hi):
+        """
+        Compatibility with the deque of dicts - builds the dicts for part of
+        the store
+        @param lo: the first logical position
+        @param hi: one past the last logical position
+        @return: a list of {'time', 'src_ip', 'path'} dicts, oldest first
+        """
+        section_names = self.section_names
+        return [{'time': t, 'src_ip': int_to_ip(src_ip),
+                 'path': section_names[section]}
+                for t, src_ip, section in
+                zip(self.column_slice(self.times, lo, hi),
+                    self.column_slice(self.src_ips, lo, hi),
+                    self.column_slice(self.sections, lo, hi))]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('record index out of range')
+        return self.records(index, index + 1)[0]
+
+    def __iter__(self):
+        return iter(self.records(0, self.count))
+
+    def __reversed__(self):
+        return reversed(self.records(0, self.count))
+
+
+class RecordWindow:
+    """
+    A stretch of a RecordStore's records, by sequence number. It's made in
+    O(log n) with the records lock held, and only the record count is
+    known up front. The records themselves are copied out a chunk at a time,
+    taking the lock for each chunk, so however big the window is, the ingest
+    loop is never locked out for longer than one chunk takes.
+
+    The window is a snapshot of the records when it was made. Records
+    appended after that aren't in it, and any expired in the meantime are
+    simply skipped when reading.
+    """
+
+    # the most records copied out per lock acquisition
+    chunk_size = 16384
+
+    def __init__(self, store, first, end, lock=None):
+        """
+        @param store: the RecordStore
+        @param first: the sequence number of the window's oldest record
+        @param end: one past the sequence number of its newest record
+        @param lock: the records lock, or None
+        """
+        self.store = store
+        self.first = first
+        self.end = end
+        self.lock = lock if lock is not None else contextlib.nullcontext()
+
+    def __len__(self):
+        return self.end - self.first
+
+    def column(self, name):
+        """
+        Copies one column of the window out, a chunk at a time
+        @param name: 'times', 'src_ips' or 'sections'
+        @return: an array of the column's values, oldest first
+        """
+        store = self.store
+        values = array(getattr(store, name).typecode)
+        position = self.first
+        while position < self.end:
+            chunk_end = min(position + self.chunk_size, self.end)
+            with self.lock:
+                lo = max(position - store.expired_total, 0)
+                hi = chunk_end - store.expired_total
+                if hi > 0:
+                    values.extend(store.column_slice(getattr(store, name),
+                                                     lo, hi))
+            position = chunk_end
+        return values
+
+    def section_ids(self):
+        """
+        @return: an array of the window's section ids, oldest first
+        """
+        return self.column('sections')
+
+    def records(self):
+        """
+        Compatibility with the deque of dicts
+        @return: a list of {'time', 'src_ip', 'path'} dicts, oldest first
+        """
+        section_names = self.store.section_names
+        return [{'time': t, 'src_ip': int_to_ip(src_ip),
+                 'path': section_names[section]}
+                for t, src_ip, section in zip(self.column('times'),
+                                              self.column('src_ips'),
+                                              self.column('sections'))]
+
+    def __iter__(self):
+        # newest first, matching get_last_n_seconds_records
+        return reversed(self.records())
+
+
+def ip_to_int(ip):
+    """
+    @param ip: a dotted quad IPv4 address
+    @return: the address as an integer
+    """
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+def int_to_ip(ip):
+    """
+    @param ip: an IPv4 address as an integer
+    @return: the dotted quad address
+    """
+    return socket.inet_ntoa(ip.to_bytes(4, 'big'))
@@ -0,0 +1,191 @@
+import contextlib
+import math
+
+from sketches import SpaceSaving
+
+"""
+    Coarser buckets of the traffic, for windows far longer than the raw
+    records are kept, (an hour, a day...), in memory that doesn't grow.
+
+    The TrafficAggregator's per-second buckets are the first tier. As each
+    second is done with, its counts are rolled into the minute it's in, and
+    as each minute is done with, it's rolled into its hour. Every tier keeps
+    its buckets in a ring covering its retention, and each bucket counts the
+    sections in a SpaceSaving summary, with room for the tier's budget of
+    section counters shared out between its buckets. So a tier's memory is
+    fixed up front, however much traffic there is, and its section counts
+    are approximate, with an error bound.
+
+    A window is read from the coarsest tier that keeps all of it and still
+    has at least MIN_BUCKETS buckets in it, (so the hour tier is used for a
+    day, and the minute tier for an hour), which merges the fewest buckets.
+    A window is made of whole buckets, the last being the one in progress,
+    so it can be up to a bucket short of the length asked for, (and a tier
+    only has what's rolled into it: the minute tier is a couple of seconds
+    behind the records, and the hour tier a minute).
+"""
+
+# the fewest buckets a window is read from, so it's no more than about a
+# tenth out, (a window of fewer would be read from a finer tier)
+MIN_BUCKETS = 10
+
+
+def fold_sections(summary, sections):
+    """
+    Adds a bucket's section counts into a summary
+    @param summary: a SpaceSaving summary
+    @param sections: a SpaceSaving summary, or a dict of section name to
+    count
+    @return: None
+    """
+    if isinstance(sections, SpaceSaving):
+        summary.merge(sections)
+        return
+    # the biggest go in first, so they're sure of a counter of their own
+    for section, hits in sorted(sections.items(),
+                                   key=lambda item: item[1], reverse=True):
+        summary.add(section, hits)
+
+
+class RollupTier:
+    """
+    The buckets of one resolution
+    """
+
+    def __init__(self, resolution, retention, budget):
+        """
+        @param resolution: in seconds, the length of a bucket
+        @param retention: in seconds, how far back buckets are kept. No
+        window read from this tier can be longer.
+        @param budget: the most section counters the tier keeps, over all
+        its buckets
+        """
+        self.resolution = resolution
+        self.retention = retention
+        # a spare bucket so the one in progress never lands on top of the
+        # oldest one still in use
+        self.size = int(math.ceil(retention / resolution)) + 1
+        self.top_k = max(1, budget // self.size)
+        self.starts = [None] * self.size
+        self.totals = [0] * self.size
+        self.sections = [None] * self.size
+        # the next, coarser, tier, which this one's buckets roll into
+        self.next = None
+        # the newest bucket's start. All the older ones have rolled on.
+        self.latest = None
+
+    def bucket_index(self, start):
+        """
+        @param start: a bucket's start
+        @return: the index of that bucket, if it's still held, or None
+        """
+        index = start // self.resolution % self.size
+        if self.starts[index] != start:
+            return None
+        return index
+
+    def add(self, start, total, sections):
+        """
+        Counts in the requests from a finer tier's bucket
+        @param start: that bucket's start, in seconds
+        @param total: its request count
+        @param sections: its section counts, a SpaceSaving summary or a dict
+        of section name to count
+        @return: None
+        """
+        bucket = start - start % self.resolution
+        if self.latest is None or bucket > self.latest:
+            # the newest bucket's done with, so it goes on to the next tier
+            index = None if self.latest is None else \
+                self.bucket_index(self.latest)
+            if self.next is not None and index is not None:
+                self.next.add(self.latest, self.totals[index],
+                              self.sections[index])
+            self.latest = bucket
+        elif bucket < self.latest and self.next is not None:
+            # late, for a bucket that's rolled on already, so it's passed
+            # straight on too
+            self.next.add(start, total, sections)
+
+        index = bucket // self.resolution % self.size
+        held = self.starts[index]
+        if held != bucket:
+            if held is not None and held > bucket:
+                # older than anything we keep
+                return
+            self.starts[index] = bucket
+            self.totals[index] = 0
+            self.sections[index] = SpaceSaving(self.top_k)
+        self.totals[index] += total
+        fold_sections(self.sections[index], sections)
+
+    def read(self, n_secs, now, lock=None):
+        """
+        Merges the buckets for a window
+        @param n_secs: the window length, in seconds
+        @param now: the current time
+        @param lock: the records lock, held only while the buckets are
+        copied, or None if the caller holds it
+        @return: (total, summary, seconds) - the request count, a SpaceSaving
+        summary of the sections, and how many seconds the buckets read
+        actually cover
+        """
+        current = int(now) - int(now) % self.resolution
+        n_buckets = max(1, int(math.ceil(n_secs / self.resolution)))
+        total = 0
+        buckets = []
+        with lock if lock is not None else contextlib.nullcontext():
+            for number in range(n_buckets):
+                index = self.bucket_index(current - number * self.resolution)
+                if index is not None:
+                    total += self.totals[index]
+                    buckets.append(self.sections[index].copy())
+        summary = SpaceSaving(self.top_k)
+        for sections in buckets:
+            summary.merge(sections)
+        seconds = (n_buckets - 1) * self.resolution + now - current
+        return total, summary, max(seconds, 1)
+
+
+class Rollups:
+    """
+    The tiers above the per-second buckets, finest first
+    """
+
+    def __init__(self, tiers):
+        """
+        @param tiers: RollupTiers, finest first. Each rolls into the next.
+        """
+        self.tiers = tiers
+        for finer, coarser in zip(tiers, tiers[1:]):
+            finer.next = coarser
+
+    def add(self, second, total, sections):
+        """
+        Rolls in a second's counts
+        @param second: the second
+        @param total: its request count
+        @param sections: its section counts, a SpaceSaving summary or a dict
+        of section name to count
+        @return: None
+        """
+        self.tiers[0].add(second, total, sections)
+
+    def retention(self):
+        """
+        @return: in seconds, the longest window any tier can be read for
+        """
+        return max(tier.retention for tier in self.tiers)
+
+    def tier_for(self, n_secs):
+        """
+        @param n_secs: a window length, in seconds
+        @return: the coarsest tier that keeps the whole window, with at
+        least MIN_BUCKETS buckets in it, or None if there's none
+        """
+        for tier in reversed(self.tiers):
+            if tier.retention >= n_secs and \
+                    n_secs >= MIN_BUCKETS * tier.resolution:
+                return tier
+        return None
+
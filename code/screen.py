@@ -0,0 +1,92 @@
+"""
+    A copy of what's on the terminal, kept in memory, so the view can be
+    drawn a frame at a time. The view's updates write into the copy, and
+    each frame only sends the terminal the cells that changed since the
+    last one, all in one write. That keeps a slow terminal, (like one over
+    SSH), from falling behind, where clearing and rewriting whole fields on
+    every update, each flushed on its own, would.
+"""
+
+# changed cells closer together than this are sent as one run, unchanged
+# cells and all, since moving the cursor costs about as much
+GAP = 6
+
+
+class Screen:
+    """
+    The cells of the terminal, each a character and the name of its style,
+    (a blessed formatting, like 'underline'), or None for plain
+    """
+
+    def __init__(self, term):
+        """
+        @param term: a blessed Terminal, for its size, cursor moves and
+        styles. The screen is taken to start out blank, (term.fullscreen()
+        clears it).
+        """
+        self.term = term
+        self.width = term.width
+        self.height = term.height
+        blank = [(' ', None)] * self.width
+        # what the view wants on the terminal, and what's been sent so far
+        self.cells = [list(blank) for _ in range(self.height)]
+        self.shown = [list(blank) for _ in range(self.height)]
+        # the rows written to since the last frame
+        self.dirty = set()
+
+    def write(self, x, y, text, width=None, style=None):
+        """
+        Puts text on the screen, (it shows with the next frame). Anything
+        past the right hand edge is cut off.
+        @param x: the column
+        @param y: the row, negative rows count up from the bottom
+        @param text: the text
+        @param width: if given, the text is padded with spaces to this many
+        columns, clearing whatever was there before
+        @param style: the name of a blessed formatting, or None
+        @return: None
+        """
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height or x >= self.width:
+            return
+        if width:
+            text = text.ljust(width)
+        row = self.cells[y]
+        for column, char in enumerate(text[:self.width - x], x):
+            row[column] = (char, style)
+        self.dirty.add(y)
+
+    def render(self):
+        """
+        Works out the next frame, and takes it as shown
+        @return: the text to send the terminal, cursor moves included, which
+        is empty when nothing changed
+        """
+        term = self.term
+        out = []
+        for y in sorted(self.dirty):
+            wanted = self.cells[y]
+            shown = self.shown[y]
+            x = 0
+            while x < self.width:
+                if wanted[x] == shown[x]:
+                    x += 1
+                    continue
+                start = x
+                style = wanted[x][1]
+                end = x + 1
+                # carry the run on to the next change within GAP, as long
+                # as everything on the way is in the same style
+                while x < self.width and wanted[x][1] == style and \
+                        x - end < GAP:
+                    if wanted[x] != shown[x]:
+                        end = x + 1
+                    x += 1
+                x = end
+                text = ''.join(char for char, _ in wanted[start:end])
+                out.append(term.move_xy(start, y))
+                out.append(getattr(term, style)(text) if style else text)
+            self.shown[y] = list(wanted)
+        self.dirty.clear()
+        return ''.join(out)
@@ -0,0 +1,83 @@
+from collections import Counter
+
+"""
+    Counting how many hits each section got, for the 'most popular sections'
+    list. This used to be a pandas groupby, but building a DataFrame just to
+    count some strings cost more than anything else the process did, so it's
+    plain python now, with numpy used when it happens to be installed.
+"""
+
+# Below this many records, Counter beats setting up the numpy arrays
+NUMPY_THRESHOLD = 2048
+
+# numpy is only imported the first time there are enough ids to use it, as
+# loading it takes longer than the rest of the start up. Until then this is
+# NOT_LOADED, and after, the module, or None if it isn't installed.
+NOT_LOADED = object()
+numpy = NOT_LOADED
+
+
+def load_numpy():
+    """
+    @return: the numpy module, imported the first time, or None if it isn't
+    installed
+    """
+    global numpy
+    if numpy is NOT_LOADED:
+        try:
+            import numpy as loaded
+        except ImportError:
+            loaded = None
+        numpy = loaded
+    return numpy
+
+
+def count_section_ids(section_ids):
+    """
+    Counts interned section ids, the way the RecordStore keeps them.
+
+    @param section_ids: an array('I'), (or any sequence), of section ids
+    @return: a list of (section_id, hits) tuples, most hits first. Sections
+    with the same number of hits are in section id order.
+    """
+    if len(section_ids) >= NUMPY_THRESHOLD and load_numpy() is not None:
+        # The ids are small integers, so bincount counts them all in a single
+        # pass in C, and an array('I') is handed over without copying it.
+        counts = numpy.bincount(numpy.asarray(section_ids))
+        seen = numpy.flatnonzero(counts)
+        order = numpy.argsort(-counts[seen], kind='stable')
+        return [(int(section_id), int(hits)) for section_id, hits in
+                zip(seen[order], counts[seen][order])]
+
+    counts = Counter(section_ids)
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def count_paths(records):
+    """
+    Counts the sections of request record dicts, for the old deque of dicts.
+
+    @param records: an iterable of dicts with a 'path'
+    @return: a list of (section name, hits) tuples, most hits first. Sections
+    with the same number of hits are in the order they were first seen.
+    """
+    return Counter(record['path'] for record in records).most_common()
+
+
+def popularity_messages(counts):
+    """
+    @param counts: a list of (section name, hits) tuples, most hits first.
+    Approximate counts are (section name, hits, error) tuples instead, with
+    error the most the hits could be over by.
+    @return: the lines for the 'most popular sections' list
+    """
+    popular_list = []
+    for section, hits, *error in counts:
+        message = f'{section}: {hits} '
+        message += "hits" if hits > 1 else "hit"
+        if error and error[0]:
+            message += f' ±{error[0]}'
+        popular_list.append(message)
+    if not popular_list:
+        popular_list.append("No activity")
+    return popular_list
@@ -0,0 +1,429 @@
+import mmap
+import os
+import queue
+import threading
+from collections import Counter
+from struct import Struct
+
+from sketches import SpaceSaving
+
+"""
+    A history of every request kept on disk, for looking back further than
+    the 10 minutes the RecordStore holds, and across restarts.
+
+    The history is a directory of segment files, each holding the requests
+    for one span of time, (an hour by default), as fixed width binary
+    records: the time, the source ip and the section's id. The section ids
+    are looked up in 'sections.txt', one name a line, which only ever grows,
+    so the ids stay the same across segments and restarts.
+
+    A segment starts with a small header, then a time index with an entry
+    for every second of its span: the number of records before that second.
+    So how many requests came in any second, or minute, or hour, is read
+    straight from the index, and the records for a stretch of time are found
+    without searching. Segment files are made at their full size up front,
+    (they're sparse, so only what's written takes up disk), and read and
+    written through mmap.
+
+    Ingest only ever hands the records over to a queue. A thread of the
+    SegmentLog's own writes them out, so a slow disk never holds up the
+    capture, (if the queue fills up, the records that don't fit are dropped
+    from the history and counted). The queries read the segments through
+    mmap a chunk at a time, so hours of history never have to fit in memory.
+"""
+
+MAGIC = b'TWSEGv1\0'
+
+# magic, the first second of the span, the span in seconds, the most
+# records the segment can hold, and the number it does
+HEADER = Struct('<8sqIII4x')
+
+# time, source ip, section id
+RECORD = Struct('<dII')
+
+# an index entry for a second that hasn't been reached yet
+NOT_YET = 0xffffffff
+
+# the records are read this many at a time by the queries
+CHUNK = 65536
+
+# the most distinct sections, and clients, the queries count, so a scanner
+# in the history can't make them take more and more memory
+QUERY_CAPACITY = 1000
+
+SECTIONS_FILE = 'sections.txt'
+SEGMENT_SUFFIX = '.seg'
+
+
+def header_size(span):
+    """
+    @param span: a segment's span, in seconds
+    @return: the size of the header and index, rounded up to a whole number
+    of records so the records stay aligned
+    """
+    size = HEADER.size + 4 * (span + 1)
+    return -(-size // RECORD.size) * RECORD.size
+
+
+def segment_name(start, sequence):
+    """
+    @param start: the first second of the segment's span
+    @param sequence: which segment it is of those for the span, (a span
+    takes more than one if the first fills up)
+    @return: the segment's file name, which sorts in time order
+    """
+    return f'{start:012d}-{sequence:04d}{SEGMENT_SUFFIX}'
+
+
+def list_segments(directory):
+    """
+    @param directory: the history directory
+    @return: a list of (start, path) of the segment files, oldest first
+    """
+    segments = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX):
+            segments.append((int(name.split('-')[0]),
+                             os.path.join(directory, name)))
+    return sorted(segments)
+
+
+class SegmentWriter:
+    """
+    A segment being appended to
+    """
+
+    def __init__(self, path, start, span, capacity):
+        """
+        Makes a new, empty, segment file
+        @param path: where
+        @param start: the first second of its span
+        @param span: its span, in seconds
+        @param capacity: the most records it can hold
+        """
+        self.start = start
+        self.span = span
+        self.capacity = capacity
+        self.count = 0
+        # the last second with its index entry written
+        self.indexed = -1
+        self.records_offset = header_size(span)
+        self.file = open(path, 'w+b')
+        self.file.truncate(self.records_offset + capacity * RECORD.size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        HEADER.pack_into(self.mm, 0, MAGIC, start, span, capacity, 0)
+        self.index = memoryview(self.mm)[
+            HEADER.size:HEADER.size + 4 * (span + 1)].cast('I')
+        self.mm[HEADER.size:HEADER.size + 4 * (span + 1)] = \
+            b'\xff' * (4 * (span + 1))
+
+    def holds(self, second):
+        """
+        @param second: a record's whole second
+        @return: whether it belongs in this segment, and there's room
+        """
+        return self.start <= second < self.start + self.span and \
+            self.count < self.capacity
+
+    def append(self, t, src_ip, section_id):
+        """
+        Adds a record. Records a little out of order are indexed with the
+        second before them, (the index only ever goes forward).
+        @param t: the record's time
+        @param src_ip: its source ip, as an integer
+        @param section_id: its section's id
+        @return: None
+        """
+        second = int(t) - self.start
+        if second > self.indexed:
+            for entry in range(self.indexed + 1, second + 1):
+                self.index[entry] = self.count
+            self.indexed = second
+        RECORD.pack_into(self.mm, self.records_offset +
+                         self.count * RECORD.size, t, src_ip, section_id)
+        self.count += 1
+
+    def commit(self):
+        """
+        Makes the records appended so far visible to readers
+        @return: None
+        """
+        HEADER.pack_into(self.mm, 0, MAGIC, self.start, self.span,
+                         self.capacity, self.count)
+
+    def close(self):
+        """
+        @return: None
+        """
+        self.commit()
+        self.index.release()
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+class SegmentReader:
+    """
+    A segment, mapped read-only. It can be read while it's still being
+    written, and only sees the records committed when it was opened.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: the segment file
+        @raise ValueError: if it isn't a segment
+        """
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.start, self.span, self.capacity, count = \
+            HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f"{path} isn't a history segment")
+        self.records_offset = header_size(self.span)
+        self.count = min(count, (len(self.mm) - self.records_offset) //
+                         RECORD.size)
+        self.index = memoryview(self.mm)[
+            HEADER.size:HEADER.size + 4 * (self.span + 1)].cast('I')
+
+    def position(self, second):
+        """
+        @param second: a whole second
+        @return: the number of the segment's records before that second
+        """
+        offset = second - self.start
+        if offset <= 0:
+            return 0
+        if offset > self.span:
+            return self.count
+        entry = self.index[offset]
+        return self.count if entry == NOT_YET else min(entry, self.count)
+
+    def columns(self, first, last):
+        """
+        The records from first up to last, as views on the mapped file
+        @param first: a record number
+        @param last: the record number after the last one wanted
+        @return: a memoryview of the records as 32 bit words, 4 a record,
+        (the source ips are [2::4], and the section ids [3::4]). It has to
+        be released before the reader is closed.
+        """
+        with memoryview(self.mm) as view:
+            return view[self.records_offset + first * RECORD.size:
+                        self.records_offset + last * RECORD.size].cast('I')
+
+    def close(self):
+        """
+        @return: None
+        """
+        self.index.release()
+        self.mm.close()
+
+
+class SegmentLog:
+    """
+    Appends the ingested records to the history, from a thread of its own
+    """
+
+    def __init__(self, directory, span=3600, capacity=1 << 20,
+                 retention=7 * 24 * 3600, backlog=4096):
+        """
+        @param directory: the history directory, made if it isn't there
+        @param span: in seconds, how much time each segment covers
+        @param capacity: the most records a segment holds. A busy span gets
+        more than one segment.
+        @param retention: in seconds, how long segments are kept, or 0 to
+        keep them forever
+        @param backlog: the most batches waiting to be written, beyond which
+        they're dropped
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.span = span
+        self.capacity = capacity
+        self.retention = retention
+        self.batches = queue.Queue(backlog)
+        self.segment = None
+        self.written = 0
+        self.dropped = 0
+
+        self.sections_path = os.path.join(directory, SECTIONS_FILE)
+        self.section_ids = {}
+        if os.path.exists(self.sections_path):
+            with open(self.sections_path, encoding='utf-8') as f:
+                for line in f:
+                    self.section_ids[line.rstrip('\n')] = \
+                        len(self.section_ids)
+        self.sections_file = open(self.sections_path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def append_batch(self, rows):
+        """
+        Hands a batch over to be written, without waiting
+        @param rows: (time, src_ip, section) tuples, like
+        RecordStore.append_batch takes
+        @return: None
+        """
+        try:
+            self.batches.put_nowait(rows)
+        except queue.Full:
+            self.dropped += len(rows)
+
+    def write_loop(self):
+        """
+        The writer thread
+        @return: None
+        """
+        while True:
+            rows = self.batches.get()
+            if rows is None:
+                break
+            self.write(rows)
+
+    def write(self, rows):
+        """
+        Writes a batch to the segments, starting new ones as needed
+        @param rows: (time, src_ip, section) tuples
+        @return: None
+        """
+        new_sections = False
+        for t, src_ip, section in rows:
+            section_id = self.section_ids.get(section)
+            if section_id is None:
+                section_id = self.section_ids[section] = \
+                    len(self.section_ids)
+                self.sections_file.write(section + '\n')
+                new_sections = True
+            if self.segment is None or not self.segment.holds(int(t)):
+                if new_sections:
+                    # the names go out before any record using them
+                    self.sections_file.flush()
+                    new_sections = False
+                self.rotate(int(t))
+            self.segment.append(t, src_ip, section_id)
+        if new_sections:
+            self.sections_file.flush()
+        if self.segment is not None:
+            self.segment.commit()
+        self.written += len(rows)
+
+    def rotate(self, second):
+        """
+        Closes the current segment, and starts the one for a second, then
+        deletes the segments past the retention
+        @param second: the whole second of the record that didn't fit
+        @return: None
+        """
+        if self.segment is not None:
+            self.segment.close()
+        start = second - second % self.span
+        existing = [name for name in os.listdir(self.directory)
+                    if name.startswith(f'{start:012d}-')]
+        self.segment = SegmentWriter(
+            os.path.join(self.directory, segment_name(start, len(existing))),
+            start, self.span, self.capacity)
+        if self.retention:
+            for segment_start, path in list_segments(self.directory):
+                if segment_start + self.span <= second - self.retention:
+                    os.remove(path)
+
+    def stats(self):
+        """
+        @return: a dict with the records 'written', the records 'dropped'
+        because the writer fell behind, and the batches waiting, ('backlog')
+        """
+        return {'written': self.written, 'dropped': self.dropped,
+                'backlog': self.batches.qsize()}
+
+    def close(self):
+        """
+        Writes out everything handed over so far, and stops the writer
+        @return: None
+        """
+        self.batches.put(None)
+        self.thread.join()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        self.sections_file.close()
+
+
+def query(directory, start, end, step=None, top_n=10,
+          capacity=QUERY_CAPACITY):
+    """
+    Works out the traffic for a stretch of the history, reading the segments
+    a chunk at a time. Times are whole seconds, (start and end are rounded
+    down). The sections and clients are counted with Space-Saving summaries,
+    so their counts are approximate once there are more than capacity of
+    them.
+    @param directory: the history directory
+    @param start: the time to start from
+    @param end: the time to stop at, (not included)
+    @param step: if given, the requests are also counted for every step
+    seconds
+    @param top_n: how many of the top sections and clients
+    @param capacity: the most distinct sections, and clients, counted
+    @return: a dict of the 'start' and 'end' seconds, the 'total' requests,
+    the 'peak' as (second, requests), the 'steps' as a list of (start of
+    step, requests), and the 'sections' and 'clients', as lists of (name or
+    src_ip as an integer, requests, error), most first, with error the most
+    the requests could be over by
+    """
+    start = int(start)
+    end = int(end)
+    with open(os.path.join(directory, SECTIONS_FILE),
+              encoding='utf-8') as f:
+        names = [line.rstrip('\n') for line in f]
+
+    per_second = Counter()
+    sections = SpaceSaving(capacity)
+    clients = SpaceSaving(capacity)
+    for segment_start, path in list_segments(directory):
+        if segment_start >= end:
+            break
+        reader = SegmentReader(path)
+        try:
+            if reader.start + reader.span <= start:
+                continue
+            # the requests each second, straight from the index
+            first_second = max(start, reader.start)
+            last_second = min(end, reader.start + reader.span)
+            before = reader.position(first_second)
+            for second in range(first_second, last_second):
+                after = reader.position(second + 1)
+                if after > before:
+                    per_second[second] += after - before
+                before = after
+            # and the sections and clients from the records
+            first = reader.position(first_second)
+            last = reader.position(last_second)
+            for chunk in range(first, last, CHUNK):
+                words = reader.columns(chunk, min(chunk + CHUNK, last))
+                try:
+                    # counted a chunk at a time first, which is much quicker
+                    # than adding the records to the summaries one by one
+                    for summary, column in ((clients, 2), (sections, 3)):
+                        for key, hits in Counter(words[column::4]).items():
+                            summary.add(key, hits)
+                finally:
+                    words.release()
+        finally:
+            reader.close()
+
+    steps = []
+    if step:
+        step_hits = Counter()
+        for second, hits in per_second.items():
+            step_hits[(second - start) // step] += hits
+        steps = [(start + number * step, step_hits[number])
+                 for number in range(-(-(end - start) // step))]
+    peak = max(per_second.items(), key=lambda item: (item[1], -item[0]),
+               default=(None, 0))
+    return {'start': start, 'end': end,
+            'total': sum(per_second.values()),
+            'peak': peak,
+            'steps': steps,
+            'sections': [(names[section_id], hits, error)
+                         for section_id, hits, error in sections.top(top_n)],
+            'clients': clients.top(top_n)}
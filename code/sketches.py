@@ -0,0 +1,359 @@
+import heapq
+import math
+import operator
+from array import array
+
+from section_counter import load_numpy
+
+"""
+    Fixed memory summaries of the traffic, for when counting everything
+    exactly would take too much.
+"""
+
+# Below this many items, counting a batch into a count-min sketch one at a
+# time beats setting up the numpy arrays
+NUMPY_BATCH = 64
+
+
+class SpaceSaving:
+    """
+    The Space-Saving heavy hitters summary, (Metwally, Agrawal and El Abbadi,
+    2005). It counts at most 'capacity' distinct items. When a new item shows
+    up and the summary is full, it takes over the counter of the item with
+    the smallest count, and inherits that count as its possible error.
+
+    So an item's count is never lower than its true count, and never more
+    than its error higher. Any item seen more than total / capacity times is
+    sure to be in the summary. Summaries can be merged, so per-second ones
+    can be combined into a summary for any window of seconds.
+    """
+
+    def __init__(self, capacity):
+        """
+        @param capacity: the most distinct items counted
+        """
+        if capacity < 1:
+            raise ValueError("A SpaceSaving summary needs a capacity of at "
+                             "least 1")
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # a min-heap of (count, item), one entry per item. Counts only ever
+        # go up, so an entry can be behind its item's count, and is only
+        # brought up to date when it gets to the top of the heap.
+        self.heap = []
+        self.total = 0
+        # whether any item's counter has been taken over or thrown away
+        self.dropped = False
+
+    def __len__(self):
+        return len(self.counts)
+
+    def copy(self):
+        """
+        @return: a summary with the same counts, that this one's later adds
+        don't change
+        """
+        other = SpaceSaving(self.capacity)
+        other.counts = self.counts.copy()
+        other.errors = self.errors.copy()
+        other.heap = self.heap.copy()
+        other.total = self.total
+        other.dropped = self.dropped
+        return other
+
+    def add(self, item, count=1):
+        """
+        Counts an item
+        @param item: anything hashable
+        @param count: how many times to count it
+        @return: None
+        """
+        self.total += count
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+        elif len(counts) < self.capacity:
+            counts[item] = count
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (count, item))
+        else:
+            heap = self.heap
+            floor, smallest = heap[0]
+            while counts[smallest] != floor:
+                heapq.heapreplace(heap, (counts[smallest], smallest))
+                floor, smallest = heap[0]
+            del counts[smallest]
+            del self.errors[smallest]
+            counts[item] = floor + count
+            self.errors[item] = floor
+            heapq.heapreplace(heap, (floor + count, item))
+            self.dropped = True
+
+    def floor(self):
+        """
+        @return: the most any item that isn't in the summary could have been
+        seen, 0 if nothing's ever been dropped from it
+        """
+        if not self.dropped or not self.counts:
+            return 0
+        return min(self.counts.values())
+
+    def merge(self, other):
+        """
+        Adds another summary's counts into this one. An item missing from
+        one of the two summaries is counted as that summary's floor, (the
+        most it could have been seen there), and that much is added to its
+        error too. Then the largest 'capacity' counts are kept. See Cafaro,
+        Pulimeno and Tempesta, 'A parallel space saving algorithm for
+        frequent items and the Hurwitz zeta distribution', 2016.
+        @param other: a SpaceSaving summary
+        @return: None
+        """
+        own_floor = self.floor()
+        other_floor = other.floor()
+        counts = {}
+        errors = {}
+        for item in self.counts.keys() | other.counts.keys():
+            counts[item] = self.counts.get(item, own_floor) + \
+                other.counts.get(item, other_floor)
+            errors[item] = self.errors.get(item, own_floor) + \
+                other.errors.get(item, other_floor)
+
+        if len(counts) > self.capacity:
+            kept = sorted(counts, key=counts.get,
+                          reverse=True)[:self.capacity]
+            counts = {item: counts[item] for item in kept}
+            errors = {item: errors[item] for item in kept}
+            self.dropped = True
+        self.dropped = self.dropped or other.dropped
+        self.counts = counts
+        self.errors = errors
+        self.heap = [(count, item) for item, count in counts.items()]
+        heapq.heapify(self.heap)
+        self.total += other.total
+
+    def error_bound(self):
+        """
+        @return: the most any single count in the summary can be too high by
+        """
+        return self.total // self.capacity
+
+    def top(self, n=None):
+        """
+        @param n: the number of items wanted, or None for all of them
+        @return: a list of (item, count, error) tuples, largest count first.
+        The true count of each item is between count - error and count.
+        """
+        items = sorted(self.counts.items(), key=lambda item: item[1],
+                       reverse=True)
+        if n is not None:
+            items = items[:n]
+        return [(item, count, self.errors[item]) for item, count in items]
+
+
+def mix64(value):
+    """
+    Scrambles an integer into a well spread 64 bit hash, (the splitmix64
+    finalizer). Python's own hash() of an int is the int itself, which is no
+    good for sketches fed IP addresses from the same few subnets.
+    @param value: a non-negative integer, like an IPv4 address
+    @return: a 64 bit hash
+    """
+    z = (value + 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return z ^ (z >> 31)
+
+
+class CountMinSketch:
+    """
+    The count-min sketch, (Cormode and Muthukrishnan, 2005): depth rows of
+    width counters, each item counted in one counter per row. An item's
+    estimate is the smallest of its counters, which is never lower than its
+    true count, and with probability 1 - e^-depth is at most
+    e / width * total higher.
+
+    Items are hashed once, with mix64, and the rows' counters picked from
+    that one hash, (Kirsch and Mitzenmacher's double hashing), so callers
+    feeding several sketches the same item can hash it once and use the
+    *_hashed methods. Sketches of the same shape can be added and
+    subtracted, which is what lets a sliding window keep a running one.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        """
+        @param width: counters per row
+        @param depth: the number of rows
+        """
+        self.width = width
+        self.depth = depth
+        self.table = array('I', [0]) * (width * depth)
+        self.total = 0
+
+    def copy(self):
+        """
+        @return: a sketch with the same counts
+        """
+        other = CountMinSketch(self.width, self.depth)
+        other.table = array('I', self.table)
+        other.total = self.total
+        return other
+
+    def indexes(self, h):
+        """
+        @param h: an item's mix64 hash
+        @return: the positions in the table of the item's counters
+        """
+        width = self.width
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        return [row * width + (h1 + row * h2) % width
+                for row in range(self.depth)]
+
+    def add_hashed(self, h, count=1):
+        """
+        @param h: an item's mix64 hash
+        @param count: how many times to count it
+        @return: None
+        """
+        table = self.table
+        for index in self.indexes(h):
+            table[index] += count
+        self.total += count
+
+    def add_many(self, hashes, counts):
+        """
+        Counts a batch of items, like a second's worth of clients. With
+        numpy, and enough of them, their counters are all worked out and
+        added in a few passes in C.
+        @param hashes: a list of the items' mix64 hashes
+        @param counts: a list of how many times to count each
+        @return: None
+        """
+        numpy = load_numpy() if len(hashes) >= NUMPY_BATCH else None
+        if numpy is None:
+            for h, count in zip(hashes, counts):
+                self.add_hashed(h, count)
+            return
+        h = numpy.array(hashes, dtype=numpy.uint64)
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        # the same counters as indexes(), a row of them per item
+        rows = numpy.arange(self.depth, dtype=numpy.uint64)[:, None]
+        positions = rows * self.width + (h1 + rows * h2) % self.width
+        weights = numpy.broadcast_to(numpy.array(counts, dtype=numpy.float64),
+                                     positions.shape)
+        # bincount, since two items can share a counter
+        added = numpy.bincount(positions.ravel().astype(numpy.intp),
+                               weights.ravel(), minlength=len(self.table))
+        table = numpy.frombuffer(self.table, dtype=numpy.uint32)
+        table += added.astype(numpy.uint32)
+        self.total += sum(counts)
+
+    def estimate_hashed(self, h):
+        """
+        @param h: an item's mix64 hash
+        @return: the item's estimated count
+        """
+        table = self.table
+        return min(table[index] for index in self.indexes(h))
+
+    def add(self, item, count=1):
+        self.add_hashed(mix64(item), count)
+
+    def estimate(self, item):
+        return self.estimate_hashed(mix64(item))
+
+    def merge(self, other, sign=1):
+        """
+        Adds another sketch's counts to this one, or with sign -1, takes
+        them back out
+        @param other: a CountMinSketch of the same width and depth
+        @param sign: 1 or -1
+        @return: None
+        """
+        numpy = load_numpy()
+        if numpy is not None:
+            # the tables are added in place, through views of their memory
+            table = numpy.frombuffer(self.table, dtype=numpy.uint32)
+            other_table = numpy.frombuffer(other.table, dtype=numpy.uint32)
+            if sign > 0:
+                table += other_table
+            else:
+                table -= other_table
+        else:
+            combine = operator.add if sign > 0 else operator.sub
+            self.table = array('I', map(combine, self.table, other.table))
+        self.total += sign * other.total
+
+    def error_bound(self):
+        """
+        @return: how far over its true count an estimate can be, (with
+        probability 1 - e^-depth)
+        """
+        return math.ceil(math.e / self.width * self.total)
+
+
+class HyperLogLog:
+    """
+    The HyperLogLog distinct counter, (Flajolet et al., 2007). 2^precision
+    one byte registers estimate the number of distinct items with a
+    standard error of about 1.04 / sqrt(2^precision), 1.6% for the default
+    4KB. Merging two is just taking the larger of each pair of registers.
+    """
+
+    def __init__(self, precision=12):
+        """
+        @param precision: the number of hash bits used to pick a register,
+        from 4 to 16
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be from 4 to 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add_hashed(self, h):
+        """
+        @param h: an item's mix64 hash
+        @return: None
+        """
+        rest_bits = 64 - self.precision
+        index = h >> rest_bits
+        rest = h & ((1 << rest_bits) - 1)
+        # the position of the first 1 bit in the rest of the hash
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, item):
+        self.add_hashed(mix64(item))
+
+    def copy(self):
+        """
+        @return: a HyperLogLog with the same registers
+        """
+        other = HyperLogLog(self.precision)
+        other.registers = bytearray(self.registers)
+        return other
+
+    def merge(self, other):
+        """
+        @param other: a HyperLogLog of the same precision
+        @return: None
+        """
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """
+        @return: the estimated number of distinct items added
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register
+                                       for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small counts are better estimated from the empty registers
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
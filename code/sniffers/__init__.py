@@ -1,19 +1,58 @@
-from sniffers import bare_socket_based_sniffer
-from sniffers import scapy_based_sniffer
+"""
+    The packet sniffer backends. Each is only imported once get_sniffer
+    picks it, so the socket backends don't pay for loading scapy, (which
+    takes most of a second), when the monitor starts up.
+"""
 
 
-def get_sniffer(name):
+def get_sniffer(name, kernel_filter=True, filter_stats=False,
+                fanout_group=None, reassemble=True, pcap_file=None,
+                replay_speed=0):
     """
     A simple factory - given a string it hands back the appropriate backend
     packet sniffer.
-    @param name: one of 'scapy' for the scapy-based backend, and 'socket' for
-        bare-bone but much faster hand implementation.
+    @param name: one of 'scapy' for the scapy-based backend, 'scapy-fast'
+        for scapy reading batches of raw frames and only dissecting the
+        requests, 'socket' for
+        bare-bone but much faster hand implementation, and 'mmap' for the
+        socket implementation reading from a memory-mapped packet ring, which
+        is the fastest of the three (linux only). 'pcap' replays a capture
+        file instead of sniffing.
+    @param kernel_filter: for 'socket' and 'mmap', attach a BPF filter so the
+        kernel drops uninteresting packets. scapy always filters in the kernel.
+    @param filter_stats: for 'socket' and 'mmap', count how many packets the
+        kernel filter dropped compared to how many it delivered.
+    @param fanout_group: for 'socket' and 'mmap', a PACKET_FANOUT group id, so
+        several sniffer processes can split the traffic between them.
+    @param reassemble: for 'socket' and 'mmap', follow each connection's byte
+        stream to find request lines split across packets, or pipelined.
+        For 'pcap' too.
+    @param pcap_file: for 'pcap', the pcap or pcapng file to replay
+    @param replay_speed: for 'pcap', how many times faster than real time to
+        replay the file, or 0 for as fast as possible
     @return: a packet sniffer
     """
-    if name == "scapy":
-        return scapy_based_sniffer.ScapySniffer()
+    if name in ("scapy", "scapy-fast"):
+        if fanout_group is not None:
+            raise NotImplementedError("The scapy backend can only run as a "
+                                      "single sniffer process")
+        from sniffers import scapy_based_sniffer
+        return scapy_based_sniffer.ScapySniffer(fast=name == "scapy-fast")
     elif name == "socket":
-        return bare_socket_based_sniffer.BareSocketSniffer()
+        from sniffers import bare_socket_based_sniffer
+        return bare_socket_based_sniffer.BareSocketSniffer(kernel_filter,
+                                                           filter_stats,
+                                                           fanout_group,
+                                                           reassemble)
+    elif name == "mmap":
+        from sniffers import mmap_ring_sniffer
+        return mmap_ring_sniffer.MmapRingSniffer(kernel_filter, filter_stats,
+                                                 fanout_group, reassemble)
+    elif name == "pcap":
+        from sniffers import pcap_replay_sniffer
+        return pcap_replay_sniffer.PcapReplaySniffer(pcap_file, replay_speed,
+                                                     reassemble)
     else:
         raise NotImplementedError(f"Unknown backend, {name}, please choose"
-                                  " 'scapy' or 'socket'")
+                                  " 'scapy', 'scapy-fast', 'socket', 'mmap'"
+                                  " or 'pcap'")
@@ -1,8 +1,18 @@
-import re
+import multiprocessing
 import socket
 import time
 from struct import unpack
 
+from sniffers import bpf
+from sniffers import http_parser
+from sniffers import packet_socket
+from sniffers import reassembly
+
+
+# TCP header flags, the ones that end a connection
+TCP_FIN = 0x01
+TCP_RST = 0x04
+
 
 class BareSocketSniffer:
     """
@@ -11,18 +21,57 @@ class BareSocketSniffer:
     This packet sniffer is coded entirely in the python networking api, to
     skip third-party libraries. It runs fast enough on my test hardware to
     capture >1,000 packets per second, and so is the preferred method of
-    capture for this app.
+    capture for this app. (The parsing on its own manages a good deal more,
+    python -m benchmarks.bench_pipeline --stages parse parse-reassembly
+    measures it.)
+
+    By default a BPF program doing the same ip/port/payload checks as
+    parse_requests() is attached to the socket, so the kernel drops the
+    packets we don't care about before they're ever copied up to python.
+
+    Also by default, the payloads are put back together into each
+    connection's byte stream, (see reassembly.FlowTable), so a request line
+    split over two segments, or several pipelined requests in one, are all
+    found.
+
+    To spread the parsing over several processes, set fanout_group, and
+    start one run_sniffer() process per worker. The workers then read from
+    AF_PACKET sockets in a PACKET_FANOUT group, which hands each flow to
+    just one of them.
     """
 
-    # this regex will be used to determine if the packet inside the tcp packet
-    # appears to be HTTP
-    http_payload_re = re.compile(
-        r"^(?:OPTIONS|GET|HEAD|POST|PUT|DELETE|TRACE|CONNECT) "
-        r"(.+?) "
-        r"HTTP/\d\.\d"
-    )
+    # How often, in seconds, the filter counters are updated
+    stats_interval = 1
 
-    def run_sniffer(self, ip, dest_port, queue=None):
+    # How often, in seconds, idle flows are cleared out of the flow table
+    expire_interval = 10
+
+    def __init__(self, kernel_filter=True, filter_stats=False,
+                 fanout_group=None, reassemble=True):
+        """
+        @param kernel_filter: Attach the BPF filter to the socket. Without it
+        every TCP packet on the box is parsed in python.
+        @param filter_stats: Count how many packets the kernel filter threw
+        away compared to how many it delivered, see capture_stats(). This
+        opens a second socket to count the incoming TCP packets, so it costs
+        a little kernel time and is off by default.
+        @param fanout_group: None for a single sniffer process, otherwise the
+        PACKET_FANOUT group id shared by all of the sniffer's workers.
+        @param reassemble: Follow each connection's byte stream, rather than
+        looking for a request line at the start of each packet on its own.
+        """
+        self.kernel_filter = kernel_filter
+        self.reassemble = reassemble
+        # Made in run_sniffer(), so each sniffer process has its own
+        self.flow_table = None
+        self.filter_stats = filter_stats
+        self.fanout_group = fanout_group
+        # Created here, in the main process, so the counters are shared with
+        # the sniffer process after it forks: packets delivered to the
+        # sniffer, and the incoming TCP packets seen by the counting socket.
+        self.filter_counts = multiprocessing.Array('Q', 2)
+
+    def run_sniffer(self, ip, dest_port, queue=None, worker=0):
         """
         This is the entry point for this sniffer.
 
@@ -31,120 +80,224 @@ class BareSocketSniffer:
         messages to to any ips will be logged, (so long as the port number
         matches)
         @param queue: The queue which sends back packet info to the main process
+        @param worker: When running several workers in a fanout group, this
+        worker's number. Worker 0 does the group-wide bookkeeping.
         @return: None
         """
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_RAW,
-                              socket.IPPROTO_TCP)
-        except socket.error as e:
-            print(f'Problem creating the socket, permissions? ' +
-                  'Error {e[0]}, {e[1]}')
-            raise e
+        if self.fanout_group is None:
+            try:
+                s = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                  socket.IPPROTO_TCP)
+            except socket.error as e:
+                print(f'Problem creating the socket, permissions? ' +
+                      'Error {e[0]}, {e[1]}')
+                raise e
+        else:
+            # Raw AF_INET sockets can't share out packets between them, but
+            # AF_PACKET ones can.
+            s = packet_socket.open_packet_socket()
+            packet_socket.join_fanout(s, self.fanout_group)
+
+        if self.kernel_filter:
+            bpf.attach_filter(s, bpf.http_request_filter(ip, dest_port))
+
+        counting_socket = None
+        delivered = 0
+        if self.filter_stats:
+            # All the workers share a single counter of incoming packets
+            if worker == 0:
+                counting_socket = packet_socket.open_counting_socket()
+            # wake up now and then even if the filter lets nothing through,
+            # so the counters keep moving
+            s.settimeout(self.stats_interval)
+        next_stats = time.time() + self.stats_interval
+        if self.reassemble:
+            self.flow_table = reassembly.FlowTable()
+        next_expiry = time.time() + self.expire_interval
 
         while True:
+            if self.filter_stats and time.time() >= next_stats:
+                self.update_filter_counts(counting_socket, delivered)
+                delivered = 0
+                next_stats = time.time() + self.stats_interval
+
             # Give me everything
-            packet, addr = s.recvfrom(0xffff)
+            try:
+                packet, addr = s.recvfrom(0xffff)
+            except socket.timeout:
+                continue
             # Timestamp it
             recv_time = time.time()
+            delivered += 1
 
-            # take first 20 characters for the ip header
-            ip_header = packet[0:20]
+            # The packet socket also sees what this host sends, which the
+            # kernel filter normally takes care of
+            if self.fanout_group is not None and \
+                    addr[2] == packet_socket.PACKET_OUTGOING:
+                continue
 
-            # This is kind of ugly but it's python's way of packing and
-            # unpacking binary data, for converting between python values and
-            # C structs. https://docs.python.org/3.7/library/struct.htm for more.
-            # Parsing just the IP header... see RFC791
-            ipheader_fields = unpack('!BBHHHBBH4s4s', ip_header)
+            for s_addr, section in self.parse_requests(packet, ip, dest_port,
+                                                       recv_time):
+                if queue:
+                    queue.put({'time': recv_time,
+                               'src_ip': s_addr,
+                               'path': section})
+                else:
+                    print(f'{s_addr} {section}')
 
-            version_ihl = ipheader_fields[0]
-            version = version_ihl >> 4
-            # the ip header length in 32 bit words
-            ihl = version_ihl & 0xF
+            if recv_time >= next_expiry:
+                self.expire_flows(recv_time)
+                next_expiry = recv_time + self.expire_interval
 
-            # bytes are easier to think about
-            ipheader_length = ihl * 4
+    def expire_flows(self, now):
+        """
+        Clears the idle flows out of the flow table, if there is one
+        @param now: the current time
+        @return: None
+        """
+        if self.flow_table is not None:
+            self.flow_table.expire(now)
 
-            # ipheader_fields[5] is ttl, not useful for now
-            protocol = ipheader_fields[6]
+    def update_filter_counts(self, counting_socket, delivered):
+        """
+        Adds the latest packet counts to the shared totals.
 
-            # The TCP protocol's magic number is 6, (see RFC 790)
-            # skip this packet if it doesn't contain TCP
-            if protocol != 6:
-                continue
+        @param counting_socket: the socket from open_counting_socket(), or
+        None for the workers that don't do the counting
+        @param delivered: packets the sniffer received since the last update
+        @return: None
+        """
+        seen = 0
+        if counting_socket:
+            seen = packet_socket.read_packet_statistics(counting_socket)[0]
+        with self.filter_counts.get_lock():
+            self.filter_counts[0] += delivered
+            self.filter_counts[1] += seen
 
-            s_addr = socket.inet_ntoa(ipheader_fields[8])
-            d_addr = socket.inet_ntoa(ipheader_fields[9])
-            # toss packets with ip destinations not matching our filter, if a
-            # filter was passed...
-            if ip and ip != d_addr:
-                continue
+    def capture_stats(self):
+        """
+        The kernel filter's running totals, safe to call from the main process.
+        @return: None if filter_stats is off, otherwise a dict with the
+        number of packets 'delivered' to the sniffer, and the number of
+        incoming TCP packets the kernel 'filtered' out.
+        """
+        if not self.filter_stats:
+            return None
+        with self.filter_counts.get_lock():
+            delivered, seen = self.filter_counts[:]
+        # The two sockets see packets at slightly different moments, so
+        # don't let a packet in flight make this go negative
+        return {'delivered': delivered, 'filtered': max(seen - delivered, 0)}
 
-            tcp_header = packet[ipheader_length:ipheader_length + 20]
+    def parse_requests(self, packet, ip, dest_port, now):
+        """
+        Picks apart a single IP packet and, if it's headed for the ip/port
+        we're watching, finds the HTTP requests in it.
 
-            # rfc793 for tcp header packing
-            tcp_header_fields = unpack('!HHLLBBHHH', tcp_header)
+        @param packet: A bytes-like object starting at the IP header. It's
+        looked at through a memoryview, so the headers and payload are never
+        copied out of it, and the ring-buffer backend can hand in slices of
+        its ring.
+        @param ip: The destination ip to filter by, or None for any ip
+        @param dest_port: The port we're interested in
+        @param now: When the packet arrived, for the flow table's idle timer
+        @return: a list of (src_ip, section), one for each request line the
+        packet has, (or with reassembly, completes). Usually empty or one.
+        """
+        packet = memoryview(packet)
+        # take first 20 characters for the ip header
+        ip_header = packet[0:20]
 
-            packet_source_port = tcp_header_fields[0]
-            packet_dest_port = tcp_header_fields[1]
-            if packet_dest_port != dest_port:
-                continue
+        # This is kind of ugly but it's python's way of packing and
+        # unpacking binary data, for converting between python values and
+        # C structs. https://docs.python.org/3.7/library/struct.htm for more.
+        # Parsing just the IP header... see RFC791
+        ipheader_fields = unpack('!BBHHHBBH4s4s', ip_header)
 
-            # for debugging, uncomment this to see responses also
-            # if packet_dest_port == dest_port or packet_source_port == dest_port:
-            #     continue
+        version_ihl = ipheader_fields[0]
+        version = version_ihl >> 4
+        # the ip header length in 32 bit words
+        ihl = version_ihl & 0xF
 
-            sequence = tcp_header_fields[2]
-            acknowledgement = tcp_header_fields[3]
-            doff_reserved = tcp_header_fields[4]
-            tcp_header_length = doff_reserved >> 4
-            total_header_size = ipheader_length + tcp_header_length * 4
+        # bytes are easier to think about
+        ipheader_length = ihl * 4
 
-            data_size = len(packet) - total_header_size
+        # the IP packet's length, which can be shorter than what was
+        # captured if the link layer padded it out
+        ip_length = ipheader_fields[2]
 
-            if data_size == 0:
-                continue
+        # ipheader_fields[5] is ttl, not useful for now
+        protocol = ipheader_fields[6]
 
-            # Debugging code to show packet details
-            # print('Version : ' + str(version) + ' IP Header Length : ' +
-            #    str(ihl) + ' Protocol : ' + str(protocol) + ' Source Address : ' +
-            #    str( s_addr) + ' Destination Address : ' + str(d_addr))
-            #
-            # print( 'Source Port : ' + str(packet_source_port) + ' Dest Port : '
-            #    + str( packet_dest_port) + ' Sequence Number : ' + str(sequence) +
-            #    'Acknowledgement : ' + str( acknowledgement) + ' TCP header '+
-            #    'length : ' + str(tcp_header_length))
+        # The TCP protocol's magic number is 6, (see RFC 790)
+        # skip this packet if it doesn't contain TCP
+        if protocol != 6:
+            return []
 
-            # get data from the packet
-            data = packet[total_header_size:]
+        # toss packets with ip destinations not matching our filter, if a
+        # filter was passed...
+        if ip and ip != socket.inet_ntoa(ipheader_fields[9]):
+            return []
 
-            try:
-                # if it's encrypted this won't work, obviously
-                payload_data = data.decode('utf-8')
-            except UnicodeDecodeError:
-                print("issue decoding data in packet, skipping")
-                continue
+        tcp_header = packet[ipheader_length:ipheader_length + 20]
 
-            # see if the data looks like HTTP
-            result = self.http_payload_re.search(payload_data)
-            if not result or len(result.groups()) == 0:
-                continue
+        # rfc793 for tcp header packing
+        tcp_header_fields = unpack('!HHLLBBHHH', tcp_header)
+
+        packet_source_port = tcp_header_fields[0]
+        packet_dest_port = tcp_header_fields[1]
+        if packet_dest_port != dest_port:
+            return []
+
+        # for debugging, uncomment this to see responses also
+        # if packet_dest_port == dest_port or packet_source_port == dest_port:
+        #     return None
+
+        sequence = tcp_header_fields[2]
+        acknowledgement = tcp_header_fields[3]
+        doff_reserved = tcp_header_fields[4]
+        flags = tcp_header_fields[5]
+        tcp_header_length = doff_reserved >> 4
+        total_header_size = ipheader_length + tcp_header_length * 4
+
+        if 0 < ip_length < len(packet):
+            packet = packet[:ip_length]
+        data_size = len(packet) - total_header_size
+
+        if data_size <= 0:
+            return []
+
+        # Debugging code to show packet details
+        # print('Version : ' + str(version) + ' IP Header Length : ' +
+        #    str(ihl) + ' Protocol : ' + str(protocol) + ' Source Address : ' +
+        #    str(socket.inet_ntoa(ipheader_fields[8])) +
+        #    ' Destination Address : ' +
+        #    str(socket.inet_ntoa(ipheader_fields[9])))
+        #
+        # print( 'Source Port : ' + str(packet_source_port) + ' Dest Port : '
+        #    + str( packet_dest_port) + ' Sequence Number : ' + str(sequence) +
+        #    'Acknowledgement : ' + str( acknowledgement) + ' TCP header '+
+        #    'length : ' + str(tcp_header_length))
+
+        # get data from the packet
+        data = packet[total_header_size:]
+
+        # look for request lines in the bytes themselves, so there's no
+        # decoding, (which binary or encrypted payloads would fail anyway)
+        if self.flow_table is not None:
+            flow = (ipheader_fields[8], packet_source_port,
+                    ipheader_fields[9], packet_dest_port)
+            finished = flags & (TCP_FIN | TCP_RST)
+            sections = self.flow_table.feed(flow, sequence, data, now,
+                                            finished)
+        else:
+            section = http_parser.find_request_section(data)
+            sections = [section] if section else []
 
-            # extract the 'section'
-            section = result.group(1).split('/')
-            if len(section) > 2:
-                # this is the form /foo/index.html, so the split looks like
-                # ['', 'foo', 'index.html']
-                section = f'/{section[1]}'
-            else:
-                # this is the form /index.html
-                section = '/'
-
-            if queue:
-                queue.put({'time': recv_time,
-                           'src_ip': s_addr,
-                           'path': section})
-            else:
-                print(data.decode('utf-8'))
+        if not sections:
+            return []
+        s_addr = socket.inet_ntoa(ipheader_fields[8])
+        return [(s_addr, section) for section in sections]
 
 
 # For testing purposes, this may be started by itself
@@ -0,0 +1,203 @@
+import ctypes
+import socket
+from struct import pack, unpack
+
+"""
+    A tiny classic BPF assembler, and the filter programs the sniffers attach
+    to their sockets. With a filter attached, the kernel throws away the
+    packets we aren't interested in before they ever get copied up to python.
+
+    The programs assume the packet data begins at the IP header, which is the
+    case for both the raw AF_INET socket and the SOCK_DGRAM AF_PACKET sockets
+    used by the sniffers, unless they're told how long a link layer header
+    comes first, (scapy's SOCK_RAW sockets keep the ethernet header). See
+    Documentation/networking/filter.rst in the kernel source for the
+    instruction set.
+"""
+
+# from asm-generic/socket.h
+SO_ATTACH_FILTER = 26
+
+# instruction classes
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+
+# sizes
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+
+# addressing modes
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MSH = 0xa0
+
+# alu operations
+BPF_ADD = 0x00
+BPF_AND = 0x50
+BPF_RSH = 0x70
+
+# jumps
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JSET = 0x40
+
+# operand sources
+BPF_K = 0x00
+BPF_X = 0x08
+
+BPF_TAX = 0x00
+
+# The kernel's "ancillary data" loads live at negative offsets. This one
+# loads the packet type, (host, broadcast, outgoing, etc.)
+SKF_AD_OFF = -0x1000
+SKF_AD_PKTTYPE = 4
+
+# Returning this from a program accepts the whole packet, returning 0 drops
+# it. Any other value truncates the packet to that many bytes.
+ACCEPT_ALL = 0x40000
+
+# the TCP protocol number, and the packet type of packets being sent
+IPPROTO_TCP = 6
+ETH_P_IP = 0x0800
+PACKET_OUTGOING = 4
+
+
+def assemble(instructions):
+    """
+    Turns a list of instructions and labels into a runnable program.
+
+    @param instructions: A list of (code, jt, jf, k) tuples, and label
+    strings. For jumps jt and jf may be label names rather than offsets, and
+    get resolved here.
+    @return: a list of (code, jt, jf, k) tuples with numeric jump offsets
+    """
+    labels = {}
+    position = 0
+    for instruction in instructions:
+        if isinstance(instruction, str):
+            labels[instruction] = position
+        else:
+            position += 1
+
+    program = []
+    for instruction in instructions:
+        if isinstance(instruction, str):
+            continue
+        code, jt, jf, k = instruction
+        # jump offsets are relative to the *next* instruction
+        here = len(program) + 1
+        if isinstance(jt, str):
+            jt = labels[jt] - here
+        if isinstance(jf, str):
+            jf = labels[jf] - here
+        program.append((code, jt, jf, k & 0xffffffff))
+    return program
+
+
+def http_request_filter(ip, dest_port, link_header=0):
+    """
+    Builds the filter for the sniffers: TCP, to the given ip (if any) and
+    port, and carrying some payload. These are the same checks the sniffers
+    do in python, so with this attached, almost every packet that reaches
+    python is an HTTP request.
+
+    @param ip: The destination ip to keep, or None for any ip
+    @param dest_port: The destination port to keep
+    @param link_header: How many bytes of ethernet header come before the IP
+    header, 0 for sockets that start at the IP header. With one, only IPv4
+    frames are kept.
+    @return: an assembled program
+    """
+    # every offset into the packet moves along by the header, (X only ever
+    # holds header lengths, so the loads from X + k need it added to k)
+    at = link_header
+    instructions = [
+        # Packet sockets also see the packets this host sends, skip those
+        (BPF_LD | BPF_W | BPF_ABS, 0, 0, SKF_AD_OFF + SKF_AD_PKTTYPE),
+        (BPF_JMP | BPF_JEQ | BPF_K, 'drop', 0, PACKET_OUTGOING),
+    ]
+    if link_header:
+        instructions += [
+            # the ethernet type, the last two bytes of the header
+            (BPF_LD | BPF_H | BPF_ABS, 0, 0, link_header - 2),
+            (BPF_JMP | BPF_JEQ | BPF_K, 0, 'drop', ETH_P_IP),
+        ]
+    instructions += [
+        # the protocol byte of the IP header
+        (BPF_LD | BPF_B | BPF_ABS, 0, 0, at + 9),
+        (BPF_JMP | BPF_JEQ | BPF_K, 0, 'drop', IPPROTO_TCP),
+    ]
+    if ip:
+        ip_value = unpack('!I', socket.inet_aton(ip))[0]
+        instructions += [
+            # the destination address
+            (BPF_LD | BPF_W | BPF_ABS, 0, 0, at + 16),
+            (BPF_JMP | BPF_JEQ | BPF_K, 0, 'drop', ip_value),
+        ]
+    instructions += [
+        # Fragments after the first one don't have a TCP header to look at
+        (BPF_LD | BPF_H | BPF_ABS, 0, 0, at + 6),
+        (BPF_JMP | BPF_JSET | BPF_K, 'drop', 0, 0x1fff),
+        # X = the IP header length, 4 * (first byte & 0xf)
+        (BPF_LDX | BPF_B | BPF_MSH, 0, 0, at),
+        # the TCP destination port
+        (BPF_LD | BPF_H | BPF_IND, 0, 0, at + 2),
+        (BPF_JMP | BPF_JEQ | BPF_K, 0, 'drop', dest_port),
+        # A = the TCP header length, which is the top nibble of its 13th
+        # byte, in 32 bit words
+        (BPF_LD | BPF_B | BPF_IND, 0, 0, at + 12),
+        (BPF_ALU | BPF_AND | BPF_K, 0, 0, 0xf0),
+        (BPF_ALU | BPF_RSH | BPF_K, 0, 0, 2),
+        # X = IP header length + TCP header length
+        (BPF_ALU | BPF_ADD | BPF_X, 0, 0, 0),
+        (BPF_MISC | BPF_TAX, 0, 0, 0),
+        # and only keep it if the IP total length is bigger than that, that
+        # is, if there is any payload
+        (BPF_LD | BPF_H | BPF_ABS, 0, 0, at + 2),
+        (BPF_JMP | BPF_JGT | BPF_X, 0, 'drop', 0),
+        (BPF_RET | BPF_K, 0, 0, ACCEPT_ALL),
+        'drop',
+        (BPF_RET | BPF_K, 0, 0, 0),
+    ]
+    return assemble(instructions)
+
+
+def tcp_counter_filter():
+    """
+    Builds the filter for the counting socket, used to compare the number of
+    packets that arrive with the number the sniffer's filter delivers. It
+    keeps incoming TCP packets, truncated to a single byte since nobody ever
+    reads them.
+    @return: an assembled program
+    """
+    return assemble([
+        (BPF_LD | BPF_W | BPF_ABS, 0, 0, SKF_AD_OFF + SKF_AD_PKTTYPE),
+        (BPF_JMP | BPF_JEQ | BPF_K, 'drop', 0, PACKET_OUTGOING),
+        (BPF_LD | BPF_B | BPF_ABS, 0, 0, 9),
+        (BPF_JMP | BPF_JEQ | BPF_K, 0, 'drop', IPPROTO_TCP),
+        (BPF_RET | BPF_K, 0, 0, 1),
+        'drop',
+        (BPF_RET | BPF_K, 0, 0, 0),
+    ])
+
+
+def attach_filter(s, program):
+    """
+    Attaches an assembled program to a socket with SO_ATTACH_FILTER
+
+    @param s: the socket
+    @param program: a list of (code, jt, jf, k) tuples, see assemble()
+    @return: None
+    """
+    # struct sock_filter is {u16 code; u8 jt; u8 jf; u32 k}, and the kernel
+    # wants a struct sock_fprog {unsigned short len; sock_filter *filter}
+    # pointing at an array of them.
+    filters = b''.join(pack('=HBBI', *instruction) for instruction in program)
+    buffer = ctypes.create_string_buffer(filters, len(filters))
+    fprog = pack('HP', len(program), ctypes.addressof(buffer))
+    s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
@@ -0,0 +1,93 @@
+import re
+
+"""
+    A small HTTP request line parser, working on the payload bytes as they
+    come off the wire. It never copies or decodes a payload, only the section
+    names it finds, and each of those just the once.
+"""
+
+# The request methods
+METHODS = (b'GET', b'POST', b'PUT', b'HEAD', b'DELETE', b'OPTIONS', b'PATCH',
+           b'TRACE', b'CONNECT')
+
+# The first bytes of the methods, so most payloads that aren't the start of a
+# request, (a body, or the rest of a long one), are turned away by looking
+# at a single byte
+METHOD_FIRST_BYTES = frozenset(method[0] for method in METHODS)
+
+# A request line, like b'GET /foo/index.html HTTP/1.1', without its line
+# ending. The section, (b'foo' there), is matched along the way, so it
+# doesn't take a second look at the target to pick it out. When the target
+# has no second '/', (b'/index.html'), the section group doesn't match.
+#
+# A regex, rather than checking the method and finding the spaces with
+# bytes.find, since it's a single call into C per request line, (a few times
+# faster than the several calls of doing it by hand), and it reads a
+# memoryview of the packet as readily as bytes, without copying it.
+REQUEST_LINE_RE = re.compile(
+    rb"(?:" + b"|".join(METHODS) + rb") "
+    rb"(?=\S)[^\s/]*(?:/([^\s/]*)/)?\S* "
+    rb"HTTP/\d\.\d")
+
+# The section names seen so far, from their bytes, so every request to the
+# same section gets the same string instead of decoding a new one
+SECTIONS = {}
+
+# Clients can make up as many sections as they like, so the interned names
+# are thrown away and started again past this many
+MAX_SECTIONS = 65536
+
+
+def section_name(request):
+    """
+    @param request: a match of REQUEST_LINE_RE
+    @return: the request's section, like '/foo' for /foo/index.html, or '/'
+    for /index.html
+    """
+    if request.lastindex is None:
+        # this is the form /index.html
+        return '/'
+    # this is the form /foo/index.html
+    key = request.group(1)
+    section = SECTIONS.get(key)
+    if section is None:
+        if len(SECTIONS) >= MAX_SECTIONS:
+            SECTIONS.clear()
+        section = '/' + key.decode('utf-8', 'replace')
+        SECTIONS[key] = section
+    return section
+
+
+def parse_request_line(data, start=0):
+    """
+    Parses the request line starting at data[start], without needing its
+    line ending.
+
+    @param data: a bytes-like object
+    @param start: where the request line would start
+    @return: (section, end), with end just past the HTTP version, or None
+    if there's no (complete) request line there
+    """
+    if start >= len(data) or data[start] not in METHOD_FIRST_BYTES:
+        return None
+    request = REQUEST_LINE_RE.match(data, start)
+    if request is None:
+        return None
+    return section_name(request), request.end()
+
+
+def find_request_section(payload):
+    """
+    Finds the request at the start of a single packet's payload, on its own,
+    without any reassembly, (which is what finds the pipelined ones).
+
+    @param payload: a bytes-like object, like a memoryview of the packet
+    @return: the request's section name, or None if it doesn't start with a
+    request line
+    """
+    if not payload or payload[0] not in METHOD_FIRST_BYTES:
+        return None
+    request = REQUEST_LINE_RE.match(payload)
+    if request is None:
+        return None
+    return section_name(request)
@@ -0,0 +1,291 @@
+import mmap
+import multiprocessing
+import select
+import time
+from struct import pack, pack_into, unpack_from
+
+from sniffers import bpf
+from sniffers import reassembly
+from sniffers.bare_socket_based_sniffer import BareSocketSniffer
+from sniffers.packet_socket import SOL_PACKET, PACKET_RX_RING, \
+    PACKET_VERSION, TPACKET_V3, PACKET_OUTGOING, open_packet_socket, \
+    open_counting_socket, read_packet_statistics, join_fanout
+
+# block_status values
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket3_hdr is 48 bytes, and the struct sockaddr_ll for the frame
+# follows at TPACKET_ALIGN(48). sll_pkttype is 10 bytes into the sockaddr_ll.
+TPACKET3_HDRLEN = 48
+SLL_PKTTYPE_OFFSET = TPACKET3_HDRLEN + 10
+
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1
+# which begins with block_status, num_pkts, offset_to_first_pkt
+BLOCK_STATUS_OFFSET = 8
+BLOCK_NUM_PKTS_OFFSET = 12
+
+# The first 8 fields of struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec,
+# tp_snaplen, tp_len, tp_status, tp_mac, tp_net
+TPACKET3_HDR_FORMAT = '=IIIIIIHH'
+
+
+def take_block(ring, block_index, block_size):
+    """
+    @param ring: a memoryview over the ring, (or any writable buffer laid out
+    like one)
+    @param block_index: which block
+    @param block_size: the size of each block, in bytes
+    @return: a memoryview of the block if the kernel has handed it over to
+    us, otherwise None
+    """
+    offset = block_index * block_size
+    block = ring[offset:offset + block_size]
+    if unpack_from('=I', block, BLOCK_STATUS_OFFSET)[0] & TP_STATUS_USER:
+        return block
+    # The kernel still owns this block
+    block.release()
+    return None
+
+
+def return_block(block):
+    """
+    Gives a block back to the kernel, to fill again, and releases our view of
+    it
+    @param block: a memoryview from take_block()
+    @return: None
+    """
+    pack_into('=I', block, BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+    block.release()
+
+
+def block_frames(block):
+    """
+    Walks the frames of a block the kernel has handed over, following each
+    frame's tp_next_offset from the block's offset_to_first_pkt.
+
+    @param block: a memoryview of the block
+    @return: a generator of (arrival time, packet) tuples, the packet being a
+    memoryview of the block from the IP header for tp_snaplen bytes. The
+    frames of packets this host sent are skipped.
+    """
+    num_pkts, frame_offset = unpack_from('=II', block, BLOCK_NUM_PKTS_OFFSET)
+    for _ in range(num_pkts):
+        next_offset, sec, nsec, snaplen, _, _, _, net = \
+            unpack_from(TPACKET3_HDR_FORMAT, block, frame_offset)
+
+        if block[frame_offset + SLL_PKTTYPE_OFFSET] != PACKET_OUTGOING:
+            packet_start = frame_offset + net
+            # The kernel timestamped the packet on arrival, which is more
+            # accurate than anything we could do here.
+            yield (sec + nsec / 1e9,
+                   block[packet_start:packet_start + snaplen])
+
+        frame_offset += next_offset
+
+
+class MmapRingSniffer(BareSocketSniffer):
+    """
+    A packet sniffer built on a memory-mapped TPACKET_V3 receive ring.
+
+    The bare socket sniffer makes a recvfrom() call, and a fresh bytes copy,
+    for every single packet. Here the kernel writes packets straight into a
+    ring of blocks shared with this process, and hands over a whole block at
+    a time. The frames in a block are then walked with memoryview slices, so
+    on a busy box there's one poll() per block instead of one syscall per
+    packet, and no copying at all for packets that get filtered out.
+
+    The packet parsing is the same as BareSocketSniffer's. Linux only.
+    """
+
+    # The ring is block_count blocks of block_size bytes each. block_size
+    # has to be a multiple of the page size, and every frame (snaplen plus
+    # headers) has to fit into one block.
+    block_size = 1 << 20
+    block_count = 32
+    frame_size = 2048
+
+    # How long the kernel waits, in ms, before handing over a block that
+    # isn't full yet. This is the worst case latency on a quiet link.
+    block_timeout_ms = 50
+
+    # How often, in seconds, the kernel's ring statistics are read
+    stats_interval = 1
+
+    def __init__(self, kernel_filter=True, filter_stats=False,
+                 fanout_group=None, reassemble=True):
+        """
+        @param kernel_filter: Attach the BPF filter to the ring's socket, see
+        BareSocketSniffer
+        @param filter_stats: Also count the incoming TCP packets the kernel
+        filter threw away, see capture_stats()
+        @param fanout_group: None for a single sniffer process, otherwise the
+        PACKET_FANOUT group id shared by all of the sniffer's workers. Each
+        worker gets a ring of its own.
+        @param reassemble: Follow each connection's byte stream, see
+        BareSocketSniffer
+        """
+        super().__init__(kernel_filter, filter_stats, fanout_group,
+                         reassemble)
+        # The ring counters: packets seen by the socket, packets dropped
+        # because the ring was full and the number of times the queue froze.
+        # These are created here, in the main process, so they're shared
+        # with the sniffer process after it forks and can be shown in the
+        # view.
+        self.ring_stats = multiprocessing.Array('Q', 3)
+
+    def run_sniffer(self, ip, dest_port, queue=None, worker=0):
+        """
+        This is the entry point for this sniffer.
+
+        @param ip: The destination ip to listen for. If this is 'None', all
+        messages to any ips will be logged, (so long as the port number
+        matches)
+        @param dest_port: The port we're interested in
+        @param queue: The queue which sends back packet info to the main process
+        @param worker: When running several workers in a fanout group, this
+        worker's number. Worker 0 does the group-wide bookkeeping.
+        @return: None
+        """
+        s = self.open_ring_socket()
+        if self.kernel_filter:
+            bpf.attach_filter(s, bpf.http_request_filter(ip, dest_port))
+        if self.fanout_group is not None:
+            join_fanout(s, self.fanout_group)
+        counting_socket = None
+        if self.filter_stats and worker == 0:
+            counting_socket = open_counting_socket()
+
+        ring_size = self.block_size * self.block_count
+        ring = mmap.mmap(s.fileno(), ring_size, mmap.MAP_SHARED,
+                         mmap.PROT_READ | mmap.PROT_WRITE)
+        poller = select.poll()
+        poller.register(s.fileno(), select.POLLIN | select.POLLERR)
+
+        ring_view = memoryview(ring)
+        try:
+            self.walk_ring(s, ring_view, poller, ip, dest_port, queue,
+                           counting_socket)
+        finally:
+            ring_view.release()
+            ring.close()
+            s.close()
+            if counting_socket:
+                counting_socket.close()
+
+    def open_ring_socket(self):
+        """
+        Creates the AF_PACKET socket and sets up its TPACKET_V3 ring.
+
+        The socket is SOCK_DGRAM, so the kernel strips the link layer header
+        and every frame begins at the IP header, same as the bare socket
+        sniffer sees.
+        @return: the socket
+        """
+        s = open_packet_socket()
+        s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        # struct tpacket_req3: block size, block count, frame size,
+        # frame count, block retire timeout, sizeof_priv, feature_req_word
+        frame_count = self.block_size * self.block_count // self.frame_size
+        s.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                     pack('=7I', self.block_size, self.block_count,
+                          self.frame_size, frame_count,
+                          self.block_timeout_ms, 0, 0))
+        return s
+
+    def walk_ring(self, s, ring, poller, ip, dest_port, queue,
+                  counting_socket=None):
+        """
+        Hands each block back and forth with the kernel, forever.
+
+        @param s: the ring's socket
+        @param ring: a memoryview over the mmapped ring
+        @param poller: a select.poll registered on the socket
+        @param ip: the destination ip filter, or None
+        @param dest_port: the destination port filter
+        @param queue: The queue which sends back packet info to the main process
+        @param counting_socket: the socket counting all incoming TCP packets
+        if filter_stats is on, otherwise None
+        @return: None
+        """
+        block_index = 0
+        next_stats = time.time() + self.stats_interval
+        if self.reassemble:
+            self.flow_table = reassembly.FlowTable()
+        next_expiry = time.time() + self.expire_interval
+        while True:
+            block = take_block(ring, block_index, self.block_size)
+            if block is None:
+                # The kernel still owns this block, wait for it
+                poller.poll(self.block_timeout_ms * 2)
+            else:
+                self.walk_block(block, ip, dest_port, queue)
+                return_block(block)
+                block_index = (block_index + 1) % self.block_count
+
+            if time.time() >= next_stats:
+                self.update_ring_stats(s)
+                if counting_socket:
+                    # everything the ring saw came through the filter
+                    self.update_filter_counts(counting_socket, 0)
+                next_stats = time.time() + self.stats_interval
+
+            if time.time() >= next_expiry:
+                self.expire_flows(time.time())
+                next_expiry = time.time() + self.expire_interval
+
+    def walk_block(self, block, ip, dest_port, queue):
+        """
+        Parses every frame in one block handed over by the kernel.
+
+        @param block: a memoryview of the block
+        @param ip: the destination ip filter, or None
+        @param dest_port: the destination port filter
+        @param queue: The queue which sends back packet info to the main process
+        @return: None
+        """
+        for recv_time, packet in block_frames(block):
+            for s_addr, section in self.parse_requests(packet, ip, dest_port,
+                                                       recv_time):
+                if queue:
+                    queue.put({'time': recv_time,
+                               'src_ip': s_addr,
+                               'path': section})
+                else:
+                    print(f'{s_addr} {section}')
+
+    def update_ring_stats(self, s):
+        """
+        Reads the kernel's PACKET_STATISTICS for the ring and adds them to
+        the running totals. The kernel resets its counters on every read.
+
+        @param s: the ring's socket
+        @return: None
+        """
+        # tp_packets already includes the drops
+        stats = read_packet_statistics(s)
+        with self.ring_stats.get_lock():
+            for i, value in enumerate(stats):
+                self.ring_stats[i] += value
+
+    def capture_stats(self):
+        """
+        The ring's running totals, safe to call from the main process.
+        @return: a dict with the 'packets' seen, the 'drops' because the ring
+        was full, and the 'freezes' of the ring's queue. With filter_stats on
+        it also has the incoming TCP packets the kernel 'filtered' out.
+        """
+        with self.ring_stats.get_lock():
+            packets, drops, freezes = self.ring_stats[:]
+        stats = {'packets': packets, 'drops': drops, 'freezes': freezes}
+        if self.filter_stats:
+            with self.filter_counts.get_lock():
+                seen = self.filter_counts[1]
+            stats['filtered'] = max(seen - packets, 0)
+        return stats
+
+
+# For testing purposes, this may be started by itself
+if __name__ == '__main__':
+    sniffer = MmapRingSniffer()
+    sniffer.run_sniffer(ip=None, dest_port=5000)
@@ -0,0 +1,94 @@
+import socket
+from struct import pack, unpack_from
+
+from sniffers import bpf
+
+"""
+    Helpers for linux AF_PACKET sockets, shared by the sniffers that use them.
+"""
+
+# Constants from linux/if_packet.h and linux/if_ether.h. Python's socket
+# module doesn't export most of these, so they live here.
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_FANOUT = 18
+TPACKET_V3 = 2
+ETH_P_IP = 0x0800
+
+# sll_pkttype value for packets this host is sending. On the loopback every
+# packet shows up twice, once going out and once coming in, so the outgoing
+# copy is skipped to avoid double counting.
+PACKET_OUTGOING = 4
+
+# PACKET_FANOUT modes and flags. Hashing spreads packets over the group by
+# flow, so every packet of a TCP connection goes to the same socket, and
+# the defrag flag reassembles IP fragments first so they hash the same way.
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
+
+def open_packet_socket():
+    """
+    Opens a SOCK_DGRAM AF_PACKET socket for IPv4. The kernel strips the link
+    layer header, so every packet read begins at the IP header, same as the
+    bare raw socket sees.
+    @return: the socket
+    """
+    try:
+        return socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM,
+                             socket.htons(ETH_P_IP))
+    except socket.error as e:
+        print(f'Problem creating the socket, permissions? Error {e}')
+        raise e
+
+
+def join_fanout(s, group_id):
+    """
+    Joins a socket to a PACKET_FANOUT group. The kernel then splits the
+    packets between all of the group's sockets, by flow, instead of handing
+    a copy of every packet to each of them.
+
+    @param s: an AF_PACKET socket
+    @param group_id: a 16 bit number, the same for every socket in the group
+    @return: None
+    """
+    fanout_type = PACKET_FANOUT_HASH | PACKET_FANOUT_FLAG_DEFRAG
+    # packed by hand, the defrag flag puts it out of the range of the signed
+    # int python would otherwise pass
+    s.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                 pack('=I', (group_id & 0xffff) | (fanout_type << 16)))
+
+
+def read_packet_statistics(s):
+    """
+    Reads PACKET_STATISTICS from an AF_PACKET socket. The kernel resets its
+    counters on every read, so callers keep their own running totals.
+
+    @param s: the socket
+    @return: (packets, drops, freezes). packets includes the drops, and
+    freezes is only ever non-zero for TPACKET_V3 rings.
+    """
+    # struct tpacket_stats_v3 is tp_packets, tp_drops, tp_freeze_q_cnt. For
+    # sockets without a V3 ring the kernel only fills in the first two.
+    stats = s.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12)
+    stats = stats + bytes(12 - len(stats))
+    return unpack_from('=3I', stats)
+
+
+def open_counting_socket():
+    """
+    Opens a socket that counts every incoming TCP packet on the box, for
+    comparing against what a sniffer's kernel filter lets through.
+
+    Nothing ever reads from it. Its filter truncates the packets to a byte
+    and its receive buffer is as small as the kernel allows, so the packets
+    are simply dropped once it's full. Dropped packets are still counted in
+    its PACKET_STATISTICS, which is all we want from it.
+    @return: the socket
+    """
+    s = open_packet_socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0)
+    bpf.attach_filter(s, bpf.tcp_counter_filter())
+    return s
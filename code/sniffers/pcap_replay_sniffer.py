@@ -0,0 +1,386 @@
+import mmap
+import multiprocessing
+import os
+import time
+from struct import unpack_from
+
+from sniffers import reassembly
+from sniffers.bare_socket_based_sniffer import BareSocketSniffer
+
+"""
+    Reading packets back out of capture files, (tcpdump's classic pcap, and
+    pcapng), instead of off the network.
+"""
+
+# The classic pcap magic numbers, for microsecond and nanosecond timestamps
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+
+# pcapng block types
+PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+# pcapng interface description options
+PCAPNG_OPT_END = 0
+PCAPNG_IF_TSRESOL = 9
+PCAPNG_IF_TSOFFSET = 14
+
+# The link layer types, (see https://www.tcpdump.org/linktypes.html), and
+# where the IP header starts in each
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+# BSD loopback headers hold the address family, AF_INET is 2 everywhere
+AF_INET = 2
+
+# the TCP header without any options
+MIN_TCP_HEADER = 20
+
+
+class CaptureFormatError(ValueError):
+    """
+    The file isn't a capture file, or it's broken
+    """
+
+
+def ip_packet(link_type, frame):
+    """
+    Finds the IPv4 packet in a captured frame
+    @param link_type: the capture's LINKTYPE_ value
+    @param frame: a memoryview of the frame
+    @return: a memoryview starting at the IP header, or None if it isn't
+    IPv4 or the link type isn't one we know
+    """
+    if link_type == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = int.from_bytes(frame[offset:offset + 2], 'big')
+        # skip over any VLAN tags
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            ethertype = int.from_bytes(frame[offset:offset + 2], 'big')
+        if ethertype != ETHERTYPE_IPV4:
+            return None
+        return frame[offset + 2:]
+    if link_type == LINKTYPE_LINUX_SLL:
+        if int.from_bytes(frame[14:16], 'big') != ETHERTYPE_IPV4:
+            return None
+        return frame[16:]
+    if link_type == LINKTYPE_LINUX_SLL2:
+        if int.from_bytes(frame[0:2], 'big') != ETHERTYPE_IPV4:
+            return None
+        return frame[20:]
+    if link_type in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # the family's in the capturing host's byte order for NULL
+        family = frame[0:4]
+        if int.from_bytes(family, 'little') != AF_INET and \
+                int.from_bytes(family, 'big') != AF_INET:
+            return None
+        return frame[4:]
+    if link_type in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        if not len(frame) or frame[0] >> 4 != 4:
+            return None
+        return frame
+    return None
+
+
+def has_tcp_header(packet):
+    """
+    @param packet: a memoryview starting at the IP header
+    @return: whether enough of the packet was captured to hold the IP header
+    and a TCP header, (a capture with a small snaplen cuts them short)
+    """
+    return len(packet) >= 20 and \
+        len(packet) >= (packet[0] & 0xf) * 4 + MIN_TCP_HEADER
+
+
+def check_capture_file(path):
+    """
+    Checks a file looks like a capture file before it's replayed, so a
+    mistake shows up straight away rather than in the replay process
+    @param path: the file
+    @return: None
+    @raise CaptureFormatError: if it doesn't start with a pcap or pcapng
+    magic number
+    @raise OSError: if it can't be read
+    """
+    with open(path, 'rb') as capture:
+        start = capture.read(4)
+    if len(start) < 4:
+        raise CaptureFormatError(f"{path} is too short to be a capture file")
+    magics = (PCAP_MAGIC_US, PCAP_MAGIC_NS, PCAPNG_SECTION_HEADER)
+    if int.from_bytes(start, 'little') not in magics and \
+            int.from_bytes(start, 'big') not in magics:
+        raise CaptureFormatError(f"{path} isn't a pcap or pcapng file")
+
+
+def read_capture(data):
+    """
+    Walks the packets in a capture file, classic pcap or pcapng, whichever
+    it turns out to be.
+    @param data: a memoryview of the whole file
+    @return: a generator of (timestamp, link type, frame, position), with
+    the frame a memoryview into data, and position how far into the file
+    the packet ends
+    """
+    if len(data) < 4:
+        raise CaptureFormatError("Too short to be a capture file")
+    if unpack_from('=I', data)[0] == PCAPNG_SECTION_HEADER:
+        return read_pcapng(data)
+    return read_pcap(data)
+
+
+def read_pcap(data):
+    """
+    Walks the packets in a classic pcap file
+    @param data: a memoryview of the whole file
+    @return: a generator of (timestamp, link type, frame, position)
+    """
+    for order in '<>':
+        magic = unpack_from(order + 'I', data)[0]
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            break
+    else:
+        raise CaptureFormatError("Not a pcap or pcapng file")
+    fraction = 1e-6 if magic == PCAP_MAGIC_US else 1e-9
+    if len(data) < 24:
+        raise CaptureFormatError("Truncated pcap file header")
+    # the link type's in the low 16 bits, the rest are FCS flags
+    link_type = unpack_from(order + 'I', data, 20)[0] & 0xffff
+
+    record_header = order + 'IIII'
+    offset = 24
+    end = len(data)
+    while offset + 16 <= end:
+        seconds, fractions, captured, _ = unpack_from(record_header, data,
+                                                      offset)
+        offset += 16
+        if offset + captured > end:
+            # the capture was cut off part way through a packet
+            return
+        offset += captured
+        yield (seconds + fractions * fraction, link_type,
+               data[offset - captured:offset], offset)
+
+
+def read_pcapng(data):
+    """
+    Walks the packets in a pcapng file. Only enhanced packet blocks are
+    read, the simple and obsolete packet blocks have no timestamps.
+    @param data: a memoryview of the whole file
+    @return: a generator of (timestamp, link type, frame, position)
+    """
+    order = '<'
+    # for each interface in the current section: (link type, timestamp units
+    # per second, seconds to add)
+    interfaces = []
+    offset = 0
+    end = len(data)
+    while offset + 12 <= end:
+        block_type = unpack_from(order + 'I', data, offset)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # each section sets its own byte order, and its own interfaces
+            for order in '<>':
+                if unpack_from(order + 'I', data, offset + 8)[0] == \
+                        PCAPNG_BYTE_ORDER_MAGIC:
+                    break
+            else:
+                raise CaptureFormatError("Bad pcapng byte order magic")
+            interfaces = []
+        length = unpack_from(order + 'I', data, offset + 4)[0]
+        if length < 12 or offset + length > end:
+            # cut off part way through a block
+            return
+        body = offset + 8
+
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            link_type = unpack_from(order + 'H', data, body)[0]
+            units, ts_offset = read_interface_options(
+                data, order, body + 8, offset + length - 4)
+            interfaces.append((link_type, units, ts_offset))
+        elif block_type == PCAPNG_ENHANCED_PACKET:
+            interface, high, low, captured = unpack_from(order + 'IIII', data,
+                                                         body)
+            if interface < len(interfaces):
+                link_type, units, ts_offset = interfaces[interface]
+                # split into whole seconds first, a nanosecond count is too
+                # big to divide as a float without losing the last digits
+                seconds, fraction = divmod((high << 32) | low, units)
+                timestamp = ts_offset + seconds + fraction / units
+                yield (timestamp, link_type,
+                       data[body + 20:body + 20 + captured], offset + length)
+        offset += length
+
+
+def read_interface_options(data, order, offset, end):
+    """
+    Reads the timestamp options of a pcapng interface description block
+    @param data: a memoryview of the whole file
+    @param order: the section's byte order, '<' or '>'
+    @param offset: where the options start
+    @param end: where they end
+    @return: (units, offset), the timestamp units per second, and the
+    seconds to add to every timestamp
+    """
+    units = 10 ** 6
+    ts_offset = 0
+    while offset + 4 <= end:
+        code, length = unpack_from(order + 'HH', data, offset)
+        offset += 4
+        if code == PCAPNG_OPT_END:
+            break
+        if code == PCAPNG_IF_TSRESOL and length >= 1:
+            value = data[offset]
+            # the top bit picks a power of 2 rather than of 10
+            units = 2 ** (value & 0x7f) if value & 0x80 else 10 ** value
+        elif code == PCAPNG_IF_TSOFFSET and length >= 8:
+            ts_offset = unpack_from(order + 'q', data, offset)[0]
+        # options are padded to 32 bits
+        offset += (length + 3) & ~3
+    return units, ts_offset
+
+
+class PcapReplaySniffer(BareSocketSniffer):
+    """
+    A 'sniffer' that reads its packets from a capture file rather than the
+    network, so the same parsing, aggregation and alerts can be run over an
+    old capture, without root, and at whatever speed is wanted.
+
+    The packets go through BareSocketSniffer's parsing, and its reassembly,
+    and the records are stamped with the capture's timestamps rather than
+    the time they were read. See clock.ReplayClock for the main process's
+    side of that.
+
+    The file is mmapped, so a big capture is read straight out of the page
+    cache without copying it.
+    """
+
+    def __init__(self, path, speed=0, reassemble=True):
+        """
+        @param path: the capture file, pcap or pcapng
+        @param speed: how many times faster than real time to replay it,
+        using the capture's timestamps, or 0 for as fast as possible
+        @param reassemble: Follow each connection's byte stream, see
+        BareSocketSniffer
+        """
+        super().__init__(kernel_filter=False, reassemble=reassemble)
+        check_capture_file(path)
+        self.path = path
+        self.speed = speed
+        # Packets read, and the bytes of the file read so far. Created
+        # here, in the main process, so they're shared with the sniffer
+        # process after it forks and can be shown in the view.
+        self.replay_stats = multiprocessing.Array('Q', 2)
+        self.file_size = os.path.getsize(path)
+
+    def run_sniffer(self, ip, dest_port, queue=None, worker=0):
+        """
+        This is the entry point for this sniffer. It returns once the whole
+        file has been replayed.
+
+        @param ip: The destination ip to filter by, or None for any ip
+        @param dest_port: The port we're interested in
+        @param queue: The queue which sends back packet info to the main process
+        @param worker: Unused, there's only ever one replay process
+        @return: None
+        """
+        with open(self.path, 'rb') as capture:
+            with mmap.mmap(capture.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                data = memoryview(mapped)
+                try:
+                    self.replay(data, ip, dest_port, queue)
+                finally:
+                    data.release()
+        if queue:
+            # don't leave the end of the capture sitting in a partial batch
+            queue.flush()
+
+    def replay(self, data, ip, dest_port, queue):
+        """
+        Runs the capture's packets through the parsing, pacing them by
+        their timestamps if there's a speed set.
+
+        @param data: a memoryview of the capture file
+        @param ip: The destination ip to filter by, or None for any ip
+        @param dest_port: The port we're interested in
+        @param queue: The queue which sends back packet info to the main process
+        @return: None
+        """
+        if self.reassemble:
+            self.flow_table = reassembly.FlowTable()
+        first = None
+        started = time.time()
+        next_expiry = None
+        packets = 0
+        # the counters are shared, so they're updated now and then rather
+        # than taking their lock every packet
+        reported = 0
+        next_stats = started + self.stats_interval
+
+        for timestamp, link_type, frame, position in read_capture(data):
+            packets += 1
+            if first is None:
+                first = timestamp
+                next_expiry = timestamp + self.expire_interval
+
+            if self.speed:
+                # wait until it's time for this packet, if we're ahead
+                wait = (timestamp - first) / self.speed - \
+                       (time.time() - started)
+                if wait > 0.001:
+                    time.sleep(wait)
+
+            packet = ip_packet(link_type, frame)
+            if packet is not None and has_tcp_header(packet):
+                for s_addr, section in self.parse_requests(packet, ip,
+                                                           dest_port,
+                                                           timestamp):
+                    if queue:
+                        queue.put({'time': timestamp,
+                                   'src_ip': s_addr,
+                                   'path': section})
+                    else:
+                        print(f'{timestamp:.6f} {s_addr} {section}')
+
+            if timestamp >= next_expiry:
+                self.expire_flows(timestamp)
+                next_expiry = timestamp + self.expire_interval
+
+            if packets & 0x3ff == 0 and time.time() >= next_stats:
+                self.update_replay_stats(packets - reported, position)
+                reported = packets
+                next_stats = time.time() + self.stats_interval
+
+        self.update_replay_stats(packets - reported, self.file_size)
+
+    def update_replay_stats(self, packets, position):
+        """
+        Adds to the shared packet count, and moves the progress along
+        @param packets: the packets read since the last update
+        @param position: how far into the file the replay is
+        @return: None
+        """
+        with self.replay_stats.get_lock():
+            self.replay_stats[0] += packets
+            self.replay_stats[1] = position
+
+    def capture_stats(self):
+        """
+        The replay's progress, safe to call from the main process.
+        @return: a dict with the 'packets' read, and how much of the file
+        has been 'replayed', as a percentage
+        """
+        with self.replay_stats.get_lock():
+            packets, position = self.replay_stats[:]
+        done = 100 * position // self.file_size
+        return {'packets': packets, 'replayed': f'{done}%'}
@@ -0,0 +1,337 @@
+import re
+from collections import OrderedDict
+
+from sniffers import http_parser
+
+"""
+    Finding HTTP request lines in TCP byte streams, rather than one packet
+    at a time, so requests whose request line is split across segments, or
+    several pipelined requests in one segment, are all counted.
+"""
+
+# The end of a line followed by what could be a request line, for finding
+# the next one after losing track of the stream. Starting with the newline,
+# rather than a multiline '^', lets the regex engine skip through the bytes
+# in between several times faster.
+NEXT_REQUEST_RE = re.compile(
+    rb"\n(?=(?:" + b"|".join(http_parser.METHODS) + rb") )")
+
+# The blank line at the end of the headers
+HEADERS_END_RE = re.compile(rb"\n\r?\n")
+
+CONTENT_LENGTH_RE = re.compile(rb"(?:\A|\n)content-length[ \t]*:[ \t]*(\d+)",
+                               re.IGNORECASE)
+
+# Distances in sequence space, which wraps around at 2^32
+SEQUENCE_MOD = 1 << 32
+HALF_SEQUENCE = 1 << 31
+
+
+def find_headers_end(data, position):
+    """
+    @param data: bytes, with the headers of a request starting at position
+    @param position: where the headers start, just after the request line
+    @return: where the blank line ending the headers ends, or None if it
+    hasn't arrived yet
+    """
+    if data.startswith(b'\r\n', position):
+        return position + 2
+    if data.startswith(b'\n', position):
+        return position + 1
+    headers_end = HEADERS_END_RE.search(data, position)
+    return headers_end.end() if headers_end else None
+
+
+def parse_request(data, position):
+    """
+    @param data: bytes
+    @param position: where a request line might start
+    @return: (section, end), with end just past the request line's line
+    ending, or None if there's no complete request line there
+    """
+    request = http_parser.parse_request_line(data, position)
+    if request is not None:
+        section, end = request
+        if data.startswith(b'\r\n', end):
+            return section, end + 2
+        if data.startswith(b'\n', end):
+            return section, end + 1
+    return None
+
+
+class Flow:
+    """
+    What's kept for one direction of one TCP connection: where the stream
+    is up to, the end of the stream that isn't a complete line yet, and any
+    segments that arrived ahead of a gap.
+    """
+    __slots__ = ('next_seq', 'tail', 'mid_line', 'in_headers', 'skip',
+                 'pending', 'pending_bytes', 'last_seen')
+
+    def __init__(self, seq, now):
+        self.next_seq = seq
+        self.tail = b''
+        # True when the start of the tail has been thrown away, so the bytes
+        # up to the next newline aren't the start of a line
+        self.mid_line = False
+        # True between a request line and the blank line after its headers
+        self.in_headers = False
+        # the number of bytes of request body still to come
+        self.skip = 0
+        self.pending = {}
+        self.pending_bytes = 0
+        self.last_seen = now
+
+
+class FlowTable:
+    """
+    A lightweight TCP reassembler, just enough to find every request line
+    in the client to server byte streams.
+
+    Flows are keyed on the (source ip, source port, destination ip,
+    destination port) 4-tuple. Each one holds at most the last partial line,
+    (or partial headers), of its stream, up to max_line bytes, and up to
+    max_pending bytes of segments that arrived ahead of a missing one.
+    Request bodies are skipped over by their Content-Length without being
+    kept. Anything too long to keep is skipped too, and matching picks up
+    again at the next line.
+
+    The table is kept in least recently used order. Flows idle for longer
+    than idle_timeout are dropped, as is the least recently used flow when
+    there are more than max_flows. Flows are also dropped when they're
+    finished, (FIN or RST).
+
+    Flows first seen part way through, (they started before the sniffer did,
+    or were dropped from the table), start from the segment seen, which is
+    taken to begin a line. That's where the old one packet at a time
+    matching looked too.
+    """
+
+    def __init__(self, max_flows=65536, idle_timeout=60, max_line=8192,
+                 max_pending=65536):
+        """
+        @param max_flows: the most flows kept at once
+        @param idle_timeout: in seconds, how long a flow is kept without any
+        traffic
+        @param max_line: the longest partial line kept per flow, in bytes
+        @param max_pending: the most out of order bytes kept per flow
+        """
+        self.max_flows = max_flows
+        self.idle_timeout = idle_timeout
+        self.max_line = max_line
+        self.max_pending = max_pending
+        self.flows = OrderedDict()
+        # running totals, for debugging and tuning
+        self.evictions = 0
+        self.resyncs = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def feed(self, key, seq, payload, now, finished=False):
+        """
+        Adds a segment to its flow.
+
+        @param key: the flow's 4-tuple
+        @param seq: the segment's TCP sequence number
+        @param payload: the segment's payload, a bytes-like object
+        @param now: the time it arrived
+        @param finished: whether the segment has FIN or RST set
+        @return: a list of the sections of the request lines this segment
+        completed
+        """
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = Flow(seq, now)
+            self.flows[key] = flow
+            if len(self.flows) > self.max_flows:
+                self.flows.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.flows.move_to_end(key)
+            flow.last_seen = now
+
+        sections = []
+        ahead = (seq - flow.next_seq) % SEQUENCE_MOD
+        if ahead >= HALF_SEQUENCE:
+            # it starts before where we're up to, a retransmission
+            behind = SEQUENCE_MOD - ahead
+            if behind >= len(payload):
+                if behind > self.max_pending + len(payload):
+                    # too far back to be a retransmission, the 4-tuple's
+                    # been reused for a new connection
+                    self.resync(flow, seq)
+                    sections = self.consume(flow, payload)
+            else:
+                sections = self.consume(flow, payload[behind:])
+        elif ahead == 0:
+            sections = self.consume(flow, payload)
+        elif ahead + len(payload) > self.max_pending:
+            # too big a gap to wait out, start again from here
+            self.resync(flow, seq)
+            sections = self.consume(flow, payload)
+        else:
+            if seq not in flow.pending:
+                flow.pending[seq] = bytes(payload)
+                flow.pending_bytes += len(payload)
+            if flow.pending_bytes > self.max_pending:
+                # give up on the gap, and carry on from the first segment
+                # after it
+                first = min(flow.pending,
+                            key=lambda s: (s - flow.next_seq) % SEQUENCE_MOD)
+                flow.next_seq = first
+                flow.tail = b''
+                flow.in_headers = False
+                flow.skip = 0
+                flow.mid_line = True
+                self.resyncs += 1
+
+        if flow.pending:
+            sections += self.drain(flow)
+        if finished:
+            del self.flows[key]
+        return sections
+
+    def resync(self, flow, seq):
+        """
+        Forgets what a flow held, and starts it again at seq
+        @param flow: the Flow
+        @param seq: the sequence number to start from
+        @return: None
+        """
+        flow.next_seq = seq
+        flow.tail = b''
+        flow.mid_line = False
+        flow.in_headers = False
+        flow.skip = 0
+        flow.pending = {}
+        flow.pending_bytes = 0
+        self.resyncs += 1
+
+    def drain(self, flow):
+        """
+        Consumes the out of order segments that have become in order
+        @param flow: the Flow
+        @return: a list of section names
+        """
+        sections = []
+        while flow.pending:
+            data = flow.pending.pop(flow.next_seq, None)
+            if data is None:
+                # drop anything that's been overtaken entirely
+                stale = [seq for seq, data in flow.pending.items()
+                         if (flow.next_seq - seq) % SEQUENCE_MOD <
+                         HALF_SEQUENCE]
+                if not stale:
+                    break
+                for seq in stale:
+                    data = flow.pending.pop(seq)
+                    flow.pending_bytes -= len(data)
+                    behind = (flow.next_seq - seq) % SEQUENCE_MOD
+                    if behind < len(data):
+                        sections += self.consume(flow, data[behind:])
+                continue
+            flow.pending_bytes -= len(data)
+            sections += self.consume(flow, data)
+        return sections
+
+    def consume(self, flow, payload):
+        """
+        Adds in order bytes to the end of a flow's stream, and finds the
+        request lines they complete.
+
+        It follows the stream a request at a time: the request line, then
+        the headers up to the blank line, then a body of Content-Length
+        bytes, which is skipped over without being kept. Anything else, (a
+        chunked body, or a line too long to keep), is scanned a line at a
+        time for the next request line.
+        @param flow: the Flow
+        @param payload: the next bytes of the stream
+        @return: a list of section names
+        """
+        flow.next_seq = (flow.next_seq + len(payload)) % SEQUENCE_MOD
+        if flow.skip >= len(payload):
+            # all body, so there's no need to even copy it
+            flow.skip -= len(payload)
+            return []
+        data = flow.tail + payload if flow.tail else bytes(payload)
+        flow.tail = b''
+
+        sections = []
+        position = 0
+        end = len(data)
+        while position < end:
+            if flow.skip:
+                skipped = min(flow.skip, end - position)
+                flow.skip -= skipped
+                position += skipped
+            elif flow.in_headers:
+                headers_end = find_headers_end(data, position)
+                if headers_end is None:
+                    self.keep_tail(flow, data, position)
+                    break
+                length = CONTENT_LENGTH_RE.search(data, max(position - 1, 0),
+                                                  headers_end)
+                flow.skip = int(length.group(1)) if length else 0
+                flow.in_headers = False
+                position = headers_end
+            elif flow.mid_line:
+                newline = data.find(b'\n', position)
+                if newline < 0:
+                    break
+                flow.mid_line = False
+                position = newline + 1
+            else:
+                # position is always at the start of a line here, and that's
+                # nearly always where the next request starts
+                request = parse_request(data, position)
+                line_start = position
+                while request is None:
+                    line = NEXT_REQUEST_RE.search(data, line_start)
+                    if line is None:
+                        break
+                    line_start = line.end()
+                    request = parse_request(data, line_start)
+                if request is None:
+                    # keep the last, partial, line for the next segment
+                    self.keep_tail(flow, data,
+                                   max(data.rfind(b'\n', position) + 1,
+                                       position))
+                    break
+                section, position = request
+                sections.append(section)
+                flow.in_headers = True
+        return sections
+
+    def keep_tail(self, flow, data, start):
+        """
+        Holds on to the end of the stream that can't be made sense of yet,
+        (a partial line, or partial headers), unless it's too long
+        @param flow: the Flow
+        @param data: the stream's bytes
+        @param start: where the part to keep starts
+        @return: None
+        """
+        if len(data) - start > self.max_line:
+            # longer than any request line or headers we'd look at, so
+            # give up on it and look for the next line
+            flow.in_headers = False
+            flow.mid_line = True
+        else:
+            flow.tail = data[start:]
+
+    def expire(self, now):
+        """
+        Drops the flows that have been idle for longer than idle_timeout
+        @param now: the current time
+        @return: the number of flows dropped
+        """
+        dropped = 0
+        flows = self.flows
+        while flows:
+            key, flow = next(iter(flows.items()))
+            if now - flow.last_seen < self.idle_timeout:
+                break
+            del flows[key]
+            dropped += 1
+        return dropped
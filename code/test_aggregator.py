@@ -0,0 +1,127 @@
+from unittest import TestCase, mock
+
+from aggregator import TrafficAggregator
+from sketches import SpaceSaving
+
+
+class RecordingLock:
+    """
+    Stands in for the records lock, keeping track of whether it's held
+    """
+    held = False
+    taken = 0
+
+    def __enter__(self):
+        self.held = True
+        self.taken += 1
+
+    def __exit__(self, *exc_info):
+        self.held = False
+
+
+class TestTrafficAggregator(TestCase):
+    """
+    Tests for the per-second buckets and the sliding windows' running sums.
+    Times are made up, so nothing here has to wait.
+    """
+
+    def test_windows_cover_complete_seconds(self):
+        aggregator = TrafficAggregator(retention=60)
+        for t in [100.1, 100.9, 101.5, 102.2, 103.0]:
+            aggregator.add(t, 0)
+
+        # at 103.5 the last complete second is 102
+        self.assertEqual(aggregator.total(1, now=103.5), 1)
+        self.assertEqual(aggregator.total(3, now=103.5), 4)
+        # and a moment later second 103 is complete
+        self.assertEqual(aggregator.total(1, now=104.0), 1)
+        self.assertEqual(aggregator.total(3, now=104.0), 3)
+
+    def test_running_sums_follow_ingest_and_sliding(self):
+        aggregator = TrafficAggregator(retention=60)
+        aggregator.add(100.5, 0)
+        # set the window up before the rest of the traffic arrives
+        self.assertEqual(aggregator.section_counts(10, now=101), {0: 1})
+
+        aggregator.add(105.5, 1)
+        aggregator.add(106.5, 1)
+        self.assertEqual(aggregator.section_counts(10, now=107),
+                         {0: 1, 1: 2})
+        # second 100 slides out of the window
+        self.assertEqual(aggregator.section_counts(10, now=111), {1: 2})
+        self.assertEqual(aggregator.total(10, now=111), 2)
+
+    def test_expired_buckets_leave_the_windows(self):
+        aggregator = TrafficAggregator(retention=60)
+        aggregator.add(100.5, 0)
+        aggregator.add(130.5, 0)
+        self.assertEqual(aggregator.total(60, now=140), 2)
+
+        aggregator.expire_before(120)
+        self.assertEqual(aggregator.total(60, now=140), 1)
+        # and records already older than the buckets kept are ignored
+        aggregator.add(50, 0)
+        self.assertEqual(aggregator.total(60, now=140), 1)
+
+    def test_window_jumping_far_ahead(self):
+        """
+        A window set up before any traffic, (like at a replay's clock of 0),
+        then read far later, still counts the buckets held by then
+        """
+        aggregator = TrafficAggregator(retention=60)
+        self.assertEqual(aggregator.section_counts(10, now=0), {})
+        for second in range(1000, 1021):
+            aggregator.add(second + 0.5, second % 2)
+        self.assertEqual(aggregator.section_counts(10, now=1020.5),
+                         {0: 5, 1: 5})
+        self.assertEqual(aggregator.total(10, now=1020.5), 10)
+
+    def test_ring_reuses_buckets(self):
+        aggregator = TrafficAggregator(retention=5)
+        for second in range(100):
+            aggregator.add(second + 0.5, second % 3)
+        self.assertEqual(aggregator.total(5, now=100), 5)
+        self.assertEqual(aggregator.section_counts(3, now=100),
+                         {0: 1, 1: 1, 2: 1})
+
+    def test_approximate_sections(self):
+        aggregator = TrafficAggregator(retention=60, top_k=4)
+        for second in range(100, 110):
+            aggregator.add(second + 0.1, 0)
+            aggregator.add(second + 0.2, 0)
+            aggregator.add(second + 0.3, 1)
+            # a different one-off section every second
+            aggregator.add(second + 0.4, 100 + second)
+
+        summary = aggregator.section_summary(10, now=110.5)
+        self.assertEqual(summary.total, 40)
+        top = summary.top(2)
+        self.assertEqual([(section, hits) for section, hits, _ in top],
+                         [(0, 20), (1, 10)])
+        self.assertEqual(aggregator.total(10, now=110.5), 40)
+        with self.assertRaises(ValueError):
+            aggregator.section_counts(10, now=110.5)
+
+    def test_summaries_are_merged_outside_the_lock(self):
+        aggregator = TrafficAggregator(retention=60, top_k=4)
+        for second in range(100, 110):
+            aggregator.add(second + 0.5, second % 2)
+        lock = RecordingLock()
+        merged_holding = []
+        merge = SpaceSaving.merge
+
+        def recording_merge(summary, other):
+            merged_holding.append(lock.held)
+            merge(summary, other)
+
+        with mock.patch.object(SpaceSaving, 'merge', recording_merge):
+            summary = aggregator.section_summary(10, now=110.5, lock=lock)
+        self.assertEqual(lock.taken, 1)
+        self.assertEqual(merged_holding, [False] * 10)
+        self.assertEqual(summary.counts, {0: 5, 1: 5})
+        # and the summary's made from copies, which records arriving
+        # afterwards, (late ones), don't change
+        aggregator.add(105.5, 0)
+        self.assertEqual(summary.counts, {0: 5, 1: 5})
+        self.assertEqual(aggregator.section_summary(10, now=110.5).counts,
+                         {0: 6, 1: 5})
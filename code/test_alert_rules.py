@@ -0,0 +1,75 @@
+from contextlib import nullcontext
+from unittest import TestCase
+
+from aggregator import TrafficAggregator
+from alert_rules import AlertEngine, ChangeRule, ClientRule, SectionRule, \
+    TotalRule, parse_rule, rule_from_dict
+from client_stats import ClientStats
+from record_store import RecordStore, ip_to_int
+
+
+class TestAlertRules(TestCase):
+    """
+    Tests the rule parsing, and the engine checking rules against the
+    aggregator's counts. Times are made up, so nothing here has to wait.
+    """
+
+    def make_store(self, rows):
+        store = RecordStore(aggregator=TrafficAggregator(
+            600, clients=ClientStats([10])))
+        store.append_batch(rows)
+        return store
+
+    def test_parse_rule(self):
+        rule = parse_rule("section=/api rate=50 period=60")
+        self.assertIsInstance(rule, SectionRule)
+        self.assertEqual((rule.target, rule.threshold, rule.period,
+                          rule.per_second), ('/api', 50, 60, True))
+
+        rule = parse_rule("client hits=1000")
+        self.assertIsInstance(rule, ClientRule)
+        self.assertEqual((rule.target, rule.per_second, rule.period),
+                         (None, False, 120))
+
+        rule = rule_from_dict({'kind': 'change', 'factor': 3, 'rate': 1,
+                               'period': 30})
+        self.assertIsInstance(rule, ChangeRule)
+        self.assertEqual(rule.windows(), [30, 60])
+
+        for bad in ["section rate=5", "total rate=5 hits=3",
+                    "bogus rate=1", "total rate=1 colour=red", "total 5"]:
+            with self.assertRaises(ValueError):
+                parse_rule(bad)
+
+    def test_engine(self):
+        # steady traffic, 1 a second to /a, with 10.0.0.1 also sending 5 a
+        # second to /api for the last 10 seconds
+        rows = []
+        for second in range(1000, 1060):
+            rows.append((second + 0.1, ip_to_int('10.0.0.2'), '/a'))
+            if second >= 1050:
+                rows += [(second + 0.2 + i / 100, ip_to_int('10.0.0.1'),
+                          '/api') for i in range(5)]
+        store = self.make_store(rows)
+
+        engine = AlertEngine([
+            TotalRule(2, 60),
+            SectionRule(4, 10, target='/api'),
+            SectionRule(4, 10, target='/nothing'),
+            ClientRule(45, 10, per_second=False),
+            ChangeRule(1, 10, factor=3),
+        ])
+        messages = engine.evaluate(store, nullcontext(), now=1060.5)
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(messages[0].startswith(
+            "Section /api traffic generated an alert - hits = 50"))
+        self.assertTrue(messages[1].startswith(
+            "Client 10.0.0.1 generated an alert - hits = 50"))
+        self.assertTrue(messages[2].startswith(
+            "Traffic jump (x3) generated an alert - hits = 60"))
+
+        # and a minute later it's all over
+        engine.evaluate(store, nullcontext(), now=1120.5)
+        self.assertEqual(len(messages), 6)
+        self.assertTrue(all('recovered' in message
+                            for message in list(messages)[3:]))
@@ -0,0 +1,68 @@
+import threading
+import time
+from unittest import TestCase
+
+from analytics import AnalyticsTick
+
+
+class TestAnalyticsTick(TestCase):
+
+    def test_jobs_share_a_tick(self):
+        """
+        The jobs due on a tick all see the same 'now', and their updates
+        are published together. The lock's only held while 'now' is read,
+        the jobs take it themselves.
+        """
+        lock = threading.RLock()
+        published = []
+        seen = []
+        times = iter(range(100, 200))
+        tick = AnalyticsTick(lock, lambda: next(times), published.append)
+
+        def fast(now):
+            # the tick doesn't hold the lock while its jobs run
+            seen.append(('fast', now, lock._is_owned()))
+            return [['FAST', None, now]]
+
+        def slow(now):
+            seen.append(('slow', now, lock._is_owned()))
+            return [['SLOW', None, now]]
+
+        def failing(now):
+            raise RuntimeError("a broken job")
+
+        tick.add(fast)
+        tick.add(slow, every=3)
+        tick.add(failing)
+        with self.assertLogs('analytics', 'ERROR'):
+            for number in range(4):
+                tick.run_once(number)
+
+        self.assertEqual(seen, [('fast', 100, False), ('slow', 100, False),
+                                ('fast', 101, False), ('fast', 102, False),
+                                ('fast', 103, False), ('slow', 103, False)])
+        self.assertEqual(published, [[['FAST', None, 100],
+                                      ['SLOW', None, 100]],
+                                     [['FAST', None, 101]],
+                                     [['FAST', None, 102]],
+                                     [['FAST', None, 103],
+                                      ['SLOW', None, 103]]])
+        self.assertEqual(tick.errors, 4)
+        self.assertEqual(tick.ticks, 4)
+
+    def test_overruns(self):
+        """
+        A tick that runs past the next one's start skips it, and it's
+        counted
+        """
+        tick = AnalyticsTick(threading.RLock(), time.time, lambda _: None,
+                             interval=0.05)
+        durations = iter([0.12, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+        tick.add(lambda now: time.sleep(next(durations, 0)))
+        tick.start()
+        time.sleep(0.4)
+        tick.stop()
+        # the first tick took over two intervals
+        self.assertEqual(tick.overruns, 2)
+        self.assertGreaterEqual(tick.max_duration, 0.12)
+        self.assertEqual(tick.stats()['overruns'], 2)
@@ -0,0 +1,154 @@
+import socket
+from struct import pack, unpack_from
+from unittest import TestCase
+
+from sniffers import bpf
+
+# the sockaddr_ll packet type of a packet arriving for this host
+PACKET_HOST = 0
+
+
+def run_filter(program, packet, pkttype=PACKET_HOST):
+    """
+    Runs an assembled program over a packet, the way the kernel would, for
+    the instructions the filters use
+    @param program: a list of (code, jt, jf, k) tuples
+    @param packet: the packet bytes
+    @param pkttype: the packet type the kernel would load for SKF_AD_PKTTYPE
+    @return: what the program returns, how many bytes of the packet to keep
+    """
+    a = x = 0
+    pc = 0
+    ancillary = bpf.SKF_AD_OFF & 0xffffffff
+    sizes = {bpf.BPF_W: ('!I', 4), bpf.BPF_H: ('!H', 2), bpf.BPF_B: ('!B', 1)}
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        kind = code & 0x07
+        if kind in (bpf.BPF_LD, bpf.BPF_LDX):
+            mode, size = code & 0xe0, code & 0x18
+            if mode == bpf.BPF_MSH:
+                if k >= len(packet):
+                    return 0
+                x = 4 * (packet[k] & 0xf)
+                continue
+            if mode == bpf.BPF_ABS and k >= ancillary:
+                assert k - ancillary == bpf.SKF_AD_PKTTYPE, k
+                a = pkttype
+                continue
+            offset = k + (x if mode == bpf.BPF_IND else 0)
+            form, length = sizes[size]
+            if offset + length > len(packet):
+                # the kernel drops the packet when a load runs off the end
+                return 0
+            a = unpack_from(form, packet, offset)[0]
+        elif kind == bpf.BPF_ALU:
+            operand = x if code & bpf.BPF_X else k
+            operation = code & 0xf0
+            if operation == bpf.BPF_ADD:
+                a = (a + operand) & 0xffffffff
+            elif operation == bpf.BPF_AND:
+                a &= operand
+            elif operation == bpf.BPF_RSH:
+                a >>= operand
+            else:
+                raise AssertionError(f'unexpected ALU operation {code:#x}')
+        elif kind == bpf.BPF_JMP:
+            operand = x if code & bpf.BPF_X else k
+            test = code & 0xf0
+            if test == bpf.BPF_JEQ:
+                taken = a == operand
+            elif test == bpf.BPF_JGT:
+                taken = a > operand
+            elif test == bpf.BPF_JSET:
+                taken = bool(a & operand)
+            else:
+                raise AssertionError(f'unexpected jump {code:#x}')
+            pc += jt if taken else jf
+        elif kind == bpf.BPF_RET:
+            return k
+        elif kind == bpf.BPF_MISC:
+            x = a
+        else:
+            raise AssertionError(f'unexpected instruction {code:#x}')
+
+
+def ip_packet(payload, destination='127.0.0.1', dest_port=8080, protocol=6,
+              fragment=0):
+    tcp = pack('!HHLLBBHHH', 40000, dest_port, 1, 0, 5 << 4, 0x18, 65535,
+               0, 0)
+    return pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0, fragment, 64,
+                protocol, 0, socket.inet_aton('10.0.0.7'),
+                socket.inet_aton(destination)) + tcp + payload
+
+
+class TestAssemble(TestCase):
+
+    def test_labels_resolve_to_jump_offsets(self):
+        program = bpf.assemble([
+            (bpf.BPF_LD | bpf.BPF_B | bpf.BPF_ABS, 0, 0, 9),
+            (bpf.BPF_JMP | bpf.BPF_JEQ | bpf.BPF_K, 'keep', 'drop', 6),
+            (bpf.BPF_RET | bpf.BPF_K, 0, 0, 1),
+            'keep',
+            (bpf.BPF_RET | bpf.BPF_K, 0, 0, bpf.ACCEPT_ALL),
+            'drop',
+            (bpf.BPF_RET | bpf.BPF_K, 0, 0, 0),
+        ])
+        self.assertEqual(len(program), 5)
+        # the offsets count from the instruction after the jump
+        self.assertEqual(program[1][1:3], (1, 2))
+        # and negative constants are stored as unsigned 32 bits
+        program = bpf.assemble([(bpf.BPF_LD | bpf.BPF_W | bpf.BPF_ABS, 0, 0,
+                                 bpf.SKF_AD_OFF)])
+        self.assertEqual(program[0][3], 0xfffff000)
+
+
+class TestHttpRequestFilter(TestCase):
+
+    def setUp(self):
+        self.program = bpf.http_request_filter('127.0.0.1', 8080)
+        self.request = b'GET /foo/index.html HTTP/1.1\r\n\r\n'
+
+    def test_a_request_is_kept(self):
+        self.assertEqual(run_filter(self.program, ip_packet(self.request)),
+                         bpf.ACCEPT_ALL)
+        # any ip, without one to filter on
+        self.assertEqual(run_filter(bpf.http_request_filter(None, 8080),
+                                    ip_packet(self.request, '10.1.1.1')),
+                         bpf.ACCEPT_ALL)
+
+    def test_the_rest_are_dropped(self):
+        for packet in (ip_packet(self.request, destination='10.1.1.1'),
+                       ip_packet(self.request, dest_port=8081),
+                       # UDP
+                       ip_packet(self.request, protocol=17),
+                       # an ack, with no payload
+                       ip_packet(b''),
+                       # the second fragment of a big packet
+                       ip_packet(self.request, fragment=185)):
+            self.assertEqual(run_filter(self.program, packet), 0)
+        # what this host sends
+        self.assertEqual(run_filter(self.program, ip_packet(self.request),
+                                    bpf.PACKET_OUTGOING), 0)
+
+    def test_ip_options_move_the_tcp_header(self):
+        # a 24 byte IP header, with a 4 byte option
+        packet = ip_packet(self.request)
+        packet = bytes([0x46]) + packet[1:20] + bytes(4) + packet[20:]
+        self.assertEqual(run_filter(self.program, packet), bpf.ACCEPT_ALL)
+        # and the port isn't read from where it would be without them
+        moved = ip_packet(self.request, dest_port=8081)
+        moved = bytes([0x46]) + moved[1:20] + pack('!HH', 0, 8080) + \
+            moved[20:]
+        self.assertEqual(run_filter(self.program, moved), 0)
+
+
+class TestTcpCounterFilter(TestCase):
+
+    def test_incoming_tcp_is_counted(self):
+        program = bpf.tcp_counter_filter()
+        # truncated to a byte, since it's only counted
+        self.assertEqual(run_filter(program, ip_packet(b'')), 1)
+        self.assertEqual(run_filter(program, ip_packet(b'', protocol=17)), 0)
+        self.assertEqual(run_filter(program, ip_packet(b''),
+                                    bpf.PACKET_OUTGOING), 0)
@@ -0,0 +1,66 @@
+import random
+import threading
+from collections import Counter
+from unittest import TestCase
+
+from client_stats import ClientStats
+
+
+class TestClientStats(TestCase):
+    """
+    Tests the client windows against exact counts. Times are made up, so
+    nothing here has to wait.
+    """
+
+    def test_top_and_unique_clients(self):
+        rng = random.Random(0)
+        stats = ClientStats([10, 600])
+        exact_10 = Counter()
+        for i in range(60000):
+            t = 1000 + i * 0.01
+            # three busy clients among a spray of one-off ones
+            src_ip = rng.choice([1, 2, 3]) if i % 5 == 0 \
+                else rng.getrandbits(32)
+            stats.add(t, src_ip)
+            if 1590 <= t < 1600:
+                exact_10[src_ip] += 1
+
+        top = stats.top_clients(10, now=1600.5, n=3)
+        self.assertEqual({src_ip for src_ip, _ in top}, {1, 2, 3})
+        for src_ip, hits in top:
+            self.assertGreaterEqual(hits, exact_10[src_ip])
+            self.assertLessEqual(hits, exact_10[src_ip] * 1.05)
+
+        unique = stats.unique_clients(10, now=1600.5)
+        self.assertAlmostEqual(unique, len(exact_10), delta=len(exact_10) * .05)
+        # the long window holds everything, all 600 seconds of it
+        self.assertAlmostEqual(stats.unique_clients(600, now=1600.5),
+                               48003, delta=48003 * .05)
+
+    def test_window_slides(self):
+        stats = ClientStats([10])
+        for second in range(100, 105):
+            stats.add(second + 0.5, 7)
+        self.assertEqual(stats.top_clients(10, now=105), [(7, 5)])
+        # the second still in progress isn't counted
+        stats.add(105.2, 7)
+        self.assertEqual(stats.top_clients(10, now=105.5), [(7, 5)])
+        self.assertEqual(stats.top_clients(10, now=113), [(7, 3)])
+        self.assertEqual(stats.top_clients(10, now=130), [])
+        self.assertEqual(stats.unique_clients(10, now=130), 0)
+
+    def test_reads_copy_the_sketches(self):
+        """
+        Passed the records lock, the reads only hold it while they copy the
+        sketches, so a late record afterwards doesn't change what they got
+        """
+        stats = ClientStats([10])
+        for second in range(100, 105):
+            stats.add(second + 0.5, 7)
+        lock = threading.RLock()
+        top = stats.top_clients(10, now=105.5, lock=lock)
+        stats.add(104.5, 7)
+        self.assertEqual(top, [(7, 5)])
+        self.assertEqual(stats.top_clients(10, now=105.5, lock=lock),
+                         [(7, 6)])
+        self.assertEqual(stats.unique_clients(10, now=105.5, lock=lock), 1)
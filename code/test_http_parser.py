@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from sniffers import http_parser
+from sniffers.http_parser import find_request_section, parse_request_line
+
+
+class TestHttpParser(TestCase):
+    """
+    The request line parser, on payload bytes.
+    """
+
+    def test_request_lines(self):
+        line = b'GET /foo/index.html HTTP/1.1\r\n'
+        self.assertEqual(parse_request_line(line), ('/foo', 28))
+        self.assertEqual(parse_request_line(b'DELETE /index.html HTTP/1.0'),
+                         ('/', 27))
+        self.assertEqual(parse_request_line(b'xxOPTIONS /a/b HTTP/1.1', 2),
+                         ('/a', 23))
+        # not requests, or not all there yet
+        for data in [b'', b'GETS /a/b HTTP/1.1', b'GET /a/b', b'GET  HTTP/1.1',
+                     b'GET /a/b HTTP/1', b'GET /a/b HTTP/x.y', b'HTTP/1.1 200',
+                     b'\xff\xfe\x00\x01']:
+            self.assertIsNone(parse_request_line(data), data)
+
+        # only the section is decoded, and anything that won't decode is
+        # replaced rather than an error
+        self.assertEqual(parse_request_line(b'GET /caf\xc3\xa9/x HTTP/1.1')[0],
+                         '/café')
+        self.assertEqual(parse_request_line(b'GET /\xff/x HTTP/1.1')[0],
+                         '/�')
+
+    def test_sections_are_interned(self):
+        first = parse_request_line(b'GET /shared/1 HTTP/1.1')[0]
+        second = parse_request_line(b'PUT /shared/2 HTTP/1.1')[0]
+        self.assertIs(first, second)
+        self.assertIn(b'shared', http_parser.SECTIONS)
+
+    def test_packets(self):
+        payload = (b'GET /a/1 HTTP/1.1\r\nHost: x\r\n\r\n'
+                   b'GET /b/2 HTTP/1.1\r\nHost: x\r\n\r\n')
+        self.assertEqual(find_request_section(memoryview(payload)), '/a')
+        self.assertIsNone(find_request_section(payload[5:]))
+        self.assertIsNone(find_request_section(memoryview(b'')))
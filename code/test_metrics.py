@@ -0,0 +1,73 @@
+import queue
+import urllib.error
+import urllib.request
+from unittest import TestCase
+
+import traffic_watch
+from aggregator import TrafficAggregator
+from alert_rules import AlertEngine, TotalRule
+from client_stats import ClientStats
+from clock import ReplayClock
+from metrics import MetricsExporter, MetricsText
+from record_store import RecordStore
+from transport import BatchReceiver
+
+
+class TestMetrics(TestCase):
+
+    def test_text_format(self):
+        text = MetricsText()
+        text.add('requests', 'gauge', "Requests", [({}, 5)])
+        text.add('section_requests', 'gauge', "Section requests",
+                 [({'section': '/a"b\\c'}, 2)])
+        self.assertEqual(text.text().decode().splitlines(), [
+            '# HELP requests Requests', '# TYPE requests gauge',
+            'requests 5',
+            '# HELP section_requests Section requests',
+            '# TYPE section_requests gauge',
+            'section_requests{section="/a\\"b\\\\c"} 2'])
+
+    def test_serves_the_last_snapshot(self):
+        exporter = MetricsExporter()
+        address, port = exporter.serve('127.0.0.1', 0)
+        try:
+            exporter.publish(b'requests 1\n')
+            exporter.publish(b'requests 2\n')
+            with urllib.request.urlopen(
+                    f'http://{address}:{port}/metrics') as response:
+                self.assertEqual(response.read(), b'requests 2\n')
+                self.assertTrue(response.headers['Content-Type']
+                                .startswith('text/plain'))
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f'http://{address}:{port}/other')
+        finally:
+            exporter.close()
+
+    def test_collect_metrics(self):
+        store = RecordStore(aggregator=TrafficAggregator(
+            600, clients=ClientStats([600])))
+        store.append_batch([(1000 + i / 10, 0x0a000001, '/api')
+                            for i in range(200)] +
+                           [(1025.5, 0x0a000002, '/home')])
+        engine = AlertEngine([TotalRule(4, 10)])
+        replay_clock = ReplayClock()
+        replay_clock.advance(1026)
+        traffic_watch.clock = replay_clock
+        try:
+            engine.evaluate(store, traffic_watch.lock, 1026)
+            receiver = BatchReceiver(queue.Queue())
+            lines = traffic_watch.collect_metrics(
+                store, engine, receiver).decode().splitlines()
+        finally:
+            traffic_watch.clock = traffic_watch.WallClock()
+        self.assertIn('traffic_watch_requests{window="600s"} 201', lines)
+        self.assertIn('traffic_watch_section_requests{window="10s",'
+                      'section="/api"} 40', lines)
+        self.assertIn('traffic_watch_client_requests{window="600s",'
+                      'client="10.0.0.1"} 200', lines)
+        self.assertIn('traffic_watch_alerts_engaged{rule="total 4/s over '
+                      '10s"} 1', lines)
+        self.assertIn('traffic_watch_alert_hits{rule="total 4/s over 10s",'
+                      'alert="High traffic"} 41', lines)
+        self.assertIn('traffic_watch_pipeline_records_total 0', lines)
+        self.assertIn('traffic_watch_records_stored 201', lines)
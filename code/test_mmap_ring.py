@@ -0,0 +1,108 @@
+import socket
+from struct import pack, pack_into, unpack_from
+from unittest import TestCase
+
+from sniffers import mmap_ring_sniffer
+from sniffers.mmap_ring_sniffer import BLOCK_STATUS_OFFSET, \
+    TP_STATUS_KERNEL, TP_STATUS_USER, MmapRingSniffer, block_frames, \
+    return_block, take_block
+from sniffers.packet_socket import PACKET_OUTGOING
+
+BLOCK_SIZE = 4096
+# where the sockaddr_ll would end, and the packet starts, in each frame
+NET_OFFSET = 80
+# the block descriptor comes before the first frame
+FIRST_FRAME = 48
+
+
+def ip_packet(payload, source='10.0.0.7', dest_port=8080):
+    tcp = pack('!HHLLBBHHH', 40000, dest_port, 1, 0, 5 << 4, 0x18, 65535,
+               0, 0)
+    return pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0, 0, 64, 6, 0,
+                socket.inet_aton(source),
+                socket.inet_aton('127.0.0.1')) + tcp + payload
+
+
+def fill_block(ring, block_index, frames, status=TP_STATUS_USER):
+    """
+    Lays out a block the way the kernel hands one over
+    @param ring: the bytearray standing in for the ring
+    @param block_index: which block
+    @param frames: (seconds, nanoseconds, pkttype, packet) tuples
+    @param status: the block status
+    @return: None
+    """
+    block = block_index * BLOCK_SIZE
+    pack_into('=III', ring, block + BLOCK_STATUS_OFFSET, status, len(frames),
+              FIRST_FRAME)
+    offset = FIRST_FRAME
+    for number, (sec, nsec, pkttype, packet) in enumerate(frames):
+        # frames aren't evenly spaced, each says how far on the next one is
+        next_offset = 0 if number == len(frames) - 1 else \
+            NET_OFFSET + len(packet) + 16 + number * 8
+        pack_into(mmap_ring_sniffer.TPACKET3_HDR_FORMAT, ring, block + offset,
+                  next_offset, sec, nsec, len(packet), len(packet), 0,
+                  NET_OFFSET, NET_OFFSET)
+        ring[block + offset + mmap_ring_sniffer.SLL_PKTTYPE_OFFSET] = pkttype
+        ring[block + offset + NET_OFFSET:
+             block + offset + NET_OFFSET + len(packet)] = packet
+        offset += next_offset
+
+
+class ListQueue(list):
+
+    def put(self, record):
+        self.append(record)
+
+    def __bool__(self):
+        return True
+
+
+class TestMmapRing(TestCase):
+
+    def setUp(self):
+        self.ring = bytearray(BLOCK_SIZE * 2)
+        self.packets = [ip_packet(b'GET /foo/a HTTP/1.1\r\n\r\n'),
+                        ip_packet(b'GET /sent/by/us HTTP/1.1\r\n\r\n'),
+                        ip_packet(b'not a request'),
+                        ip_packet(b'POST /bar HTTP/1.1\r\n\r\n',
+                                  source='10.0.0.8')]
+        fill_block(self.ring, 0, [(100, 500000000, 0, self.packets[0]),
+                                  (101, 0, PACKET_OUTGOING, self.packets[1]),
+                                  (102, 0, 0, self.packets[2]),
+                                  (103, 250000000, 0, self.packets[3])])
+        # the kernel's still filling the second one
+        fill_block(self.ring, 1, [(104, 0, 0, self.packets[0])],
+                   status=TP_STATUS_KERNEL)
+
+    def test_frames_in_a_block(self):
+        block = take_block(memoryview(self.ring), 0, BLOCK_SIZE)
+        frames = [(when, bytes(packet)) for when, packet in
+                  block_frames(block)]
+        # the one this host sent is skipped
+        self.assertEqual(frames, [(100.5, self.packets[0]),
+                                  (102.0, self.packets[2]),
+                                  (103.25, self.packets[3])])
+
+        queue = ListQueue()
+        MmapRingSniffer(reassemble=False).walk_block(block, None, 8080,
+                                                     queue)
+        self.assertEqual(queue, [
+            {'time': 100.5, 'src_ip': '10.0.0.7', 'path': '/foo'},
+            {'time': 103.25, 'src_ip': '10.0.0.8', 'path': '/'}])
+
+    def test_blocks_are_handed_back(self):
+        ring = memoryview(self.ring)
+        self.assertIsNone(take_block(ring, 1, BLOCK_SIZE))
+        block = take_block(ring, 0, BLOCK_SIZE)
+        self.assertIsNotNone(block)
+        return_block(block)
+        self.assertEqual(unpack_from('=I', self.ring, BLOCK_STATUS_OFFSET)[0],
+                         TP_STATUS_KERNEL)
+        self.assertIsNone(take_block(ring, 0, BLOCK_SIZE))
+        # once the kernel hands it over again
+        pack_into('=I', self.ring, BLOCK_SIZE + BLOCK_STATUS_OFFSET,
+                  TP_STATUS_USER)
+        block = take_block(ring, 1, BLOCK_SIZE)
+        self.assertEqual([when for when, _ in block_frames(block)], [104.0])
+        return_block(block)
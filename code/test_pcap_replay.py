@@ -0,0 +1,157 @@
+import os
+import socket
+import tempfile
+import time
+from struct import pack
+from unittest import TestCase
+
+from aggregator import TrafficAggregator
+from alert_rules import AlertEngine, TotalRule
+from clock import ReplayClock
+from record_store import RecordStore
+from sniffers.pcap_replay_sniffer import CaptureFormatError, \
+    PcapReplaySniffer
+from traffic_watch import ingest_replayed
+
+
+class ListQueue(list):
+    """
+    Stands in for the transport's sender
+    """
+
+    def put(self, record):
+        self.append(record)
+
+    def flush(self):
+        pass
+
+    def __bool__(self):
+        return True
+
+
+def stamp(t):
+    return time.strftime('%d %b %H:%M:%S', time.localtime(t))
+
+
+def ip_packet(payload, sport=40000, seq=1, dest_port=8080):
+    tcp = pack('!HHLLBBHHH', sport, dest_port, seq, 0, 5 << 4, 0x18, 65535,
+               0, 0)
+    return pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0, 0, 64, 6, 0,
+                socket.inet_aton('10.0.0.7'),
+                socket.inet_aton('127.0.0.1')) + tcp + payload
+
+
+class TestPcapReplay(TestCase):
+    """
+    Replays capture files written here, byte by byte, in the formats
+    tcpdump and wireshark write.
+    """
+
+    def write(self, data):
+        handle, path = tempfile.mkstemp(suffix='.pcap')
+        with os.fdopen(handle, 'wb') as capture:
+            capture.write(data)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def replay(self, data, speed=0):
+        sniffer = PcapReplaySniffer(self.write(data), speed)
+        queue = ListQueue()
+        sniffer.run_sniffer('127.0.0.1', 8080, queue)
+        return [(record['time'], record['path']) for record in queue], \
+            sniffer.capture_stats()
+
+    def test_pcap(self):
+        ethernet = b'\x00' * 12 + b'\x08\x00'
+        vlan = b'\x00' * 12 + b'\x81\x00\x00\x05\x08\x00'
+        frames = [
+            (1000.25, ethernet + ip_packet(b'GET /a/1 HTTP/1.1\r\n\r\nGET /b')),
+            # padded out by the link layer, which isn't stream data
+            (1000.5, ethernet + ip_packet(b'/2 HTTP/1.1\r\n\r\n', seq=28) +
+             b'\x00' * 6),
+            (1001.0, vlan + ip_packet(b'GET /c/3 HTTP/1.1\r\n\r\n',
+                                      sport=40001)),
+            # IPv6, and another port, are both skipped
+            (1001.5, b'\x00' * 12 + b'\x86\xdd' + bytes(60)),
+            (1002.0, ethernet + ip_packet(b'GET /d/4 HTTP/1.1\r\n\r\n',
+                                          dest_port=9090)),
+        ]
+        data = pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+        for t, frame in frames:
+            data += pack('<IIII', int(t), int(t % 1 * 1e6), len(frame),
+                         len(frame)) + frame
+        found, stats = self.replay(data)
+        self.assertEqual(found, [(1000.25, '/a'), (1000.5, '/b'),
+                                 (1001.0, '/c')])
+        self.assertEqual(stats, {'packets': 5, 'replayed': '100%'})
+
+        # cut off part way through the last packet
+        found, _ = self.replay(data[:-10])
+        self.assertEqual(len(found), 3)
+
+    def test_small_snaplen(self):
+        """
+        A capture taken with a snaplen too small for the headers has its
+        packets skipped, rather than failing part way through
+        """
+        ethernet = b'\x00' * 12 + b'\x08\x00'
+        frames = [ethernet + ip_packet(b'GET /a/1 HTTP/1.1\r\n\r\n'),
+                  ethernet + ip_packet(b'GET /b/2 HTTP/1.1\r\n\r\n',
+                                       sport=40001)]
+        snaplen = 14 + 30
+        data = pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, snaplen, 1)
+        for t, frame in enumerate(frames):
+            data += pack('<IIII', 1000 + t, 0, snaplen, len(frame)) + \
+                frame[:snaplen]
+        found, stats = self.replay(data)
+        self.assertEqual(found, [])
+        self.assertEqual(stats['packets'], 2)
+
+    def test_pcapng(self):
+        # big endian, a linux 'cooked' capture with nanosecond timestamps
+        def block(block_type, body):
+            body += b'\x00' * (-len(body) % 4)
+            return pack('>II', block_type, len(body) + 12) + body + \
+                pack('>I', len(body) + 12)
+
+        options = pack('>HHB3x', 9, 1, 9) + pack('>HH', 0, 0)
+        data = block(0x0a0d0d0a, pack('>IHHq', 0x1a2b3c4d, 1, 0, -1))
+        data += block(1, pack('>HHI', 113, 0, 65535) + options)
+        frame = b'\x00' * 14 + b'\x08\x00' + \
+            ip_packet(b'PUT /x/y HTTP/1.1\r\n\r\n')
+        nanoseconds = 2_000_000_000_500_000_000
+        data += block(6, pack('>IIIII', 0, nanoseconds >> 32,
+                              nanoseconds & 0xffffffff, len(frame),
+                              len(frame)) + frame)
+        found, _ = self.replay(data)
+        self.assertEqual(found, [(2_000_000_000.5, '/x')])
+
+        with self.assertRaises(CaptureFormatError):
+            self.replay(b'not a capture file')
+
+    def test_replayed_alerts(self):
+        """
+        A whole capture arriving in one batch still has its alerts checked at
+        every capture second
+        """
+        store = RecordStore(aggregator=TrafficAggregator(600))
+        engine = AlertEngine([TotalRule(5, 4)])
+        clock = ReplayClock()
+        # 10 requests a second for 10 seconds, then quiet until 30
+        rows = [(1000 + i / 10, 1, '/a') for i in range(100)] + \
+            [(1030.0, 1, '/b')]
+        ingest_replayed(store, rows, engine, clock)
+        self.assertEqual(clock.time(), 1030.0)
+        self.assertEqual(len(engine.msg_deque), 2)
+        fired, recovered = engine.msg_deque
+        # the period's complete seconds first come to 20 hits at 1002, and
+        # come back down under it at 1013
+        self.assertIn('hits = 20', fired)
+        self.assertIn(stamp(1002), fired)
+        self.assertIn('recovered', recovered)
+        self.assertIn(stamp(1013), recovered)
+        self.assertEqual(len(store), 101)
+
+        # the clock doesn't go back for a late record
+        clock.advance(1020.0)
+        self.assertEqual(clock.time(), 1030.0)
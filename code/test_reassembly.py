@@ -0,0 +1,114 @@
+import socket
+from struct import pack
+from unittest import TestCase
+
+from sniffers.bare_socket_based_sniffer import BareSocketSniffer
+from sniffers.reassembly import FlowTable
+
+FLOW = (b'\x7f\x00\x00\x01', 40000, b'\x7f\x00\x00\x01', 8080)
+
+
+class TestFlowTable(TestCase):
+    """
+    Feeds made up TCP segments through the reassembler.
+    """
+
+    def test_split_and_pipelined_requests(self):
+        table = FlowTable()
+        stream = (b'GET /a/1 HTTP/1.1\r\nHost: x\r\n\r\n'
+                  b'GET /b/2 HTTP/1.1\r\nHost: x\r\n\r\n'
+                  b'POST /c HTTP/1.1\r\nContent-Length: 0\r\n\r\n')
+        found = []
+        # cut it up so request lines straddle segments
+        for start in range(0, len(stream), 7):
+            found += table.feed(FLOW, 1000 + start, stream[start:start + 7],
+                                now=0)
+        self.assertEqual(found, ['/a', '/b', '/'])
+
+    def test_out_of_order_and_retransmitted(self):
+        table = FlowTable()
+        opening = b'GET /z HTTP/1.1\r\n\r\n'
+        first = b'GET /a/1 HTTP/1.1\r\n\r\nGET /b'
+        second = b'/2 HTTP/1.1\r\n\r\n'
+        self.assertEqual(table.feed(FLOW, 100 - len(opening), opening,
+                                    now=0), ['/'])
+        # the second segment arrives first, waits for the gap to fill
+        self.assertEqual(table.feed(FLOW, 100 + len(first), second, now=0),
+                         [])
+        self.assertEqual(table.feed(FLOW, 100, first, now=0),
+                         ['/a', '/b'])
+        # a retransmission of either is ignored
+        self.assertEqual(table.feed(FLOW, 100, first, now=0), [])
+        self.assertEqual(table.feed(FLOW, 100 + len(first), second, now=0),
+                         [])
+
+    def test_long_lines_are_skipped(self):
+        table = FlowTable(max_line=64)
+        body = b'x' * 200
+        found = table.feed(FLOW, 0, b'POST /a/1 HTTP/1.1\r\n\r\n' + body,
+                           now=0)
+        found += table.feed(FLOW, 22 + len(body),
+                            b'GET /not/a/line HTTP/1.1\r\nGET /b/2 '
+                            b'HTTP/1.1\r\n', now=0)
+        # the bytes after a skipped line aren't the start of a line
+        self.assertEqual(found, ['/a', '/b'])
+
+    def test_bodies_are_skipped(self):
+        table = FlowTable()
+        # a body without a line ending, and one that looks like a request
+        stream = (b'POST /a/1 HTTP/1.1\r\nContent-Length: 4\r\n\r\n'
+                  b'\x00\x01\x02\x03GET /b/2 HTTP/1.1\r\n\r\n'
+                  b'PUT /c/3 HTTP/1.1\r\ncontent-length:19\r\n\r\n'
+                  b'GET /d/4 HTTP/1.1\r\n'
+                  b'GET /e/5 HTTP/1.1\r\n\r\n')
+        found = []
+        for start in range(0, len(stream), 5):
+            found += table.feed(FLOW, start, stream[start:start + 5], now=0)
+        self.assertEqual(found, ['/a', '/b', '/c', '/e'])
+
+    def test_eviction(self):
+        table = FlowTable(max_flows=2, idle_timeout=10)
+        for port in range(3):
+            table.feed((b'', port, b'', 80), 0, b'GET', now=port)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.evictions, 1)
+        self.assertEqual(table.expire(now=11.5), 1)
+        self.assertEqual(len(table), 1)
+        # and a finished flow goes straight away
+        table.feed((b'', 2, b'', 80), 3, b' /a HTTP/1.1\n', now=12,
+                   finished=True)
+        self.assertEqual(len(table), 0)
+
+
+class TestParseRequests(TestCase):
+    """
+    Runs whole packets through the socket sniffer's parsing.
+    """
+
+    def make_packet(self, seq, payload, dest_port=8080):
+        tcp = pack('!HHLLBBHHH', 40000, dest_port, seq, 0, 5 << 4, 0x18,
+                   65535, 0, 0)
+        ip = pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0,
+                  0, 64, 6, 0, socket.inet_aton('10.0.0.7'),
+                  socket.inet_aton('127.0.0.1'))
+        return ip + tcp + payload
+
+    def test_request_line_split_across_packets(self):
+        first = b'GET /sec'
+        second = b'tion/page HTTP/1.1\r\nHost: x\r\n\r\n'
+        for reassemble, expected in [(True, [('10.0.0.7', '/section')]),
+                                     (False, [])]:
+            sniffer = BareSocketSniffer(reassemble=reassemble)
+            if reassemble:
+                sniffer.flow_table = FlowTable()
+            found = []
+            for seq, payload in [(1, first), (1 + len(first), second)]:
+                packet = memoryview(self.make_packet(seq, payload))
+                found += sniffer.parse_requests(packet, '127.0.0.1', 8080,
+                                                now=0)
+            self.assertEqual(found, expected)
+
+        # binary payloads are just not requests, rather than an error
+        sniffer = BareSocketSniffer(reassemble=False)
+        self.assertEqual(sniffer.parse_requests(
+            self.make_packet(1, b'\xff\xfe\x00GET'), None, 8080, now=0), [])
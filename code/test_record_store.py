@@ -0,0 +1,99 @@
+from unittest import TestCase
+
+import traffic_watch
+from aggregator import TrafficAggregator
+from record_store import RECYCLE_DELAY, RecordStore, ip_to_int
+
+
+class TestRecordStore(TestCase):
+    """
+    Tests for the columnar traffic record store, in particular that the
+    circular columns behave once they've wrapped around.
+    """
+
+    def fill(self, store, times, path='/foo'):
+        store.append_batch((t, ip_to_int('10.0.0.1'), path) for t in times)
+
+    def wrapped_store(self):
+        """
+        A store with 8 slots, holding the times 6 through 11 with the last
+        few wrapped around to the front of the columns
+        """
+        store = RecordStore(capacity=8)
+        self.fill(store, range(8))
+        store.expire_before(6)
+        self.fill(store, range(8, 12))
+        self.assertEqual(store.capacity, 8)
+        return store
+
+    def test_time_lookups_across_the_wrap(self):
+        store = self.wrapped_store()
+        self.assertEqual([r['time'] for r in store], [6, 7, 8, 9, 10, 11])
+        self.assertEqual(store.index_after(5), 0)
+        self.assertEqual(store.index_after(7), 2)
+        self.assertEqual(store.index_after(9.5), 4)
+        self.assertEqual(store.index_after(11), 6)
+
+    def test_expire_across_the_wrap(self):
+        store = self.wrapped_store()
+        self.assertEqual(store.expire_before(9), 3)
+        self.assertEqual([r['time'] for r in store], [9, 10, 11])
+
+    def test_grows_and_keeps_order(self):
+        store = self.wrapped_store()
+        self.fill(store, range(12, 20), path='/bar')
+        self.assertEqual(store.capacity, 16)
+        self.assertEqual([r['time'] for r in store], list(range(6, 20)))
+        self.assertEqual(store[-1], {'time': 19, 'src_ip': '10.0.0.1',
+                                     'path': '/bar'})
+
+    def test_sections_are_interned(self):
+        store = RecordStore()
+        self.fill(store, range(3), path='/foo')
+        self.fill(store, range(3, 5), path='/bar')
+        self.assertEqual(store.section_names, ['/foo', '/bar'])
+        self.assertEqual(list(store.section_ids_between(1, 4)), [0, 0, 1])
+
+    def test_sections_of_expired_records_are_forgotten(self):
+        """
+        A scanner's made up sections are let go as its records expire, so
+        the intern table stays the size of what's held
+        """
+        store = RecordStore(aggregator=TrafficAggregator(60, top_k=5))
+        for second in range(1000, 1300):
+            store.append_batch((second + i / 100, ip_to_int('10.0.0.1'),
+                                f'/scan{second}-{i}' if i % 2 else '/home')
+                               for i in range(100))
+            store.expire_before(second - 60)
+        # the 60 seconds held, and the ids waiting to be handed out again
+        self.assertLessEqual(len(store.section_ids), 61 * 50 + 1)
+        self.assertLessEqual(len(store.section_names),
+                             (61 + RECYCLE_DELAY + 1) * 50 + 1)
+        self.assertEqual(store.section_ids['/home'], 0)
+        # the recycled ids still give the records their own names
+        self.assertEqual(store[-1]['path'], '/scan1299-99')
+        self.assertEqual(store[0]['path'], '/home')
+        self.assertEqual(store[1]['path'], '/scan1239-1')
+        hits = traffic_watch.section_hits(store, 10, 1, now=1300)
+        self.assertEqual(hits[0][:2], ('/home', 500))
+
+    def test_out_of_order_records_are_clamped(self):
+        store = RecordStore()
+        self.fill(store, [5, 4, 6])
+        self.assertEqual([r['time'] for r in store], [5, 5, 6])
+
+    def test_window_is_chunked_snapshot(self):
+        """
+        A window reads its records a chunk at a time, and skips any that
+        were expired after it was made
+        """
+        store = RecordStore()
+        self.fill(store, range(100))
+        window = store.window(49)
+        window.chunk_size = 7
+        self.assertEqual(len(window), 50)
+
+        store.expire_before(60)
+        self.fill(store, range(100, 110))
+        self.assertEqual(list(window.column('times')), list(range(60, 100)))
+        self.assertEqual(next(iter(window))['time'], 99)
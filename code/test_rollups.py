@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+import traffic_watch
+from aggregator import TrafficAggregator
+from record_store import RecordStore
+from rollups import RollupTier, Rollups
+
+
+class TestRollups(TestCase):
+    """
+    Tests for the minute and hour style tiers, shrunk to tens and hundreds
+    of seconds so the made up times stay short.
+    """
+
+    def setUp(self):
+        self.rollups = Rollups([RollupTier(10, 200, 1000),
+                                RollupTier(100, 2000, 1000)])
+        self.aggregator = TrafficAggregator(20, rollups=self.rollups)
+
+    def test_seconds_roll_up_through_the_tiers(self):
+        # a request every second, section 0 on the even ones
+        for second in range(1000, 1250):
+            self.aggregator.add(second + 0.5, second % 2)
+        self.aggregator.roll_up(1250)
+        tens, hundreds = self.rollups.tiers
+        # 1249 waits a couple of seconds for any late records
+        self.assertEqual(tens.totals[tens.bucket_index(1240)], 9)
+        self.assertEqual(tens.totals[tens.bucket_index(1100)], 10)
+        # the hundreds get each ten as the next one starts
+        self.assertEqual(hundreds.totals[hundreds.bucket_index(1100)], 100)
+        # 1200 to 1239, the ten in progress hasn't gone on yet
+        self.assertEqual(hundreds.totals[hundreds.bucket_index(1200)], 40)
+        # the buckets older than the retention, (or the ring), are gone
+        self.assertIsNone(tens.bucket_index(1000))
+        self.assertIsNotNone(hundreds.bucket_index(1000))
+
+        # whole buckets, so at 1250 it's 1160 up to 1249
+        total, summary, seconds = tens.read(100, 1250)
+        self.assertEqual((total, seconds), (89, 90))
+        self.assertEqual(summary.top(), [(0, 45, 0), (1, 44, 0)])
+
+    def test_tier_choice(self):
+        tens, hundreds = self.rollups.tiers
+        self.assertIsNone(self.rollups.tier_for(50))
+        self.assertIs(self.rollups.tier_for(100), tens)
+        self.assertIs(self.rollups.tier_for(200), tens)
+        self.assertIs(self.rollups.tier_for(1000), hundreds)
+        self.assertIsNone(self.rollups.tier_for(5000))
+        with self.assertRaises(ValueError):
+            self.aggregator.rollup_window(5000, 2000)
+
+    def test_late_records_and_short_windows(self):
+        for t in (1000.5, 1001.5, 1002.5, 1003.5):
+            self.aggregator.add(t, 0)
+        self.aggregator.roll_up(1010)
+        self.aggregator.add(1001.7, 1)
+        tens = self.rollups.tiers[0]
+        self.assertEqual(tens.totals[tens.bucket_index(1000)], 5)
+        # too short for the tiers, so it's read from the seconds
+        total, summary, seconds = self.aggregator.rollup_window(5, 1004)
+        self.assertEqual((total, seconds), (5, 5))
+        self.assertEqual(summary.top(1), [(0, 4, 0)])
+
+    def test_long_term_section_hits(self):
+        store = RecordStore(aggregator=self.aggregator)
+        store.append_batch([(1000 + i / 2, 0, f'/s{i % 3 // 2}')
+                            for i in range(400)])
+        self.aggregator.roll_up(1200)
+        hits, rate = traffic_watch.long_term_section_hits(store, 150,
+                                                          now=1200)
+        # the tens from 1060, up to the rolled up 1198
+        self.assertEqual(hits, [('/s0', 186, 0), ('/s1', 92, 0)])
+        self.assertAlmostEqual(rate, 278 / 140)
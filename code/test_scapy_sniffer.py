@@ -0,0 +1,60 @@
+import socket
+from struct import pack
+from unittest import TestCase
+
+from sniffers import bpf
+from sniffers.scapy_based_sniffer import ScapySniffer
+
+
+def ether_frame(payload, source='10.0.0.7', dest_port=8080):
+    tcp = pack('!HHLLBBHHH', 40000, dest_port, 1, 0, 5 << 4, 0x18, 65535,
+               0, 0)
+    ip = pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0, 0, 64, 6, 0,
+              socket.inet_aton(source), socket.inet_aton('127.0.0.1'))
+    return bytes(12) + pack('!H', 0x0800) + ip + tcp + payload
+
+
+class TestScapyFastMode(TestCase):
+
+    def test_only_requests_are_found(self):
+        frames = [
+            (ether_frame(b'GET /foo/index.html HTTP/1.1\r\nHost: a\r\n\r\n'),
+             1.0),
+            # a body, and the start of a request line with the rest of it
+            # still to come
+            (ether_frame(b'{"GET /foo/ HTTP/1.1": 1}\r\n'), 2.0),
+            (ether_frame(b'POST /bar/baz HT'), 3.0),
+            (ether_frame(b'POST /index.html HTTP/1.0\r\n\r\n',
+                         source='10.0.0.8'), 4.0),
+        ]
+        records = ScapySniffer(fast=True).requests_in(frames)
+        self.assertEqual(records, [
+            {'time': 1.0, 'src_ip': '10.0.0.7', 'path': '/foo'},
+            {'time': 4.0, 'src_ip': '10.0.0.8', 'path': '/'}])
+
+    def test_paths_that_are_not_utf8(self):
+        frames = [(ether_frame(b'GET /\xff\xfe/x HTTP/1.1\r\n\r\n'), 1.0),
+                  (ether_frame(b'GET /foo/\xff HTTP/1.1\r\n\r\n'), 2.0)]
+        records = ScapySniffer(fast=True).requests_in(frames)
+        self.assertEqual([record['path'] for record in records],
+                         ['/\ufffd\ufffd', '/foo'])
+
+    def test_filter_past_the_ethernet_header(self):
+        plain = bpf.http_request_filter('127.0.0.1', 8080)
+        ether = bpf.http_request_filter('127.0.0.1', 8080, 14)
+        # the ethernet type's checked after the outgoing packets are dropped
+        self.assertEqual(ether[2][3], 12)
+        self.assertEqual(ether[3][3], bpf.ETH_P_IP)
+        # and everything else loads from 14 bytes further on
+        loads = (bpf.BPF_LD | bpf.BPF_B | bpf.BPF_ABS,
+                 bpf.BPF_LD | bpf.BPF_H | bpf.BPF_ABS,
+                 bpf.BPF_LD | bpf.BPF_W | bpf.BPF_ABS,
+                 bpf.BPF_LD | bpf.BPF_H | bpf.BPF_IND,
+                 bpf.BPF_LD | bpf.BPF_B | bpf.BPF_IND,
+                 bpf.BPF_LDX | bpf.BPF_B | bpf.BPF_MSH)
+        self.assertEqual(len(ether), len(plain) + 2)
+        for before, after in zip(plain[2:], ether[4:]):
+            if before[0] in loads:
+                self.assertEqual(after[3], before[3] + 14)
+            else:
+                self.assertEqual(after, before)
@@ -0,0 +1,32 @@
+from array import array
+from unittest import TestCase
+
+import section_counter
+
+
+class TestSectionCounter(TestCase):
+    """
+    Tests that the numpy and Counter paths count the same way.
+    """
+
+    def test_numpy_and_counter_agree(self):
+        section_ids = array('I', [2, 0, 2, 1, 2, 0] * 1000)
+        expected = [(2, 3000), (0, 2000), (1, 1000)]
+
+        numpy = section_counter.numpy
+        section_counter.numpy = None
+        try:
+            self.assertEqual(section_counter.count_section_ids(section_ids),
+                             expected)
+        finally:
+            section_counter.numpy = numpy
+        self.assertEqual(section_counter.count_section_ids(section_ids),
+                         expected)
+
+    def test_messages(self):
+        records = [{'path': '/a'}, {'path': '/b'}, {'path': '/a'}]
+        self.assertEqual(section_counter.popularity_messages(
+            section_counter.count_paths(records)),
+            ['/a: 2 hits', '/b: 1 hit'])
+        self.assertEqual(section_counter.popularity_messages([]),
+                         ['No activity'])
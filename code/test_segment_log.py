@@ -0,0 +1,100 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import segment_log
+import traffic_watch
+from segment_log import SegmentLog, SegmentReader, list_segments, query
+
+
+class TestSegmentLog(TestCase):
+    """
+    Tests for the history on disk. Times are made up, so the segments are
+    short, and nothing here has to wait.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = self.directory.name
+
+    def write(self, batches, **kwargs):
+        log = SegmentLog(self.path, **kwargs)
+        for rows in batches:
+            log.append_batch(rows)
+        log.close()
+        return log
+
+    def test_segments_rotate_and_index_the_seconds(self):
+        log = self.write([[(1000.5, 1, '/a'), (1000.7, 2, '/b')],
+                          [(1003.2, 1, '/a'), (1012.0, 3, '/c')]], span=10)
+        self.assertEqual(log.stats()['written'], 4)
+        segments = list_segments(self.path)
+        self.assertEqual([start for start, _ in segments], [1000, 1010])
+
+        reader = SegmentReader(segments[0][1])
+        try:
+            self.assertEqual(reader.count, 3)
+            self.assertEqual([reader.position(second) for second in
+                              (999, 1000, 1001, 1003, 1004, 1010)],
+                             [0, 0, 2, 2, 3, 3])
+        finally:
+            reader.close()
+
+    def test_query(self):
+        rows = [(2000 + i / 4, i % 3, f'/s{i % 2}') for i in range(40)]
+        self.write([rows[:25], rows[25:]], span=4, capacity=6)
+        result = query(self.path, 2001, 2009, step=4, top_n=1)
+        # seconds 2001 to 2008, 4 records each
+        self.assertEqual(result['total'], 32)
+        self.assertEqual(result['steps'], [(2001, 16), (2005, 16)])
+        self.assertEqual(result['peak'], (2001, 4))
+        self.assertEqual(result['sections'], [('/s0', 16, 0)])
+        self.assertEqual(result['clients'][0][1:], (11, 0))
+
+    def test_query_counts_are_bounded(self):
+        # a scanner hitting a new section every time, among the real traffic
+        rows = []
+        for i in range(300):
+            rows.append((6000 + i / 100, 1, '/api'))
+            rows.append((6000 + i / 100, 100 + i, f'/scan{i}'))
+        self.write([rows])
+        result = query(self.path, 6000, 6010, top_n=2, capacity=10)
+        self.assertEqual(result['total'], 600)
+        section, hits, error = result['sections'][0]
+        self.assertEqual(section, '/api')
+        # never under, and over by no more than the error
+        self.assertGreaterEqual(hits, 300)
+        self.assertLessEqual(hits - error, 300)
+        self.assertEqual(result['clients'][0][0], 1)
+        self.assertGreater(result['sections'][1][2], 0)
+
+        lines = traffic_watch.history_report(self.path, 6000, 6010, top_n=2)
+        self.assertIn('  /api 300 hits', lines)
+        lines = [line for line in lines if line.startswith('  /scan')]
+        self.assertEqual(len(lines), 1)
+
+    def test_sections_keep_their_ids_across_restarts(self):
+        self.write([[(3000.0, 1, '/a'), (3000.5, 1, '/b')]], span=10)
+        self.write([[(3020.0, 1, '/b'), (3021.0, 1, '/c')]], span=10)
+        with open(os.path.join(self.path, segment_log.SECTIONS_FILE)) as f:
+            self.assertEqual(f.read().split(), ['/a', '/b', '/c'])
+        result = query(self.path, 3000, 3030)
+        self.assertEqual({section: hits for section, hits, _ in
+                          result['sections']}, {'/a': 1, '/b': 2, '/c': 1})
+
+    def test_retention(self):
+        self.write([[(4000.0, 1, '/a')], [(4100.0, 1, '/a')]], span=10,
+                   retention=50)
+        self.assertEqual([start for start, _ in list_segments(self.path)],
+                         [4100])
+
+    def test_report(self):
+        self.write([[(5000.5, 0x0a000001, '/api'), (5001.5, 0x0a000001,
+                                                     '/api')]])
+        lines = traffic_watch.history_report(self.path, 5000, 5004)
+        self.assertIn('2 Requests, 0.50 Requests / Sec', lines)
+        self.assertIn('  /api 2 hits', lines)
+        self.assertIn('  10.0.0.1 2 hits', lines)
+        self.assertEqual(traffic_watch.parse_history_time('2h', 10000),
+                         2800)
@@ -0,0 +1,103 @@
+import random
+from collections import Counter
+from unittest import TestCase
+
+import section_counter
+from sketches import CountMinSketch, SpaceSaving, mix64
+
+
+class TestSpaceSaving(TestCase):
+    """
+    Checks the Space-Saving summary's bounds hold, against exact counts of
+    a stream with a few heavy hitters buried in lots of one-off items.
+    """
+
+    def make_stream(self, seed, length=20000):
+        rng = random.Random(seed)
+        stream = []
+        for i in range(length):
+            if rng.random() < 0.3:
+                stream.append(f'/heavy{rng.randrange(5)}')
+            else:
+                stream.append(f'/scan{seed}-{i}')
+        return stream
+
+    def assert_bounds(self, summary, exact):
+        for item, count, error in summary.top():
+            self.assertLessEqual(count - error, exact[item])
+            self.assertGreaterEqual(count, exact[item])
+            self.assertLessEqual(error, summary.error_bound())
+        # every item seen more than total / capacity times is in it
+        for item, count in exact.items():
+            if count > summary.total / summary.capacity:
+                self.assertIn(item, summary.counts)
+
+    def test_bounds(self):
+        stream = self.make_stream(0)
+        summary = SpaceSaving(50)
+        for item in stream:
+            summary.add(item)
+
+        self.assertEqual(len(summary), 50)
+        self.assertEqual(summary.total, len(stream))
+        self.assert_bounds(summary, Counter(stream))
+        self.assertEqual({item for item, _, _ in summary.top(5)},
+                         {f'/heavy{i}' for i in range(5)})
+
+    def test_merged_bounds(self):
+        merged = SpaceSaving(50)
+        exact = Counter()
+        for seed in range(10):
+            stream = self.make_stream(seed, length=2000)
+            exact.update(stream)
+            summary = SpaceSaving(50)
+            for item in stream:
+                summary.add(item)
+            merged.merge(summary)
+
+        self.assertEqual(merged.total, sum(exact.values()))
+        self.assert_bounds(merged, exact)
+
+    def test_exact_until_full(self):
+        summary = SpaceSaving(10)
+        for item in ['/a', '/b', '/a']:
+            summary.add(item)
+        other = SpaceSaving(10)
+        other.add('/b', 4)
+        summary.merge(other)
+        self.assertEqual(summary.top(), [('/b', 5, 0), ('/a', 2, 0)])
+
+
+class TestCountMinSketch(TestCase):
+    """
+    Tests that the numpy and plain python paths count the same way.
+    """
+
+    def test_numpy_and_python_agree(self):
+        rng = random.Random(2)
+        hashes = [mix64(rng.getrandbits(32)) for _ in range(500)]
+        counts = [rng.randrange(1, 20) for _ in hashes]
+        # the batch is counted the same as adding the items one at a time
+        expected = CountMinSketch(256, 4)
+        for h, count in zip(hashes, counts):
+            expected.add_hashed(h, count)
+        half = CountMinSketch(256, 4)
+        for h, count in zip(hashes[:250], counts[:250]):
+            half.add_hashed(h, count)
+
+        numpy = section_counter.numpy
+        for loaded in (None, numpy):
+            section_counter.numpy = loaded
+            try:
+                sketch = CountMinSketch(256, 4)
+                sketch.add_many(hashes, counts)
+                self.assertEqual(sketch.table, expected.table)
+                self.assertEqual(sketch.total, expected.total)
+                # and a sketch taken back out leaves the rest
+                sketch.merge(half, sign=-1)
+                for h, count in zip(hashes[250:], counts[250:]):
+                    self.assertGreaterEqual(sketch.estimate_hashed(h), count)
+                sketch.merge(half)
+                self.assertEqual(sketch.table, expected.table)
+            finally:
+                section_counter.numpy = numpy
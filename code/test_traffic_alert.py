@@ -91,3 +91,32 @@ class TestTrafficAlert(TestCase):
         alert.traffic_alert(test_traffic, self.alert_threshold,
                             self.alert_period)
         self.assertFalse(alert.alert_engaged)
+
+    def test_client_alert(self):
+        """
+        This test checks that a single busy client gets an alert of its own,
+        even though the total traffic is under the threshold
+        """
+        alert = TrafficAlert()
+        test_traffic = collections.deque()
+        for i in range(self.alert_threshold * self.alert_period - 1):
+            test_traffic.append({'time': time.time(),
+                                 'src_ip': '10.0.0.1' if i % 2 else
+                                 f'10.0.1.{i}',
+                                 'path': '/'})
+        alert.traffic_alert(test_traffic, self.alert_threshold,
+                            self.alert_period)
+        self.assertFalse(alert.alert_engaged)
+
+        # 10.0.0.1 sent about half the traffic
+        alert.client_alert(test_traffic, self.alert_threshold / 4,
+                           self.alert_period)
+        self.assertEqual(alert.clients_engaged, {'10.0.0.1'})
+        self.assertIn("Client 10.0.0.1 generated an alert",
+                      alert.msg_deque[-1])
+
+        test_traffic.clear()
+        alert.client_alert(test_traffic, self.alert_threshold / 4,
+                           self.alert_period)
+        self.assertEqual(alert.clients_engaged, set())
+        self.assertIn("Client 10.0.0.1 alert recovered", alert.msg_deque[-1])
@@ -0,0 +1,95 @@
+import asyncio
+import random
+from collections import Counter
+from unittest import TestCase
+
+from traffic_generator import LoadGenerator, profile_from_dict
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+class TestLoadProfile(TestCase):
+
+    def test_ramps_and_bursts(self):
+        profile = profile_from_dict({'phases': [
+            {'duration': 10, 'rate': [100, 200]},
+            {'duration': 10, 'rate': 50,
+             'burst': {'every': 5, 'length': 1, 'rate': 1000}}]})
+        self.assertEqual(profile.duration, 20)
+        self.assertEqual(profile.rate(0), 100)
+        self.assertEqual(profile.rate(5), 150)
+        self.assertEqual(profile.rate(10.5), 1000)
+        self.assertEqual(profile.rate(12), 50)
+        self.assertEqual(profile.rate(15.5), 1000)
+        self.assertEqual(profile.rate(20), 0)
+        # 1500 on the ramp, then 8 seconds at 50 and 2 bursting at 1000
+        self.assertAlmostEqual(profile.requests_between(0, 20), 3900)
+        self.assertAlmostEqual(profile.requests_between(9.5, 10.5), 98.75 +
+                               500)
+
+    def test_zipf_sections_and_clients(self):
+        profile = profile_from_dict({
+            'phases': [{'duration': 1, 'rate': 1}],
+            'sections': {'count': 10, 'zipf': 1},
+            'clients': {'count': 3, 'first_ip': '127.0.0.254'}})
+        self.assertEqual(profile.clients,
+                         ['127.0.0.254', '127.0.0.255', '127.0.1.0'])
+        rng = random.Random(0)
+        sections = Counter(profile.pick(rng)[0] for _ in range(30000))
+        # the first section twice as popular as the second, and so on
+        self.assertAlmostEqual(sections['section0'] / sections['section1'],
+                               2, delta=0.2)
+        self.assertAlmostEqual(sections['section0'] / sections['section4'],
+                               5, delta=0.6)
+
+    def test_bad_profiles(self):
+        for spec in ({}, {'phases': []}, {'phases': [{'rate': 5}]},
+                     {'phases': [{'duration': 5, 'rate': -5}]},
+                     {'phases': [{'duration': 5, 'rate': [1, 2, 3]}]},
+                     {'phases': [{'duration': 5, 'rate': 1,
+                                  'burst': {'every': 5}}]},
+                     {'phases': [{'duration': 5, 'rate': 1}], 'sectons': {}}):
+            with self.assertRaises(ValueError):
+                profile_from_dict(spec)
+
+
+class TestLoadGenerator(TestCase):
+
+    def test_sends_the_target_rate(self):
+        """
+        The requests that are due all go out, and are counted in the seconds
+        they were due in
+        """
+        profile = profile_from_dict({'phases': [
+            {'duration': 1, 'rate': 300}, {'duration': 1, 'rate': 100}]})
+        reports = {}
+        paths = []
+
+        async def handle(reader, writer):
+            try:
+                while True:
+                    request = await reader.readuntil(b'\r\n\r\n')
+                    paths.append(request.split()[1])
+                    writer.write(RESPONSE)
+            except asyncio.IncompleteReadError:
+                # the generator closed the connection at the end
+                writer.close()
+
+        async def main():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            generator = LoadGenerator(profile, f'http://127.0.0.1:{port}', 1,
+                                      connections=10, max_in_flight=1000,
+                                      timeout=5, seed=0)
+            await generator.run(lambda second, counts:
+                                reports.setdefault(second, counts))
+            server.close()
+
+        asyncio.run(main())
+        self.assertEqual(reports[0].sent, 300)
+        self.assertEqual(reports[1].sent, 100)
+        self.assertAlmostEqual(reports[0].target, 300, delta=1)
+        self.assertEqual(sum(counts.ok for counts in reports.values()), 400)
+        self.assertEqual(len(paths), 400)
+        self.assertTrue(all(path.startswith(b'/section')
+                            for path in paths))
@@ -0,0 +1,174 @@
+import multiprocessing
+import queue
+import time
+from unittest import TestCase
+
+from record_store import ip_to_int
+from transport import BatchingSender, BatchReceiver, ReorderBuffer, \
+    SharedMemoryRing, SharedMemoryReceiver, OTHER_SECTION
+
+
+class TestReorderBuffer(TestCase):
+    """
+    Tests for putting the records from several sniffer workers back in time
+    order before they reach the windowing code.
+    """
+
+    def test_releases_in_time_order(self):
+        """
+        Records pushed out of order come back out oldest first, once they're
+        older than the slack period.
+        """
+        buffer = ReorderBuffer(slack=1)
+        for t in [10.2, 10.0, 10.5, 10.1]:
+            buffer.push((t, 0, '/'))
+
+        # nothing is old enough yet
+        self.assertEqual(buffer.pop_ready(now=10.9), [])
+
+        ready = buffer.pop_ready(now=11.3)
+        self.assertEqual([r[0] for r in ready], [10.0, 10.1, 10.2])
+        self.assertEqual(len(buffer), 1)
+
+    def test_late_records_keep_timeline_monotonic(self):
+        """
+        A record arriving after newer ones were released is restamped rather
+        than inserted behind them, and counted as late.
+        """
+        buffer = ReorderBuffer(slack=1)
+        buffer.push((20.0, 0, '/'))
+        buffer.pop_ready(now=22)
+
+        buffer.push((19.0, 0, '/'))
+        ready = buffer.pop_ready(now=22)
+
+        self.assertEqual([r[0] for r in ready], [20.0])
+        self.assertEqual(buffer.late, 1)
+
+
+class TestBatching(TestCase):
+    """
+    Tests for the batched transport between the sniffers and the main
+    process. A plain queue.Queue stands in for the multiprocessing one.
+    """
+
+    def test_full_batches_are_sent(self):
+        """
+        A batch goes out as soon as it reaches the batch size, and arrives
+        as rows.
+        """
+        q = queue.Queue()
+        sender = BatchingSender(q, batch_size=3, flush_interval=60)
+        receiver = BatchReceiver(q)
+        for i in range(7):
+            sender.put({'time': i, 'src_ip': '0.0.0.0', 'path': '/foo'})
+
+        self.assertEqual(q.qsize(), 2)
+        records = receiver.get() + receiver.get()
+        self.assertEqual([r[0] for r in records], list(range(6)))
+        self.assertEqual(records[0], (0, ip_to_int('0.0.0.0'), '/foo'))
+        self.assertEqual(receiver.stats()['max batch'], 3)
+
+    def test_partial_batch_is_flushed_when_idle(self):
+        """
+        A partial batch isn't held forever when the traffic stops
+        """
+        q = queue.Queue()
+        sender = BatchingSender(q, batch_size=100, flush_interval=0.05)
+        receiver = BatchReceiver(q)
+        sender.put({'time': time.time(), 'src_ip': '0.0.0.0', 'path': '/'})
+
+        self.assertEqual(len(receiver.get(timeout=1)), 1)
+        self.assertEqual(receiver.stats()['records'], 1)
+
+
+class TestSharedMemoryRing(TestCase):
+    """
+    Tests for the shared memory transport. The producer and consumer sides
+    are exercised from a single process here.
+    """
+
+    def setUp(self):
+        self.ring = SharedMemoryRing(4)
+        self.receiver = SharedMemoryReceiver([self.ring])
+
+    def tearDown(self):
+        self.receiver.close()
+
+    def test_records_round_trip(self):
+        """
+        Records come out as they went in, across the end of the ring
+        """
+        for i in range(10):
+            self.ring.put({'time': float(i), 'src_ip': '10.0.0.1',
+                           'path': f'/s{i % 3}'})
+            records = self.receiver.get(timeout=1)
+            self.assertEqual(records, [(float(i), ip_to_int('10.0.0.1'),
+                                        f'/s{i % 3}')])
+
+    def test_overflow_is_counted_not_blocking(self):
+        """
+        A full ring drops new records and counts them
+        """
+        for i in range(6):
+            self.ring.put({'time': float(i), 'src_ip': '10.0.0.1',
+                           'path': '/'})
+
+        self.assertEqual(self.receiver.stats()['overflows'], 2)
+        records = self.receiver.get(timeout=1)
+        self.assertEqual([r[0] for r in records], [0.0, 1.0, 2.0, 3.0])
+
+    def test_section_ids_are_capped(self):
+        """
+        Past max_sections, new sections share one id, rather than each
+        being announced and kept for good
+        """
+        self.ring.max_sections = 2
+        for i in range(4):
+            self.ring.put({'time': float(i), 'src_ip': '10.0.0.1',
+                           'path': f'/scan{i}'})
+            # the ones with ids still get through under their names
+            self.ring.put({'time': float(i), 'src_ip': '10.0.0.1',
+                           'path': '/scan0'})
+            self.receiver.get(timeout=1)
+        self.ring.put({'time': 4.0, 'src_ip': '10.0.0.1', 'path': '/scan1'})
+        self.ring.put({'time': 5.0, 'src_ip': '10.0.0.1', 'path': '/scan9'})
+        records = self.receiver.get(timeout=1)
+        self.assertEqual([r[2] for r in records], ['/scan1', OTHER_SECTION])
+        self.assertEqual(len(self.ring.sections), 2)
+        self.assertEqual(len(self.ring.section_names), 3)
+        self.assertEqual(self.receiver.stats()['unnamed'], 3)
+
+    def test_empty_ring_times_out(self):
+        with self.assertRaises(queue.Empty):
+            self.receiver.get(timeout=0.01)
+
+    def test_separate_processes(self):
+        """
+        With the producer in another process, every record arrives once and
+        in order, or is counted as an overflow. The consumer used to catch
+        the write index at 0 part way through an update, and read the whole
+        ring over again.
+        """
+        count = 200_000
+        ring = SharedMemoryRing(1024)
+        receiver = SharedMemoryReceiver([ring])
+        self.addCleanup(receiver.close)
+
+        def produce():
+            for i in range(count):
+                ring.put({'time': float(i), 'src_ip': '10.0.0.1',
+                          'path': '/'})
+
+        producer = multiprocessing.get_context('fork').Process(
+            target=produce)
+        producer.start()
+        times = []
+        while producer.is_alive() or ring.depth():
+            try:
+                times += [record[0] for record in receiver.get(timeout=0.1)]
+            except queue.Empty:
+                pass
+        producer.join()
+        self.assertEqual(times, sorted(set(times)))
+        self.assertEqual(len(times) + ring.overflows(), count)
@@ -0,0 +1,83 @@
+import queue
+import re
+import time
+from unittest import TestCase
+
+from screen import Screen
+from view_manager import ViewManager
+
+
+class FakeTerminal:
+    width = 80
+    height = 20
+
+    def move_xy(self, x, y):
+        return f'<{x},{y}>'
+
+    def underline(self, text):
+        return f'_{text}_'
+
+
+class TestScreen(TestCase):
+
+    def setUp(self):
+        self.screen = Screen(FakeTerminal())
+
+    def test_only_changes_are_sent(self):
+        self.screen.write(2, 1, 'Hello world')
+        self.assertEqual(self.screen.render(), '<2,1>Hello world')
+        self.assertEqual(self.screen.render(), '')
+        self.screen.write(2, 1, 'Hello world')
+        self.assertEqual(self.screen.render(), '')
+        # two changes close together go as one run, far apart as two
+        self.screen.write(2, 1, 'Jello World')
+        self.assertEqual(self.screen.render(), '<2,1>Jello W')
+        self.screen.write(2, 1, 'Hello World', width=30)
+        self.screen.write(30, 1, 'x')
+        self.assertEqual(self.screen.render(), '<2,1>H<30,1>x')
+
+    def test_styles_edges_and_bottom_rows(self):
+        self.screen.write(0, 0, 'Alerts:', style='underline')
+        self.screen.write(75, -1, 'cut off here')
+        self.screen.write(0, 25, 'off the screen')
+        self.assertEqual(self.screen.render(), '<0,0>_Alerts:_<75,19>cut o')
+
+
+class TestViewManager(TestCase):
+
+    def test_updates_are_coalesced(self):
+        """
+        Updates waiting on the queue, (each message a tick's list of them),
+        are drawn as one frame, with only the newest for each id
+        """
+        view = ViewManager(FakeTerminal(), frame_rate=1000)
+        view.view_queue = queue.Queue()
+        view.screen.render()
+        for rate in (1, 2, 3):
+            view.view_queue.put([['VW_RATE_1',
+                                  ViewManager.update_request_rate, rate]])
+        view.view_queue.put([['VW_SA_1', ViewManager.update_section_activity,
+                              ['/a 5 hits']],
+                             ['VW_RATE_1', ViewManager.update_request_rate,
+                              4]])
+        frame = view.next_frame(time.monotonic())
+        self.assertIn('4 Requests / Sec', frame)
+        self.assertNotIn('3 Requests', frame)
+        self.assertIn('/a 5 hits', frame)
+        self.assertEqual(len(re.findall('Requests', frame)), 1)
+        self.assertTrue(view.view_queue.empty())
+
+    def test_alerts_stop_above_the_pipeline_line(self):
+        terminal = FakeTerminal()
+        terminal.height = 24
+        view = ViewManager(terminal)
+        view.screen.render()
+        view.update_pipeline_stats({'records': 7}, 'VW_PIPE_1')
+        view.update_traffic_alert([f'alert {i}' for i in range(6)],
+                                  'VW_TFC_1')
+        frame = view.screen.render()
+        # the newest two fit, between the heading and the pipeline line
+        self.assertIn('<4,19>- alert 5', frame)
+        self.assertIn('<4,20>- alert 4', frame)
+        self.assertNotIn('alert 3', frame)
+        self.assertIn('<0,21>Pipeline: records 7', frame)
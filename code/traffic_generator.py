@@ -1,74 +1,647 @@
 import argparse
 import asyncio
+import ipaddress
+import itertools
+import json
+import multiprocessing
+import queue
 import random
 import time
 
 import aiohttp
 
+import raw_injector
+
 """
-    This program sends a number of requests to the local webserver for testing
-    the traffic profiler
+    This program sends requests to the local webserver for testing the
+    traffic profiler.
+
+    It's open loop: requests go out on a schedule worked out from the target
+    rate, whether or not the earlier ones have been answered, over a pool of
+    kept-alive connections, so a slow server shows up as latency and errors
+    rather than as a quietly lower rate. Several processes can share the
+    load for rates one event loop can't manage. Every second it prints the
+    target rate, what was actually sent and answered, and how far short it
+    fell.
+
+    What it sends is described by a profile, a JSON file like:
+
+        {"sections": {"count": 20, "zipf": 1.0},
+         "clients": {"count": 50, "zipf": 0.5, "first_ip": "127.0.1.1"},
+         "phases": [
+            {"duration": 30, "rate": 1000},
+            {"duration": 60, "rate": [1000, 10000]},
+            {"duration": 60, "rate": 2000,
+             "burst": {"every": 10, "length": 2, "rate": 8000}}]}
+
+    See profile_from_dict for the details.
 """
 
-sections = ['foo', 'bar', 'baz', 'spiffy', 'zoom']
+# The original test schedule, which assumes the alert threshold period has
+# been set to one minute: a full minute at the default alert rate, (20 a
+# second), then 100 a second for 20 seconds, which should raise the high
+# traffic alert, then back to 20 a second, which should clear it.
+DEFAULT_PROFILE = {
+    'sections': {'names': ['foo', 'bar', 'baz', 'spiffy', 'zoom']},
+    'phases': [{'duration': 60, 'rate': 20},
+               {'duration': 20, 'rate': 100},
+               {'duration': 60, 'rate': 20}]}
+
+# how often, in seconds, the scheduler wakes up to send what's due
+TICK = 0.002
+
+# the most response times each process keeps for the percentiles
+LATENCY_SAMPLES = 20000
+
+
+def zipf_weights(count, exponent):
+    """
+    @param count: the number of things
+    @param exponent: how skewed the popularity is, 0 for all the same, 1 for
+    the classic Zipf where the second is half as popular as the first
+    @return: a list of weights, most popular first
+    """
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
 
 
-async def fetch(session, url):
+class Phase:
     """
-    A coroutine that simply calls 'get' against a url, and returns the response
-    @param session: The session, previously set up by aiohttp.ClientSession()
-    @param url: The destination url
-    @return: A string of response text
+    A stretch of a profile with a steady or ramping rate, and optional
+    bursts on top
     """
-    async with session.get(url) as response:
-        return await response.text()
 
+    def __init__(self, duration, start_rate, end_rate, burst=None):
+        """
+        @param duration: in seconds
+        @param start_rate: requests per second at the start of the phase
+        @param end_rate: requests per second at the end, the rate ramps
+        linearly between the two
+        @param burst: None, or (every, length, rate): every 'every' seconds,
+        for 'length' seconds, the rate is 'rate' instead
+        """
+        self.duration = duration
+        self.start_rate = start_rate
+        self.end_rate = end_rate
+        self.burst = burst
+
+    def rate(self, t):
+        """
+        @param t: seconds since the start of the phase
+        @return: the target requests per second at that moment
+        """
+        if self.burst:
+            every, length, burst_rate = self.burst
+            if t % every < length:
+                return burst_rate
+        return self.rate_without_burst(t)
+
+    def requests_between(self, a, b):
+        """
+        @param a: seconds since the start of the phase
+        @param b: a later time in the phase
+        @return: the number of requests due between the two, (a fraction)
+        """
+        steady = (self.rate_without_burst(a) + self.rate_without_burst(b)) \
+            / 2 * (b - a)
+        if not self.burst or b <= a:
+            return steady
+        every, length, burst_rate = self.burst
+
+        def burst_time(t):
+            # the time spent in bursts since the start of the phase
+            return t // every * length + min(t % every, length)
+
+        bursting = burst_time(b) - burst_time(a)
+        return steady * (1 - bursting / (b - a)) + burst_rate * bursting
 
-async def do_requests(ip, port, num_requests, quiet):
+    def rate_without_burst(self, t):
+        return self.start_rate + \
+            (self.end_rate - self.start_rate) * t / self.duration
+
+
+class LoadProfile:
+    """
+    What to send, and when
     """
-    Take the number of requests and spin them off to the fetching coroutine
-    @param ip: The destination ip
-    @param port: The destination port
-    @param num_requests: the number of requests to send
+
+    def __init__(self, phases, sections, section_weights, clients,
+                 client_weights):
+        """
+        @param phases: a list of Phases, run one after the other
+        @param sections: the section names to request
+        @param section_weights: how often each section is picked
+        @param clients: the source ips to send from, or [None] for whatever
+        the system picks
+        @param client_weights: how often each client is picked
+        """
+        self.phases = phases
+        self.sections = sections
+        self.section_weights = list(itertools.accumulate(section_weights))
+        self.clients = clients
+        self.client_weights = list(itertools.accumulate(client_weights))
+        self.duration = sum(phase.duration for phase in phases)
+
+    def rate(self, t):
+        """
+        @param t: seconds since the start
+        @return: the target requests per second at that moment, 0 once the
+        profile is over
+        """
+        for phase in self.phases:
+            if t < phase.duration:
+                return phase.rate(t)
+            t -= phase.duration
+        return 0
+
+    def requests_between(self, a, b):
+        """
+        @param a: seconds since the start
+        @param b: a later time
+        @return: the number of requests due between the two, (a fraction)
+        """
+        total = 0
+        for phase in self.phases:
+            if a < phase.duration and b > 0:
+                total += phase.requests_between(max(a, 0),
+                                                min(b, phase.duration))
+            a -= phase.duration
+            b -= phase.duration
+        return total
+
+    def pick(self, rng):
+        """
+        @param rng: a random.Random
+        @return: (section, client) for the next request
+        """
+        section, = rng.choices(self.sections,
+                               cum_weights=self.section_weights)
+        client, = rng.choices(self.clients, cum_weights=self.client_weights)
+        return section, client
+
+
+def rate_from_spec(rate):
+    """
+    @param rate: a number, or a [start, end] pair for a ramp
+    @return: (start, end)
+    """
+    if isinstance(rate, (int, float)):
+        start = end = rate
+    elif isinstance(rate, list) and len(rate) == 2:
+        start, end = rate
+    else:
+        raise ValueError(f"A rate should be a number, or [start, end] for a "
+                         f"ramp, not {rate!r}")
+    if not all(isinstance(value, (int, float)) and value >= 0
+               for value in (start, end)):
+        raise ValueError(f"Rates can't be negative, {rate!r}")
+    return float(start), float(end)
+
+
+def profile_from_dict(spec):
+    """
+    Makes a profile from its description, (see the module docstring for an
+    example).
+
+    'phases' is a list of phases, each with a 'duration' in seconds and a
+    'rate' in requests per second, which is a number, or [start, end] to
+    ramp from one to the other. A phase can also have a 'burst', with
+    'every', 'length' and 'rate': every 'every' seconds, for 'length'
+    seconds, the rate jumps to the burst's rate.
+
+    'sections' is either {"names": [...]} or {"count": n}, (for /section0,
+    /section1...), with an optional 'zipf' exponent for how much more
+    popular the first sections are than the rest, (default 0, all the
+    same).
+
+    'clients' is optional, {"count": n, "first_ip": "127.0.1.1"}, also with
+    an optional 'zipf'. Requests are sent from n consecutive source ips
+    starting at first_ip. Anywhere in 127.0.0.0/8 works when the server is on
+    the loopback address, otherwise the ips have to be ones the box has.
+
+    @param spec: a dict, like the above
+    @return: a LoadProfile
+    """
+    spec = dict(spec)
+    phase_specs = spec.pop('phases', None)
+    if not isinstance(phase_specs, list) or not phase_specs:
+        raise ValueError("A profile needs a list of phases")
+    phases = []
+    for phase_spec in phase_specs:
+        phase_spec = dict(phase_spec)
+        duration = phase_spec.pop('duration', None)
+        if not isinstance(duration, (int, float)) or duration <= 0:
+            raise ValueError("Every phase needs a duration, in seconds")
+        start_rate, end_rate = rate_from_spec(phase_spec.pop('rate', None))
+        burst = phase_spec.pop('burst', None)
+        if burst is not None:
+            burst = dict(burst)
+            try:
+                burst = (float(burst.pop('every')),
+                         float(burst.pop('length')),
+                         rate_from_spec(burst.pop('rate'))[0])
+            except KeyError as e:
+                raise ValueError(f"A burst needs {e}")
+            if burst[0] <= 0:
+                raise ValueError("A burst's 'every' has to be above 0")
+        if phase_spec:
+            raise ValueError(f"Unknown phase settings: "
+                             f"{', '.join(phase_spec)}")
+        phases.append(Phase(float(duration), start_rate, end_rate, burst))
+
+    section_spec = dict(spec.pop('sections', {'count': 10}))
+    section_zipf = float(section_spec.pop('zipf', 0))
+    if 'names' in section_spec:
+        sections = [str(name) for name in section_spec.pop('names')]
+    else:
+        sections = [f'section{i}'
+                    for i in range(int(section_spec.pop('count', 10)))]
+    if not sections:
+        raise ValueError("A profile needs at least one section")
+    if section_spec:
+        raise ValueError(f"Unknown section settings: "
+                         f"{', '.join(section_spec)}")
+
+    client_spec = dict(spec.pop('clients', {}))
+    client_zipf = float(client_spec.pop('zipf', 0))
+    client_count = int(client_spec.pop('count', 0))
+    first_ip = client_spec.pop('first_ip', '127.0.1.1')
+    if client_spec:
+        raise ValueError(f"Unknown client settings: "
+                         f"{', '.join(client_spec)}")
+    if client_count:
+        first_ip = ipaddress.IPv4Address(first_ip)
+        clients = [str(first_ip + i) for i in range(client_count)]
+    else:
+        clients = [None]
+
+    if spec:
+        raise ValueError(f"Unknown profile settings: {', '.join(spec)}")
+    return LoadProfile(phases, sections,
+                       zipf_weights(len(sections), section_zipf), clients,
+                       zipf_weights(len(clients), client_zipf))
+
+
+def load_profile(path):
+    """
+    @param path: a JSON file holding a profile, see profile_from_dict
+    @return: a LoadProfile
+    """
+    with open(path) as profile_file:
+        return profile_from_dict(json.load(profile_file))
+
+
+class Counts:
+    """
+    One process's numbers for one second of the run
+    """
+    __slots__ = ('target', 'sent', 'ok', 'errors', 'skipped')
+
+    def __init__(self):
+        self.target = 0.0
+        self.sent = 0
+        self.ok = 0
+        self.errors = 0
+        self.skipped = 0
+
+
+class LoadGenerator:
+    """
+    Sends one process's share of a profile's requests
+    """
+
+    def __init__(self, profile, url, share, connections, max_in_flight,
+                 timeout, seed):
+        """
+        @param profile: the LoadProfile
+        @param url: the server, like http://127.0.0.1:5000
+        @param share: the fraction of the profile's rate this process sends
+        @param connections: the most connections kept open per source ip
+        @param max_in_flight: the most requests waiting on answers at once.
+        Requests due beyond that are skipped, and counted, rather than
+        queueing up and throwing off the schedule.
+        @param timeout: in seconds, how long to wait for an answer
+        @param seed: for the random number generator
+        """
+        self.profile = profile
+        self.url = url
+        self.share = share
+        self.connections = connections
+        self.max_in_flight = max_in_flight
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.rng = random.Random(seed)
+        self.sessions = {}
+        self.seconds = {}
+        self.start = None
+        self.latencies = []
+        self.answered = 0
+
+    def session(self, client):
+        """
+        @param client: the source ip, or None
+        @return: the session, with its own connection pool, for the client
+        """
+        session = self.sessions.get(client)
+        if session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.connections,
+                local_addr=(client, 0) if client else None)
+            session = aiohttp.ClientSession(connector=connector,
+                                            timeout=self.timeout)
+            self.sessions[client] = session
+        return session
+
+    def counts(self, second):
+        counts = self.seconds.get(second)
+        if counts is None:
+            counts = self.seconds[second] = Counts()
+        return counts
+
+    async def request(self, url, client, due):
+        """
+        Sends one request, and counts how it went, in the second it finished
+        @param url: the url to get
+        @param client: the source ip, or None
+        @param due: when the request was meant to go out, for the latency,
+        (so falling behind shows up in it)
+        @return: None
+        """
+        try:
+            async with self.session(client).get(url) as response:
+                await response.read()
+            ok = response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            ok = False
+        finished = time.perf_counter()
+        counts = self.counts(int(finished - self.start))
+        if ok:
+            counts.ok += 1
+        else:
+            counts.errors += 1
+        latency = finished - due
+        self.answered += 1
+        # a reservoir sample, so long runs don't keep every time
+        if len(self.latencies) < LATENCY_SAMPLES:
+            self.latencies.append(latency)
+        else:
+            slot = self.rng.randrange(self.answered)
+            if slot < LATENCY_SAMPLES:
+                self.latencies[slot] = latency
+
+    async def run(self, report):
+        """
+        Sends the requests as they come due, until the profile ends
+        @param report: called with (second, Counts) once each second of the
+        run is over. The target, sent and skipped counts go with the second
+        the requests were due in, the ok and errors with the second the
+        answers came in.
+        @return: None
+        """
+        loop = asyncio.get_running_loop()
+        profile = self.profile
+        tasks = set()
+        start = self.start = time.perf_counter()
+        last = 0.0
+        # how many requests should have gone out so far, and how many have
+        expected = 0.0
+        scheduled = 0
+        reported = 0
+        while True:
+            now = min(time.perf_counter() - start, profile.duration)
+            due = profile.requests_between(last, now) * self.share
+            # when the event loop is slow a tick can run across the end of a
+            # second, so its target is shared between the two
+            second = int(last)
+            if now > second + 1:
+                before = profile.requests_between(last, second + 1) * \
+                    self.share
+                self.counts(second).target += before
+                self.counts(second + 1).target += due - before
+            else:
+                self.counts(second).target += due
+
+            # a request is due as soon as the expected count passes the
+            # number already sent, so the first goes out straight away,
+            # (give or take the rounding in adding up the expected count)
+            while scheduled < expected + due - 1e-6:
+                # when, in the tick, it was due
+                due_at = last + (now - last) * (scheduled - expected) / due
+                scheduled += 1
+                counts = self.counts(int(due_at))
+                if len(tasks) >= self.max_in_flight:
+                    counts.skipped += 1
+                    continue
+                section, client = profile.pick(self.rng)
+                task = loop.create_task(self.request(
+                    f'{self.url}/{section}/index.html{scheduled}', client,
+                    start + due_at))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                counts.sent += 1
+            expected += due
+            last = now
+
+            while reported < int(now):
+                report(reported, self.seconds.pop(reported, Counts()))
+                reported += 1
+            if now >= profile.duration:
+                break
+            await asyncio.sleep(TICK)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        for second in sorted(self.seconds):
+            report(second, self.seconds[second])
+        self.seconds.clear()
+        for session in self.sessions.values():
+            await session.close()
+
+
+def run_worker(profile, url, share, connections, max_in_flight, timeout,
+               seed, results):
+    """
+    A generator process
+    @param results: a multiprocessing.Queue, for ('second', second, counts)
+    as each second is over, then ('done', latencies) at the end
     @return: None
     """
-    async with aiohttp.ClientSession() as session:
-        for i in range(num_requests):
-            html = await fetch(session,
-                               f'http://{ip}:{port}/{random.choice(sections)}/index.html{i}')
-            if not quiet:
-                print(html)
+    generator = LoadGenerator(profile, url, share, connections,
+                              max_in_flight, timeout, seed)
+
+    def report(second, counts):
+        results.put(('second', second, (counts.target, counts.sent, counts.ok,
+                                        counts.errors, counts.skipped)))
+
+    try:
+        asyncio.run(generator.run(report))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results.put(('done', generator.latencies))
+
+
+def percentile(values, fraction):
+    """
+    @param values: a sorted list
+    @param fraction: 0 to 1
+    @return: the value at that point in the list
+    """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def print_second(second, totals, quiet):
+    target, sent, ok, errors, skipped = totals
+    # rounding can put sent a request over
+    short = max(1 - sent / target, 0) if target else 0
+    if not quiet:
+        print(f'{second:>5}s  target {target:>9.0f}  sent {sent:>8}  '
+              f'ok {ok:>8}  errors {errors:>6}  skipped {skipped:>6}  '
+              f'short {short:>6.1%}', flush=True)
+
+
+def run(profile, url, processes, connections, max_in_flight, timeout,
+        quiet):
+    """
+    Runs a profile, split evenly over a number of processes, printing each
+    second's numbers, and a summary at the end
+    @return: the summary, a dict
+    """
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(
+        target=run_worker,
+        args=(profile, url, 1 / processes, connections, max_in_flight,
+              timeout, seed, results),
+        daemon=True) for seed in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    # each second's numbers are summed as they come in from the processes,
+    # and printed once they all have
+    seconds = {}
+    reports = {}
+    latencies = []
+    done = 0
+    total = [0.0, 0, 0, 0, 0]
+    try:
+        while done < processes:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            if message[0] == 'done':
+                done += 1
+                latencies += message[1]
+                continue
+            _, second, counts = message
+            totals = seconds.setdefault(second, [0.0, 0, 0, 0, 0])
+            for i, value in enumerate(counts):
+                totals[i] += value
+                total[i] += value
+            reports[second] = reports.get(second, 0) + 1
+            if reports[second] == processes:
+                print_second(second, seconds.pop(second), quiet)
+    except KeyboardInterrupt:
+        pass
+    for second in sorted(seconds):
+        print_second(second, seconds[second], quiet)
+    for worker in workers:
+        worker.join(timeout=1)
+
+    target, sent, ok, errors, skipped = total
+    summary = {'target': round(target), 'sent': sent, 'ok': ok,
+               'errors': errors, 'skipped': skipped,
+               'short': max(1 - sent / target, 0) if target else 0,
+               'ok short': max(1 - ok / target, 0) if target else 0}
+    if latencies:
+        latencies.sort()
+        summary.update({f'p{point}_ms': round(
+            percentile(latencies, point / 100) * 1000, 1)
+            for point in (50, 90, 99)})
+    return summary
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='This program sends a number of requests to a predefined' +
-                    'server')
+        description='This program sends requests to a server, at the rates '
+                    'a load profile describes')
     parser.add_argument('--port', '-p', type=int, help="The port to monitor",
                         default=5000)
     parser.add_argument('-ip', type=str,
                         help="(Default: 127.0.0.1) - the ip address to use" + \
                              "for the requests.",
                         default="127.0.0.1")
-    parser.add_argument('--quiet', '-q', action='store_true', help="turn off output")
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help="Only print the summary at the end")
+    parser.add_argument('--profile', type=str,
+                        help="A JSON load profile, see the top of this file. "
+                             "Without one, the functional test's schedule "
+                             "is sent.")
+    parser.add_argument('--rate', type=float,
+                        help="Instead of a profile, send this many requests "
+                             "a second, for --duration seconds")
+    parser.add_argument('--duration', type=float, default=60,
+                        help="In seconds, for --rate")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Generator processes to split the load over. "
+                             "One manages a few thousand requests a second.")
+    parser.add_argument('--connections', type=int, default=100,
+                        help="The most connections each process keeps open "
+                             "per source ip")
+    parser.add_argument('--max-in-flight', type=int, default=10000,
+                        help="The most unanswered requests per process. "
+                             "Requests due beyond that are skipped and "
+                             "counted.")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="In seconds, how long to wait for an answer")
+    parser.add_argument('--raw', action='store_true',
+                        help="Instead of making real requests, write made "
+                             "up request packets straight to the ip, "
+                             "(see raw_injector.py), for rates "
+                             "far past what a server can answer. Needs "
+                             "root.")
+    parser.add_argument('--flows', type=int, default=1000,
+                        help="For --raw, how many TCP flows, (source ip "
+                             "and port pairs), each process spreads its "
+                             "packets over")
 
     args = parser.parse_args()
-    port = args.port
-    ip = args.ip
-    quiet = args.quiet
-
-    loop = asyncio.get_event_loop()
-    # This test profile assumes the threshold_period has been set to one minute
-    # For a full minute send packets at the default request rate limit,
-    # (20 per sec).
-    for i in range(60):
-        loop.run_until_complete(do_requests(ip, port, 20, quiet))
-        time.sleep(1)
-    # then increase the rate to 100 per second for 20 seconds
-    for i in range(20):
-        loop.run_until_complete(do_requests(ip, port, 100, quiet))
-        time.sleep(1)
-    # then reduce the rate back to 20. The high traffic warning should disappear
-    for i in range(60):
-        loop.run_until_complete(do_requests(ip, port, 20, quiet))
-        time.sleep(1)
+    try:
+        if args.rate is not None:
+            if args.profile:
+                parser.error("Use either --rate or --profile, not both")
+            profile = profile_from_dict(
+                {'phases': [{'duration': args.duration, 'rate': args.rate}],
+                 'sections': DEFAULT_PROFILE['sections']})
+        elif args.profile:
+            profile = load_profile(args.profile)
+        else:
+            profile = profile_from_dict(DEFAULT_PROFILE)
+    except (OSError, ValueError) as e:
+        parser.error(f"Bad load profile: {e}")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+
+    if args.raw:
+        if not 1 <= args.flows * args.processes <= 50000:
+            parser.error("--flows times --processes has to be between 1 "
+                         "and 50000, (each flow needs a source port)")
+        try:
+            summary = raw_injector.run(profile, args.ip, args.port,
+                                       args.processes, args.flows, args.quiet)
+        except OSError as e:
+            parser.error(f"Can't send raw packets, (--raw needs root): {e}")
+        print(f"target {summary['target']} packets, sent {summary['sent']}, "
+              f"({summary['short']:.1%} short)")
+        raise SystemExit
+
+    summary = run(profile, f'http://{args.ip}:{args.port}', args.processes,
+                  args.connections, args.max_in_flight, args.timeout,
+                  args.quiet)
+    print(f"target {summary['target']}, sent {summary['sent']}, "
+          f"({summary['short']:.1%} short), {summary['ok']} ok, "
+          f"({summary['ok short']:.1%} short), {summary['errors']} errors, "
+          f"{summary['skipped']} skipped")
+    if 'p50_ms' in summary:
+        print(f"latency p50 {summary['p50_ms']} ms, p90 "
+              f"{summary['p90_ms']} ms, p99 {summary['p99_ms']} ms")
@@ -2,16 +2,28 @@
 
 import argparse
 import collections
-import multiprocessing
+import os
+import queue
 import time
+from contextlib import ExitStack
+from datetime import datetime
+from functools import partial
 from multiprocessing import Process
-from threading import Lock
-
-from apscheduler.schedulers.background import BackgroundScheduler
-from blessed import Terminal
-from pandas import DataFrame
+from threading import RLock
 
+import section_counter
 import sniffers
+from aggregator import TrafficAggregator
+from analytics import AnalyticsTick
+from alert_rules import AlertEngine, ClientRule, TotalRule, load_rules, \
+    parse_rule
+from client_stats import ClientStats
+from clock import ReplayClock, WallClock
+from metrics import MetricsExporter, MetricsText
+from record_store import RecordStore, int_to_ip
+from rollups import RollupTier, Rollups
+from segment_log import SegmentLog, query
+from transport import ReorderBuffer, make_transport
 from view_manager import ViewManager
 
 # in seconds
@@ -21,13 +33,30 @@ RECORD_RETENTION_PERIOD = 600
 # activates
 DEFAULT_TRAFFIC_THRESHOLD_PER_SECOND = 20
 
-# This lock is to prevent issues with the accessing the records data
-lock = Lock()
+# The tiers the per-second counts are rolled up into, for the 'Long Term'
+# panels: (bucket length in seconds, how long they're kept in seconds, the
+# most section counters kept). That's 50 sections for each minute of a
+# day, and for each hour of a month, about 30MB when they're all full.
+ROLLUP_TIERS = ((60, 24 * 3600, 72050), (3600, 30 * 24 * 3600, 36050))
+
+# This lock is to prevent issues with the accessing the records data. It's
+# re-entrant so the analytics tick can hold it over all of its jobs, which
+# take it themselves too.
+lock = RLock()
+
+# Where 'now' comes from for the jobs. It's the wall clock, except when
+# replaying a capture file, when it's the capture's time instead.
+clock = WallClock()
 
 
 class TrafficAlert:
     """
     This class handles the alerting for traffic over some threshold.
+
+    The running program uses an alert_rules.AlertEngine instead, which
+    checks any number of rules, (this one is its TotalRule), against the
+    aggregator's running counts. This class still works with any records,
+    including a plain deque.
     """
     # This is the alert-in-progress indicator.
     alert_engaged = False
@@ -36,6 +65,9 @@ class TrafficAlert:
     # the notifications that are happening.
     msg_deque = collections.deque()
 
+    # The clients whose own alerts are in progress
+    clients_engaged = frozenset()
+
     def traffic_alert(self, records, alert_threshold, alert_period,
                       per_second=True):
         """
@@ -45,7 +77,8 @@ class TrafficAlert:
         the two values, but it's easier to be able to think about it from
         one perspective or the other.
 
-        @param records: A collections.deque containing the request records
+        @param records: A RecordStore or collections.deque containing the
+        request records
         @param alert_threshold: The threshold of messages above which to set the
         alert. It has two modes, depending on the state of the "per_second"
         argument:
@@ -61,8 +94,8 @@ class TrafficAlert:
         argument, see above.
         @return: None
         """
-        recs, when = get_last_n_seconds_records(records, alert_period)
-        num_records = len(recs)
+        num_records, when = count_last_n_seconds_records(records,
+                                                         alert_period)
 
         msg = None
         if per_second:
@@ -96,51 +129,246 @@ class TrafficAlert:
             self.msg_deque.append(msg)
         return self.msg_deque
 
+    def client_alert(self, records, alert_threshold, alert_period,
+                     per_second=True):
+        """
+        The same as traffic_alert, but for each client, (source ip), on its
+        own, so a single client hammering the server raises an alert of its
+        own even when the total traffic is under the threshold. Its messages
+        go in the same deque as the traffic alert's.
+
+        @param records: A RecordStore or collections.deque containing the
+        request records. If the RecordStore's aggregator has a ClientStats,
+        it has to be tracking alert_period.
+        @param alert_threshold: as for traffic_alert, but for one client
+        @param alert_period: The time period over which to total the average.
+        @param per_second: as for traffic_alert
+        @return: the message deque
+        """
+        clients, when = busiest_clients(records, alert_period)
+        msg_time = time.strftime('%d %b %H:%M:%S', time.localtime(when))
+
+        over = {}
+        for client, hits in clients:
+            rate = hits / alert_period if per_second else hits
+            if rate >= alert_threshold:
+                over[client] = hits
+
+        for client, hits in over.items():
+            if client not in self.clients_engaged:
+                self.msg_deque.append(f"Client {client} generated an alert - "
+                                      f"hits = {hits} triggered at {msg_time}")
+        for client in self.clients_engaged - over.keys():
+            self.msg_deque.append(f"Client {client} alert recovered at "
+                                  f"{msg_time}")
+        self.clients_engaged = frozenset(over)
 
-def recent_section_activity(records, threshold_secs=10):
+        while len(self.msg_deque) > 500:
+            self.msg_deque.popleft()
+        return self.msg_deque
+
+
+def recent_section_activity(records, threshold_secs=10, top_n=None,
+                            now=None):
     """
     This method obtains the most popular website 'sections' in the last 10
     seconds, (or threshold_secs).
-    @param records: An iterable collection with the request records
+    @param records: A RecordStore, or any iterable collection of request
+    record dicts
     @param threshold_secs: The number of seconds over which to collect the
     'most popular section' info.
-    @return: None
+    @param top_n: The number of sections wanted, or None for all of them.
+    When the aggregator's section counts are approximate, the counts come
+    with the most they could be over by.
+    @param now: the time to count back from, or None for clock.time(). The
+    analytics tick passes the same one to everything it works out.
+    @return: the lines for the 'most popular sections' list
     """
-    records_to_check, _ = get_last_n_seconds_records(records, threshold_secs)
+    return section_counter.popularity_messages(
+        section_hits(records, threshold_secs, top_n, now))
 
-    popular_list = []
-    if len(records_to_check) > 0:
-        df = DataFrame(records_to_check)
-        vals = df.groupby(['path']).size().sort_values(ascending=False)
 
-        for section, hits in zip(vals.index, vals.values):
-            message = f'{section}: {hits} '
-            message += "hits" if hits > 1 else "hit"
-            popular_list.append(message)
+def section_hits(records, threshold_secs=10, top_n=None, now=None):
+    """
+    The hits for each of the most popular sections in the last 10 seconds,
+    (or threshold_secs), as numbers.
+    @param records: A RecordStore, or any iterable collection of request
+    record dicts
+    @param threshold_secs: The number of seconds to look back over
+    @param top_n: The number of sections wanted, or None for all of them
+    @param now: the time to count back from, or None for clock.time(). The
+    analytics tick passes the same one to everything it works out.
+    @return: a list of (section name, hits) tuples, most hits first. When
+    the aggregator's section counts are approximate they're (section name,
+    hits, error) tuples, with error the most the hits could be over by.
+    """
+    if now is None:
+        now = clock.time()
+    if isinstance(records, RecordStore) and records.aggregator and \
+            records.aggregator.top_k:
+        # approximate counts, from the aggregator's fixed size summaries
+        summary = records.aggregator.section_summary(threshold_secs, now,
+                                                     lock)
+        return summary.top(top_n)
+    elif isinstance(records, RecordStore) and records.aggregator:
+        # The aggregator keeps running per-section counts, so there's no
+        # need to look at the records at all
+        with lock:
+            counts = records.aggregator.section_counts(threshold_secs, now)
+        return sorted(counts.items(),
+                      key=lambda item: (-item[1], item[0]))[:top_n]
+    elif isinstance(records, RecordStore):
+        # Count the interned section ids, then look up the names of the ones
+        # that were seen, rather than building a dict per record
+        window, _ = get_last_n_seconds_records(records, threshold_secs, now)
+        counts = section_counter.count_section_ids(window.section_ids())
+        with lock:
+            section_names = records.section_names
+            return [(section_names[section_id], hits) for section_id, hits
+                    in counts[:top_n]]
     else:
-        popular_list.append("No activity")
-    return popular_list
+        records_to_check, _ = get_last_n_seconds_records(records,
+                                                         threshold_secs, now)
+        return section_counter.count_paths(records_to_check)[:top_n]
 
 
-def get_last_n_seconds_records(records, n_secs):
+def long_term_section_hits(records, threshold_secs=3600, top_n=None,
+                           now=None):
+    """
+    The hits for each of the most popular sections, and the request rate,
+    over any length of time the rollups keep, (an hour, a day...). It's read
+    from the coarsest rollup tier that fits, so the window is rounded to
+    whole buckets, and the hits are approximate.
+    @param records: A RecordStore, or any iterable collection of request
+    record dicts. Without rollups, it's the same as section_hits, so it can
+    only go back as far as the records do.
+    @param threshold_secs: The number of seconds to look back over
+    @param top_n: The number of sections wanted, or None for all of them
+    @param now: the time to count back from, or None for clock.time()
+    @return: (list, rate) - a list of (section name, hits, error) tuples,
+    most hits first, with error the most the hits could be over by, and the
+    requests per second over the window
+    """
+    if now is None:
+        now = clock.time()
+    aggregator = getattr(records, 'aggregator', None)
+    if aggregator is None:
+        hits = section_hits(records, threshold_secs, top_n, now)
+        count, _ = count_last_n_seconds_records(records, threshold_secs, now)
+        return hits, count / threshold_secs
+    total, summary, seconds = aggregator.rollup_window(threshold_secs, now,
+                                                       lock)
+    return summary.top(top_n), total / seconds
+
+
+def long_term_section_activity(records, threshold_secs=3600, top_n=None,
+                               now=None):
+    """
+    Like recent_section_activity, but for any length of time the rollups
+    keep, see long_term_section_hits
+    @param records: A RecordStore, or any iterable collection of request
+    record dicts
+    @param threshold_secs: The number of seconds to look back over
+    @param top_n: The number of sections wanted, or None for all of them
+    @param now: the time to count back from, or None for clock.time()
+    @return: (lines, rate) - the lines for the 'most popular sections' list,
+    and the requests per second over the window
+    """
+    hits, rate = long_term_section_hits(records, threshold_secs, top_n, now)
+    return section_counter.popularity_messages(hits), rate
+
+
+def busiest_clients(records, n_secs, n=None, now=None):
+    """
+    Finds the clients, (source ips), that sent the most requests in the last
+    n seconds.
+
+    @param records: a RecordStore, or anything get_last_n_seconds_records
+                    takes. If it's a RecordStore whose aggregator has a
+                    ClientStats, the counts are its count-min estimates over
+                    the last n complete seconds, which are never too low,
+                    instead of exact counts.
+    @param n_secs: number of seconds in the past to look at
+    @param n: the number of clients wanted, or None for all of them, (or
+              for a ClientStats, all of its top client candidates)
+    @param now: the time to count back from, or None for clock.time()
+    @return: (list, when) A list of (ip, requests) tuples, most requests
+             first, and the time used as 'now'
+    """
+    aggregator = getattr(records, 'aggregator', None)
+    if aggregator is not None and aggregator.clients is not None:
+        if now is None:
+            now = clock.time()
+        top = aggregator.clients.top_clients(n_secs, now, n, lock)
+        return [(int_to_ip(src_ip), hits) for src_ip, hits in top], now
+
+    recs, now = get_last_n_seconds_records(records, n_secs, now)
+    if isinstance(records, RecordStore):
+        counts = collections.Counter(recs.column('src_ips'))
+        return [(int_to_ip(src_ip), hits)
+                for src_ip, hits in counts.most_common(n)], now
+    counts = collections.Counter(record['src_ip'] for record in recs)
+    return counts.most_common(n), now
+
+
+def client_activity(records, threshold_secs=600, top_n=5, now=None):
+    """
+    The top clients and number of unique clients in the last 10 minutes, (or
+    threshold_secs), for the 'Top Clients' panel.
+    @param records: A RecordStore, or any iterable collection of request
+    record dicts
+    @param threshold_secs: The number of seconds to look back over
+    @param top_n: The number of clients wanted
+    @param now: the time to count back from, or None for clock.time()
+    @return: (unique, lines) - the number of different clients, (estimated
+    if it comes from a ClientStats), and a line for each top client
+    """
+    if now is None:
+        now = clock.time()
+    aggregator = getattr(records, 'aggregator', None)
+    if aggregator is not None and aggregator.clients is not None:
+        unique = aggregator.clients.unique_clients(threshold_secs, now,
+                                                   lock)
+        top, _ = busiest_clients(records, threshold_secs, top_n, now)
+    else:
+        everyone, _ = busiest_clients(records, threshold_secs, now=now)
+        unique = len(everyone)
+        top = everyone[:top_n]
+
+    lines = []
+    for client, hits in top:
+        lines.append(f'{client}: {hits} ' + ("hits" if hits > 1 else "hit"))
+    if not lines:
+        lines.append("No activity")
+    return unique, lines
+
+
+def get_last_n_seconds_records(records, n_secs, now=None):
     """
         Returns a list of records that were received from now to n seconds ago.
 
-    @param records: built on a collections.deque but will work an any iterable
+    @param records: a RecordStore, or a collections.deque, or any iterable
                     containing objects with a 'time' value.
     @type n_secs: float
     @param n_secs: number of seconds in the past to include in the
             output.
+    @param now: the time to look back from, or None for clock.time()
     @return: (list, when) The list of the events, newest to oldest, and the
             time that was used for t0 or 'now', so calling methods can know at
-            what point in time the search backward began.
+            what point in time the search backward began. For a RecordStore
+            the 'list' is a RecordWindow instead: it's found by a binary
+            search, len() is free, and the records are only copied out if
+            they're asked for.
     """
     records_to_check = []
-    now = time.time()
+    if now is None:
+        now = clock.time()
     # This was originally a list comprehension, but since the records are in
     # reverse time order, since we need to break the iteration at a time
     # threshold, this format is much easier to read.
     with lock:
+        if isinstance(records, RecordStore):
+            return records.window(now - n_secs, lock), now
         for i in reversed(records):
             if i['time'] > now - n_secs:
                 records_to_check.append(i)
@@ -149,82 +377,413 @@ def get_last_n_seconds_records(records, n_secs):
     return records_to_check, now
 
 
-def record_cleanup(records, retention_period):
+def count_last_n_seconds_records(records, n_secs, now=None):
+    """
+    Counts the records received from now to n seconds ago.
+
+    @param records: a RecordStore, or anything get_last_n_seconds_records
+                    takes. If it's a RecordStore with an aggregator, the
+                    count comes from the aggregator's running sums, over the
+                    last n complete seconds, instead of the records.
+    @param n_secs: number of seconds in the past to count
+    @param now: the time to count back from, or None for clock.time()
+    @return: (count, when) The number of records, and the time used as 'now'
+    """
+    if now is None:
+        now = clock.time()
+    if isinstance(records, RecordStore) and records.aggregator:
+        with lock:
+            return records.aggregator.total(n_secs, now), now
+    recs, now = get_last_n_seconds_records(records, n_secs, now)
+    return len(recs), now
+
+
+def record_cleanup(records, retention_period, now=None):
     """
     This job is to keep the records deque to a manageable length, so it doesn't
     grow forever.
-    @param records: A collections.deque containing request records
-    @param retention_period: This is treated like time.time()-retention period.
+    @param records: A RecordStore or a collections.deque containing request
+    records
+    @param retention_period: This is treated like clock.time()-retention period.
     Items older than this are discarded.
+    @param now: the time now, or None for clock.time()
     @return: None
     """
-    now = time.time()
+    if now is None:
+        now = clock.time()
     with lock:
+        if isinstance(records, RecordStore):
+            records.expire_before(now - retention_period)
+            return
         while len(records) > 0 and records[0]['time'] < now - retention_period:
             records.popleft()
 
 
-def display(id, display_method):
+def ingest_replayed(records, rows, alert_engine, replay_clock):
     """
-    This method is used as a python decorator, to link the monitoring functions
-    to a queue which connects to the viewing code. This decouples the
-    calculation jobs from the display thread.
-
-    @param id: A unique ID for the wrapped method, so if two or more instances
-     of the same method are sending updates to the view, that it can
-     tell them apart.
-    @param display_method: This is a reference to the actual view function.
-     This could be further decoupled by using strings and reflection, but I
-     don't want to pay the runtime cost on each update.
-    @return: The wrapped function
+    Adds a batch of records replayed from a capture file. A batch can cover
+    any amount of capture time when the replay runs as fast as it can, so
+    it's added a second at a time, with the alerts checked at the start of
+    each capture second, the same as they'd have been checked live.
+
+    @param records: the RecordStore
+    @param rows: the batch of (time, src_ip, section) rows, oldest first
+    @param alert_engine: the AlertEngine
+    @param replay_clock: the ReplayClock, which is moved along to the rows'
+    times
+    @return: None
     """
+    last = replay_clock.capture_time
+    current = None if last is None else int(last)
+    start = 0
+    for i, row in enumerate(rows):
+        second = int(row[0])
+        if current is None:
+            current = second
+        elif second > current:
+            with lock:
+                records.append_batch(rows[start:i])
+            replay_clock.advance(rows[i - 1][0])
+            start = i
+            # After the longest window's worth of quiet seconds the alerts
+            # can't change any more, so the rest of a long gap is skipped.
+            for tick in range(current + 1, min(second, current +
+                                               RECORD_RETENTION_PERIOD + 1)
+                              + 1):
+                alert_engine.evaluate(records, lock, tick)
+            current = second
+    with lock:
+        records.append_batch(rows[start:])
+    if rows:
+        replay_clock.advance(rows[-1][0])
 
-    def wrapper(func):
-        myqueue = None
-
-        def activity_call(*args, **kwargs):
-            nonlocal myqueue
-            if not myqueue:
-                myqueue = view_manager.get_view_queue()
-
-            output = func(*args, **kwargs)
-            myqueue.put([id, display_method, output])
-            return
 
-        return activity_call
+# The units --query takes for times back from now, like '2h'
+QUERY_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
 
-    return wrapper
 
+def parse_history_time(text, now):
+    """
+    Reads a --query time
+    @param text: 'now', a time back from now, like '90m' or '2h', (or
+    '-2h'), a unix time, or a local date and time, like '2024-05-01 13:00'
+    @param now: the current time
+    @return: the time, in seconds since the epoch
+    @raise ValueError: if it's none of those
+    """
+    text = text.strip()
+    if text == 'now':
+        return now
+    if text[-1:] in QUERY_UNITS:
+        return now - abs(float(text[:-1])) * QUERY_UNITS[text[-1]]
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def history_report(directory, start, end, step=None, top_n=10):
+    """
+    The --query report, for a stretch of the history on disk
+    @param directory: the --history directory
+    @param start: the time to start from
+    @param end: the time to stop at
+    @param step: if given, the rate for every step seconds is listed too
+    @param top_n: how many of the top sections and clients to list
+    @return: the report's lines, with the most any approximate count of a
+    section or client could be over by after a ±
+    """
+    def when(t):
+        return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+    result = query(directory, start, end, step, top_n)
+    seconds = max(result['end'] - result['start'], 1)
+    lines = [f"From {when(result['start'])} to {when(result['end'])}:",
+             f"{result['total']} Requests, "
+             f"{result['total'] / seconds:.2f} Requests / Sec"]
+    peak_second, peak = result['peak']
+    if peak:
+        lines.append(f"Busiest second: {peak} Requests at "
+                     f"{when(peak_second)}")
+    def counted(name, hits, error):
+        # like the 'most popular sections' panels, with the most an
+        # approximate count could be over by
+        return f"  {name} {hits} hits" + (f" ±{error}" if error else "")
+
+    lines.append("Most Popular Sections:")
+    lines += [counted(section, hits, error)
+              for section, hits, error in result['sections']]
+    lines.append("Top Clients:")
+    lines += [counted(int_to_ip(client), hits, error)
+              for client, hits, error in result['clients']]
+    if step:
+        lines.append(f"Every {step} Secs:")
+        lines += [f"  {when(step_start)} {hits} Requests, "
+                  f"{hits / min(step, result['end'] - step_start):.2f} "
+                  f"Requests / Sec" for step_start, hits in result['steps']]
+    return lines
+
+
+# The windows the metrics give the section counts for, (the same as the
+# 'Most Popular Sections' panels), and how many sections for each
+METRICS_SECTION_WINDOWS = (10, RECORD_RETENTION_PERIOD)
+METRICS_TOP_SECTIONS = 10
+
+# The transport's and sniffers' numbers that only ever go up, which makes
+# them counters, the rest are gauges
+COUNTER_STATS = {'batches', 'records', 'overflows', 'packets', 'drops',
+                 'freezes', 'delivered', 'filtered', 'written', 'dropped',
+                 'unnamed'}
+
+
+def add_stats_metrics(text, prefix, stats, help_text):
+    """
+    Adds a transport's or sniffer's numbers to the metrics, each as a metric
+    of its own. Anything that isn't a number is left out.
+    @param text: a MetricsText
+    @param prefix: the start of the metrics' names
+    @param stats: a dict of names to values, like receiver.stats()
+    @param help_text: what the numbers are
+    @return: None
+    """
+    for name, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = prefix + name.replace(' ', '_')
+        if name.rsplit('_', 1)[-1] in COUNTER_STATS:
+            text.add(name + '_total', 'counter', help_text, [({}, value)])
+        else:
+            text.add(name, 'gauge', help_text, [({}, value)])
 
-traffic_alert = TrafficAlert()
 
+def collect_metrics(records, alert_engine, receiver, sniffer=None, tick=None,
+                    now=None, history=None):
+    """
+    Works out everything --headless serves: the request rates, the top
+    sections and clients, the alerts in progress, and the transport's,
+    sniffer's, analytics tick's and history's counters.
+    @param records: the RecordStore
+    @param alert_engine: the AlertEngine
+    @param receiver: the transport's receiver
+    @param sniffer: the sniffer, for its capture counters if it keeps any
+    @param tick: the AnalyticsTick, for its timings
+    @param now: the time to count back from, or None for clock.time()
+    @param history: the SegmentLog, with --history
+    @return: the metrics, as Prometheus text in bytes
+    """
+    text = MetricsText()
+    rate, now = count_last_n_seconds_records(records, 1, now)
+    text.add('traffic_watch_requests_per_second', 'gauge',
+             "Requests in the last complete second", [({}, rate)])
+    totals = []
+    sections = []
+    for n_secs in METRICS_SECTION_WINDOWS:
+        window = f'{n_secs}s'
+        total, _ = count_last_n_seconds_records(records, n_secs, now)
+        totals.append(({'window': window}, total))
+        for section, hits, *_ in section_hits(records, n_secs,
+                                              METRICS_TOP_SECTIONS, now):
+            sections.append(({'window': window, 'section': section}, hits))
+    text.add('traffic_watch_requests', 'gauge',
+             "Requests in the window", totals)
+    text.add('traffic_watch_section_requests', 'gauge',
+             "Requests to each of the most popular sections in the window",
+             sections)
+    clients, _ = busiest_clients(records, RECORD_RETENTION_PERIOD, 5, now)
+    text.add('traffic_watch_client_requests', 'gauge',
+             "Requests from each of the busiest clients in the window",
+             [({'window': f'{RECORD_RETENTION_PERIOD}s', 'client': client},
+               hits) for client, hits in clients])
+
+    # the alert checks replace each rule's dict whole, so a copy of the
+    # outer one is enough to read them all consistently
+    engaged = dict(alert_engine.engaged)
+    in_progress = []
+    alert_hits = []
+    for rule in alert_engine.rules:
+        label = repr(rule)[1:-1]
+        in_progress.append(({'rule': label}, len(engaged[rule])))
+        for key, hits in engaged[rule].items():
+            alert_hits.append(({'rule': label, 'alert': rule.name(key)},
+                               hits))
+    text.add('traffic_watch_alerts_engaged', 'gauge',
+             "How many alerts each rule has in progress", in_progress)
+    text.add('traffic_watch_alert_hits', 'gauge',
+             "The hits that set off each alert in progress", alert_hits)
 
-# This section hooks the various profiling functions to their display
-# counterparts. We could have just marked the functions directly, but then
-# unit tests become a problem, because calling the function then requires
-# the view to exist.
-@display("VW_TFC_1", ViewManager.update_traffic_alert)
-def display_traffic_alert(records, alert_threshold, alert_period,
-                          per_second=True):
-    return traffic_alert.traffic_alert(records, alert_threshold, alert_period,
-                                       per_second)
+    with lock:
+        stored = len(records)
+    text.add('traffic_watch_records_stored', 'gauge',
+             "Request records kept for the windows", [({}, stored)])
+    add_stats_metrics(text, 'traffic_watch_pipeline_', receiver.stats(),
+                      "The sniffer to main process transport")
+    capture = getattr(sniffer, 'capture_stats', lambda: None)()
+    if capture:
+        add_stats_metrics(text, 'traffic_watch_capture_', capture,
+                          "The sniffer's capture")
+    if tick is not None:
+        text.add('traffic_watch_tick_seconds', 'gauge',
+                 "How long the last analytics tick took",
+                 [({}, round(tick.last_duration, 6))])
+        text.add('traffic_watch_tick_max_seconds', 'gauge',
+                 "The longest an analytics tick has taken",
+                 [({}, round(tick.max_duration, 6))])
+        text.add('traffic_watch_tick_overruns_total', 'counter',
+                 "Analytics ticks skipped because one ran too long",
+                 [({}, tick.overruns)])
+    if history is not None:
+        add_stats_metrics(text, 'traffic_watch_history_', history.stats(),
+                          "The records written to the history on disk")
+    text.add('traffic_watch_snapshot_time_seconds', 'gauge',
+             "When these numbers were worked out", [({}, now)])
+    return text.text()
+
+
+# How often, in seconds, the analytics tick runs, and how many ticks there
+# are between the slower jobs, (the 'popular section' and 'top clients'
+# panels, and the record cleanup)
+TICK_INTERVAL = 1
+SLOW_JOB_TICKS = 10
+
+# The 'Long Term' panels: (view id, label, window in seconds)
+LONG_TERM_PANELS = (("VW_LT_1", "Last Hour", 3600),
+                    ("VW_LT_2", "Last Day", 24 * 3600))
+
+
+# The analytics tick's jobs. Each is called with the tick's 'now', takes the
+# records lock for what it reads, and returns its view updates, a list of
+# [id, display method, output]. The id is unique to the view field, so if
+# two or more jobs use the same display method, the view can tell them
+# apart. The display method is a reference to the actual view function.
+# This could be further decoupled by using strings and reflection, but I
+# don't want to pay the runtime cost on each update.
+def section_activity_updates(records, now):
+    # the view only has room for the top 5, for the last 10 seconds and the
+    # last 10 minutes
+    return [["VW_SA_1", ViewManager.update_section_activity,
+             recent_section_activity(records, 10, 5, now)],
+            ["VW_SA_2", ViewManager.update_section_activity,
+             recent_section_activity(records, RECORD_RETENTION_PERIOD, 5,
+                                     now)]]
+
+
+def long_term_updates(records, now):
+    # the top 5 sections and the rate for each of the long term panels
+    updates = []
+    for id, label, n_secs in LONG_TERM_PANELS:
+        lines, rate = long_term_section_activity(records, n_secs, 5, now)
+        updates.append([id, ViewManager.update_long_term,
+                        (label, rate, lines)])
+    return updates
+
+
+def alert_updates(alert_engine, records, now):
+    return [["VW_TFC_1", ViewManager.update_traffic_alert,
+             list(alert_engine.evaluate(records, lock, now))]]
+
+
+# When replaying, the alerts are checked as the records go in, (see
+# ingest_replayed), so this just shows them
+def alert_message_updates(alert_engine, now):
+    return [["VW_TFC_1", ViewManager.update_traffic_alert,
+             list(alert_engine.msg_deque)]]
+
+
+def rate_updates(records, now):
+    num_records, _ = count_last_n_seconds_records(records, 1, now)
+    return [["VW_RATE_1", ViewManager.update_request_rate, num_records]]
+
+
+def client_activity_updates(records, now):
+    return [["VW_CL_1", ViewManager.update_top_clients,
+             client_activity(records, RECORD_RETENTION_PERIOD, now=now)]]
+
+
+def capture_stats_updates(sniffer, now):
+    return [["VW_CAP_1", ViewManager.update_capture_stats,
+             sniffer.capture_stats()]]
+
+
+def pipeline_stats_updates(receiver, tick, now):
+    # the tick's own timings go on the same line
+    return [["VW_PIPE_1", ViewManager.update_pipeline_stats,
+             {**receiver.stats(), **tick.stats()}]]
+
+
+def cleanup_job(records, now):
+    record_cleanup(records, RECORD_RETENTION_PERIOD, now)
+
+
+def rollup_job(records, now):
+    with lock:
+        records.aggregator.roll_up(now)
 
 
-@display("VW_RATE_1", ViewManager.update_request_rate)
-def display_current_rate(records):
-    len_records, _ = get_last_n_seconds_records(records, 1)
-    return len(len_records)
+def check_alerts(alert_engine, records, now):
+    """
+    The --headless alert job, the same check as alert_updates without the
+    view
+    @return: None
+    """
+    alert_engine.evaluate(records, lock, now)
 
 
-@display("VW_SA_1", ViewManager.update_section_activity)
-def display_recent_section_activity1(records, threshold_secs=10):
-    return recent_section_activity(records, threshold_secs)
+def publish_metrics(exporter, records, alert_engine, receiver, sniffer, tick,
+                    history, now):
+    """
+    The --headless job, which keeps the metrics exporter's text up to date
+    @param exporter: the MetricsExporter
+    @return: None
+    """
+    exporter.publish(collect_metrics(records, alert_engine, receiver,
+                                     sniffer, tick, now, history))
 
 
-# we'll also add a "recent section" monitor tally of the last 10 mins
-@display("VW_SA_2", ViewManager.update_section_activity)
-def display_recent_section_activity2(records, threshold_secs=600):
-    return recent_section_activity(records, threshold_secs)
+def add_jobs(tick, records, alert_engine, receiver, sniffer, replaying,
+             exporter=None, history=None):
+    """
+    Sets up the analytics tick's jobs, for the screen, or with an exporter,
+    for --headless
+    @param tick: the AnalyticsTick
+    @param records: the RecordStore
+    @param alert_engine: the AlertEngine
+    @param receiver: the transport's receiver
+    @param sniffer: the sniffer
+    @param replaying: whether a capture's being replayed, when the alerts
+    are checked as the records go in
+    @param exporter: the MetricsExporter for --headless, or None
+    @param history: the SegmentLog, with --history, for the metrics
+    @return: None
+    """
+    # The record cleanup job, to control memory usage
+    tick.add(partial(cleanup_job, records), every=SLOW_JOB_TICKS)
+    # Each second's counts go on into the rollups as soon as it's done with
+    tick.add(partial(rollup_job, records))
+    if exporter is not None:
+        if not replaying:
+            tick.add(partial(check_alerts, alert_engine, records))
+        # everything the screen would show, after the alerts are checked
+        tick.add(partial(publish_metrics, exporter, records, alert_engine,
+                         receiver, sniffer, tick, history))
+        return
+
+    # The 'popular section' and 'top clients' jobs
+    tick.add(partial(section_activity_updates, records),
+             every=SLOW_JOB_TICKS)
+    tick.add(partial(client_activity_updates, records), every=SLOW_JOB_TICKS)
+    tick.add(partial(long_term_updates, records), every=SLOW_JOB_TICKS)
+    # The alert check job, all the rules at once
+    if replaying:
+        tick.add(partial(alert_message_updates, alert_engine))
+    else:
+        tick.add(partial(alert_updates, alert_engine, records))
+    tick.add(partial(rate_updates, records))
+    # The transport's queue depth and batch sizes, for tuning
+    tick.add(partial(pipeline_stats_updates, receiver, tick))
+    # Some backends keep capture counters, (like packets the kernel
+    # dropped), so show those too
+    if getattr(sniffer, 'capture_stats', lambda: None)() is not None:
+        tick.add(partial(capture_stats_updates, sniffer))
 
 
 if __name__ == '__main__':
@@ -268,13 +827,198 @@ if __name__ == '__main__':
                         help="(default: socket) which backend packet sniffer "
                              "to use, choices are 'scapy' which is based on "
                              "the popular framework, but has a limited ~15-20 "
-                             "packets/sec listening speed, or 'socket' which "
-                             "is hand written for this and much faster, "
+                             "packets/sec listening speed, 'scapy-fast' "
+                             "which is scapy reading batches of raw frames "
+                             "and only dissecting the requests, 'socket' "
+                             "which is hand written for this and much faster, "
                              "(but potentially less stable - I haven't had "
-                             "any issues but your mileage may vary). ",
+                             "any issues but your mileage may vary), or "
+                             "'mmap' which is the socket sniffer reading "
+                             "from a memory-mapped kernel packet ring, the "
+                             "fastest option on busy linux boxes. ",
                         default='socket')
+
+    parser.add_argument('--no-kernel-filter', action='store_true',
+                        help="For the 'socket' and 'mmap' backends, don't "
+                             "attach the BPF filter that has the kernel drop "
+                             "packets for other ips and ports, and send "
+                             "every TCP packet up to be checked in python "
+                             "instead.")
+
+    parser.add_argument('--no-reassembly', action='store_true',
+                        help="For the 'socket' and 'mmap' backends, look for "
+                             "a request line at the start of each packet on "
+                             "its own, instead of following each "
+                             "connection's byte stream. Request lines split "
+                             "across packets are then missed.")
+
+    parser.add_argument('--filter-stats', action='store_true',
+                        help="For the 'socket' and 'mmap' backends, show how "
+                             "many incoming TCP packets the kernel filter "
+                             "dropped compared to how many it delivered.")
+
+    parser.add_argument('--sniffer-workers', type=int, default=1,
+                        help="(default: 1) The number of sniffer processes "
+                             "for the 'socket' and 'mmap' backends. With "
+                             "more than one, the kernel splits the traffic "
+                             "between them by TCP flow, (PACKET_FANOUT), so "
+                             "the parsing can use more than one core.")
+
+    parser.add_argument('--reorder-slack', type=float, default=250,
+                        help="(default: 250) With more than one sniffer "
+                             "worker, how long in milliseconds to hold "
+                             "incoming records so the ones from different "
+                             "workers can be put back in time order.")
+
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help="(default: 256) The sniffers send their records "
+                             "to the main process in batches of up to this "
+                             "many records.")
+
+    parser.add_argument('--batch-interval', type=float, default=50,
+                        help="(default: 50) The longest time, in "
+                             "milliseconds, a record waits in the sniffer "
+                             "for its batch to fill up before it's sent "
+                             "anyway.")
+
+    parser.add_argument('--transport', default='queue',
+                        help="(default: queue) How records get from the "
+                             "sniffers to the main process: 'queue' sends "
+                             "them in batches over a multiprocessing queue, "
+                             "'shm' writes them into a lock-free shared "
+                             "memory ring per sniffer worker, with no "
+                             "pickling at all. The batch options only apply "
+                             "to 'queue'.")
+
+    parser.add_argument('--ring-size', type=int, default=65536,
+                        help="(default: 65536) For the 'shm' transport, the "
+                             "number of records each ring holds. Records "
+                             "arriving when a ring is full are dropped and "
+                             "counted as overflows.")
+
+    parser.add_argument('--top-k', type=int, default=0,
+                        help="Count the most popular sections approximately, "
+                             "keeping at most this many sections per second "
+                             "in fixed memory, (a Space-Saving summary), "
+                             "instead of counting every section exactly. "
+                             "Useful when something is requesting huge "
+                             "numbers of distinct paths. The counts are then "
+                             "shown with the most they could be over by. "
+                             "100 is plenty for the 5 shown.")
+
+    parser.add_argument('--client_threshold_per_second', '-cs', type=float,
+                        help="An alert for single clients - this number of "
+                             "average requests PER SECOND from any one "
+                             "source ip over the 'threshold_period' will "
+                             "cause an alert for that client. This option "
+                             "and -ct cannot be used at the same time.")
+
+    parser.add_argument('--client_threshold_total', '-ct', type=int,
+                        help="An alert for single clients - this number of "
+                             "TOTAL requests from any one source ip over the "
+                             "'threshold_period' will cause an alert for "
+                             "that client. This option and -cs cannot be "
+                             "used at the same time.")
+
+    parser.add_argument('--rule', action='append', default=[],
+                        help="An extra alert rule, and this can be given "
+                             "any number of times. A rule is its kind, "
+                             "then its settings, like \"section=/api "
+                             "rate=50 period=60\", \"client=10.0.0.5 "
+                             "hits=1000 period=600\", or \"change factor=3 "
+                             "rate=1 period=30\", (the traffic jumping to "
+                             "3 times what it was the period before). "
+                             "Periods are in seconds, rates are requests "
+                             "per second and hits are total requests over "
+                             "the period.")
+
+    parser.add_argument('--rules-file',
+                        help="A JSON file with a list of extra alert rules, "
+                             "each like {\"kind\": \"section\", \"target\": "
+                             "\"/api\", \"rate\": 50, \"period\": 60}. See "
+                             "--rule.")
+    parser.add_argument('--headless', action='store_true',
+                        help="Run without the screen, for servers with no "
+                             "terminal, and serve the rates, top sections, "
+                             "alerts and pipeline counters over HTTP "
+                             "instead, in the Prometheus text format, (see "
+                             "--metrics-port).")
+
+    parser.add_argument('--metrics-port', type=int, default=9180,
+                        help="(default: 9180) With --headless, the port the "
+                             "metrics are served on, at /metrics")
+
+    parser.add_argument('--metrics-address', default='127.0.0.1',
+                        help="(default: 127.0.0.1) With --headless, the "
+                             "address the metrics are served on. The default "
+                             "only serves this box.")
+
+    parser.add_argument('--frame-rate', type=float, default=10,
+                        help="(default: 10) The most times a second the "
+                             "screen is redrawn. The updates in between are "
+                             "drawn together, and only what changed is sent "
+                             "to the terminal, so a slow terminal, (like one "
+                             "over SSH), can use a lower rate.")
+
+    parser.add_argument('--read-pcap', metavar='FILE',
+                        help="Replay a capture file, (pcap or pcapng, like "
+                             "tcpdump -w writes), instead of sniffing the "
+                             "network. The packets go through the same "
+                             "parsing, counting and alerts, timed by the "
+                             "capture's timestamps, and root isn't needed. "
+                             "--port and -ip still pick out the traffic to "
+                             "watch.")
+
+    parser.add_argument('--replay-speed', type=float, default=0,
+                        help="(default: 0) With --read-pcap, how many times "
+                             "faster than real time to replay the capture, "
+                             "so 1 is as it happened and 60 is a minute a "
+                             "second. 0 replays it as fast as possible.")
+
+    parser.add_argument('--history', metavar='DIR',
+                        help="Keep every request on disk too, in DIR, for "
+                             "looking back further than the 10 minutes "
+                             "shown, and across restarts. See --query.")
+
+    parser.add_argument('--history-days', type=float, default=7,
+                        help="(default: 7) How many days of --history to "
+                             "keep, or 0 to keep it all")
+
+    parser.add_argument('--query', nargs=2, metavar=('FROM', 'TO'),
+                        help="Report the rates, top sections and top "
+                             "clients from the --history between two "
+                             "times, then exit. A time can be 'now', a time "
+                             "back from now, like 90m, 2h or 1d, a unix "
+                             "time, or a local date and time, like "
+                             "'2024-05-01 13:00'. Root isn't needed.")
+
+    parser.add_argument('--query-step', type=int, metavar='SECONDS',
+                        help="With --query, also list the rate for every "
+                             "this many seconds")
     args = parser.parse_args()
 
+    if args.query:
+        # a report from the history on disk, nothing is sniffed
+        if not args.history:
+            parser.error("--query needs the --history directory")
+        if args.query_step is not None and args.query_step < 1:
+            parser.error("--query-step must be at least 1")
+        query_now = time.time()
+        try:
+            query_from, query_to = (parse_history_time(text, query_now)
+                                    for text in args.query)
+        except ValueError as e:
+            parser.error(f"Bad --query time: {e}")
+        if query_to <= query_from:
+            parser.error("--query's TO has to be after its FROM")
+        try:
+            report = history_report(args.history, query_from, query_to,
+                                    args.query_step)
+        except OSError as e:
+            parser.error(f"Can't read the history in {args.history}: {e}")
+        print('\n'.join(report))
+        raise SystemExit(0)
+
     # Pull the args into the appropriate variables
     port = args.port
     ip = args.ip
@@ -290,70 +1034,221 @@ if __name__ == '__main__':
             traffic_alarm_thresh = DEFAULT_TRAFFIC_THRESHOLD_PER_SECOND
         thresh_avg_by_sec = True
 
-    alarm_period = args.threshold_period * 60  # cmd line arg is in minutes
-    backend = args.backend
-
-    # This is a handle to the terminal session
-    term = Terminal()
-
-    # make sure the terminal is tall enough to display the data
-    if term.height < 10:
-        raise RuntimeError("Please resize your terminal window to be at least" +
-                           " 10 rows tall.")
-
-    # a deque that will hold the collected packet information
-    traffic_records = collections.deque()
-
-    # The scheduler mechanism. This calls the various background monitoring
-    # jobs in this application
-    scheduler = BackgroundScheduler()
-    # The 'popular section' job
-    scheduler.add_job(display_recent_section_activity1, 'interval', seconds=10,
-                      args=(traffic_records,))
-    scheduler.add_job(display_recent_section_activity2, 'interval', seconds=10,
-                      args=(traffic_records,))
-
-    # The Traffic Alert check job
-    scheduler.add_job(display_traffic_alert, 'interval', seconds=1,
-                      args=(traffic_records,
-                            traffic_alarm_thresh,
-                            alarm_period,
-                            thresh_avg_by_sec))
-
-    # The record cleanup job, to control memory usage
-    scheduler.add_job(record_cleanup, 'interval', seconds=10,
-                      args=(traffic_records, RECORD_RETENTION_PERIOD))
-
-    scheduler.add_job(display_current_rate, 'interval', seconds=1,
-                      args=(traffic_records,))
-
-    # this is the queue for receiving info from the network-sniffing subprocess
-    incoming_data_queue = multiprocessing.Queue()
+    if args.client_threshold_total and args.client_threshold_per_second:
+        parser.error("Cannot use options -ct and -cs at the same time")
+    client_alarm_thresh = args.client_threshold_total or \
+        args.client_threshold_per_second
+    client_avg_by_sec = not args.client_threshold_total
 
-    # Putting the app inside this 'with' allows the client's terminal to be
-    # restored to its former state on exit, even if the process doesn't exit
-    # cleanly.
-    with term.fullscreen(), term.cbreak(), term.hidden_cursor():
-        view_manager = ViewManager(term)
-        view_manager.update_listening_info(port, ip)
+    alarm_period = args.threshold_period * 60  # cmd line arg is in minutes
 
-        # Initialize a sniffer
-        sniffer = sniffers.get_sniffer(backend)
-        # Start the sniffer in a new process
-        snifferProcess = Process(target=sniffer.run_sniffer,
-                                 args=(ip, port, incoming_data_queue))
-        snifferProcess.daemon = True
-        snifferProcess.start()
+    # The alert rules: the traffic alert, the client alert if there is one,
+    # and any others given
+    try:
+        alert_rules = [TotalRule(traffic_alarm_thresh, alarm_period,
+                                 thresh_avg_by_sec)]
+        if client_alarm_thresh:
+            alert_rules.append(ClientRule(client_alarm_thresh, alarm_period,
+                                          client_avg_by_sec))
+        alert_rules += [parse_rule(rule) for rule in args.rule]
+        if args.rules_file:
+            alert_rules += load_rules(args.rules_file)
+    except (ValueError, OSError) as e:
+        parser.error(f"Bad alert rule: {e}")
+    alert_engine = AlertEngine(alert_rules)
+    if max(alert_engine.windows()) > RECORD_RETENTION_PERIOD:
+        parser.error(f"Alert rules can't look back more than "
+                     f"{RECORD_RETENTION_PERIOD} seconds")
+    backend = args.backend
 
-        # Start the scheduler
-        scheduler.start()
+    sniffer_workers = args.sniffer_workers
+    if sniffer_workers < 1:
+        parser.error("--sniffer-workers must be at least 1")
+    if sniffer_workers > 1 and backend in ('scapy', 'scapy-fast'):
+        parser.error("The scapy backend only supports one sniffer worker")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.top_k < 0:
+        parser.error("--top-k can't be negative")
+    if args.transport not in ('queue', 'shm'):
+        parser.error("--transport must be 'queue' or 'shm'")
+    if args.replay_speed < 0:
+        parser.error("--replay-speed can't be negative")
+    if args.frame_rate <= 0:
+        parser.error("--frame-rate has to be above 0")
+    if args.history_days < 0:
+        parser.error("--history-days can't be negative")
+    if args.read_pcap:
+        if sniffer_workers > 1:
+            parser.error("A capture file is replayed by a single sniffer "
+                         "worker")
+        try:
+            sniffer = sniffers.get_sniffer(
+                'pcap', reassemble=not args.no_reassembly,
+                pcap_file=args.read_pcap, replay_speed=args.replay_speed)
+        except (ValueError, OSError) as e:
+            parser.error(f"Can't replay {args.read_pcap}: {e}")
+        clock = ReplayClock(args.replay_speed)
+    if sniffer_workers > 1 and args.reorder_slack <= args.batch_interval:
+        parser.error("--reorder-slack has to be longer than --batch-interval, "
+                     "or records waiting in a batch will arrive too late to "
+                     "be put in order")
+
+    if not args.headless:
+        # blessed is only loaded for the screen, it's slow to import
+        from blessed import Terminal
+
+        # This is a handle to the terminal session
+        term = Terminal()
+
+        # make sure the terminal is big enough to display the data
+        if term.width < ViewManager.min_width or \
+                term.height < ViewManager.min_height:
+            raise RuntimeError("Please resize your terminal window to be at "
+                               f"least {ViewManager.min_width} columns wide "
+                               f"and {ViewManager.min_height} rows tall, or "
+                               "use --headless.")
+
+    # the columnar store that will hold the collected packet information,
+    # with per-second running totals kept alongside for the jobs to read
+    # with fixed size sketches of the clients for the 'Top Clients' panel
+    # and the client alerts, and the seconds rolled up into minutes and
+    # hours for the 'Long Term' panels
+    client_windows = {RECORD_RETENTION_PERIOD} | \
+        alert_engine.client_windows()
+    rollups = Rollups([RollupTier(*tier) for tier in ROLLUP_TIERS])
+    traffic_records = RecordStore(
+        aggregator=TrafficAggregator(RECORD_RETENTION_PERIOD,
+                                     top_k=args.top_k or None,
+                                     clients=ClientStats(client_windows),
+                                     rollups=rollups))
+
+    # this is the transport for receiving info from the network-sniffing
+    # subprocesses, with a sender for each of them
+    senders, receiver = make_transport(args.transport, sniffer_workers,
+                                       args.batch_size,
+                                       args.batch_interval / 1000,
+                                       args.ring_size)
+
+    # the history on disk, written from a thread of its own so ingest only
+    # ever hands the batches over
+    history = None
+    if args.history:
+        try:
+            history = SegmentLog(args.history,
+                                 retention=args.history_days * 86400)
+        except OSError as e:
+            parser.error(f"Can't keep the history in {args.history}: {e}")
+
+    with ExitStack() as terminal_modes:
+        if args.headless:
+            # The metrics are served from a thread of their own, and only
+            # ever read the text the metrics job last made
+            exporter = MetricsExporter()
+            try:
+                metrics_ip, metrics_port = exporter.serve(
+                    args.metrics_address, args.metrics_port)
+            except OSError as e:
+                parser.error(f"Can't serve metrics on "
+                             f"{args.metrics_address}:{args.metrics_port}: "
+                             f"{e}")
+            print(f"Serving metrics on "
+                  f"http://{metrics_ip}:{metrics_port}/metrics, Ctrl-C to "
+                  f"exit...", flush=True)
+        else:
+            # Putting the app inside the terminal's modes allows the client's
+            # terminal to be restored to its former state on exit, even if
+            # the process doesn't exit cleanly.
+            for mode in (term.fullscreen(), term.cbreak(),
+                         term.hidden_cursor()):
+                terminal_modes.enter_context(mode)
+            view_manager = ViewManager(term, args.frame_rate)
+            if args.read_pcap:
+                view_manager.update_replay_info(args.read_pcap, port, ip)
+            else:
+                view_manager.update_listening_info(port, ip)
+
+        if not args.read_pcap:
+            # Initialize a sniffer. Several workers are joined in a fanout
+            # group, and the group id only has to be unique on this box, so
+            # use our pid.
+            fanout_group = os.getpid() & 0xffff if sniffer_workers > 1 \
+                else None
+            sniffer = sniffers.get_sniffer(
+                backend, kernel_filter=not args.no_kernel_filter,
+                filter_stats=args.filter_stats, fanout_group=fanout_group,
+                reassemble=not args.no_reassembly)
+        # Start the sniffer in new processes
+        if sniffer_workers == 1:
+            snifferProcess = Process(target=sniffer.run_sniffer,
+                                     args=(ip, port, senders[0]))
+            snifferProcess.daemon = True
+            snifferProcess.start()
+        else:
+            for worker in range(sniffer_workers):
+                snifferProcess = Process(target=sniffer.run_sniffer,
+                                         args=(ip, port, senders[worker],
+                                               worker))
+                snifferProcess.daemon = True
+                snifferProcess.start()
+
+        # The analytics tick, which works out everything shown from one
+        # thread, all of a tick's view updates going to the view together.
+        # The first tick is straight away.
+        if args.headless:
+            tick = AnalyticsTick(lock, clock.time, lambda updates: None,
+                                 TICK_INTERVAL)
+            add_jobs(tick, traffic_records, alert_engine, receiver, sniffer,
+                     bool(args.read_pcap), exporter, history)
+        else:
+            tick = AnalyticsTick(lock, clock.time,
+                                 view_manager.get_view_queue().put,
+                                 TICK_INTERVAL)
+            add_jobs(tick, traffic_records, alert_engine, receiver, sniffer,
+                     bool(args.read_pcap))
 
-        # Start the view update loop
-        viewProcess = Process(target=view_manager.start_view_update_loop)
-        viewProcess.start()
+            # Start the view update loop
+            viewProcess = Process(target=view_manager.start_view_update_loop)
+            viewProcess.start()
+        tick.start()
 
         # Start recording captured traffic to traffic_records
-        while True:
-            new_traffic = incoming_data_queue.get()
-            with lock:
-                traffic_records.append(new_traffic)
+        try:
+            if args.read_pcap:
+                while True:
+                    new_traffic = receiver.get()
+                    if history is not None:
+                        history.append_batch(new_traffic)
+                    ingest_replayed(traffic_records, new_traffic,
+                                    alert_engine, clock)
+            elif sniffer_workers == 1:
+                while True:
+                    new_traffic = receiver.get()
+                    if history is not None:
+                        history.append_batch(new_traffic)
+                    # the whole batch goes in under one lock
+                    with lock:
+                        traffic_records.append_batch(new_traffic)
+            else:
+                # The workers' records are interleaved slightly out of
+                # order, so they go through the reorder buffer first. Wake
+                # up at least once per slack period to release what's ready
+                # even when it's quiet.
+                reorder_buffer = ReorderBuffer(args.reorder_slack / 1000)
+                while True:
+                    try:
+                        for record in receiver.get(
+                                timeout=reorder_buffer.slack):
+                            reorder_buffer.push(record)
+                    except queue.Empty:
+                        pass
+                    ready = reorder_buffer.pop_ready(time.time())
+                    if ready:
+                        if history is not None:
+                            history.append_batch(ready)
+                        with lock:
+                            traffic_records.append_batch(ready)
+        finally:
+            receiver.close()
+            if history is not None:
+                history.close()
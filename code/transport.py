@@ -0,0 +1,507 @@
+import heapq
+import itertools
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+from record_store import ip_to_int
+
+"""
+    The plumbing between the sniffer processes and the main process's
+    traffic records.
+
+    Whatever the transport, records reach the main process as "rows":
+    (time, src_ip, section name) tuples with the source IPv4 address as an
+    integer, ready for RecordStore.append_batch().
+"""
+
+# The most section names a shared memory ring gives ids to. Clients can make
+# up as many sections as they like, and each new one costs an announcement
+# on the side queue, (pickled), and an entry on both sides for good. Past
+# this many, new sections all share OTHER_SECTION_ID.
+MAX_SECTIONS = 65536
+
+# The id, and the name, of the sections past MAX_SECTIONS
+OTHER_SECTION_ID = 0xffffffff
+OTHER_SECTION = '(other)'
+
+
+class ReorderBuffer:
+    """
+    Puts records from several sniffer workers back into timestamp order.
+
+    Each worker's records arrive in order, but the workers race each other
+    to the queue, so the merged stream is only roughly in order. The
+    windowing code, (get_last_n_seconds_records and record_cleanup), stops
+    at the first record outside its window, so it needs the records in
+    order. This holds every record back for a short 'slack' period, and
+    releases them oldest first once no earlier record can still be on its
+    way.
+
+    A record that shows up more than 'slack' late is released straight away,
+    stamped with the time of the newest record already released, so the
+    timeline never runs backward. Those are counted in 'late'.
+    """
+
+    def __init__(self, slack):
+        """
+        @param slack: in seconds, how long to hold records back. This should
+        comfortably cover the time a record spends between the sniffer and
+        the main process.
+        """
+        self.slack = slack
+        self.heap = []
+        # ties on time are released in arrival order
+        self.counter = itertools.count()
+        self.last_released = 0
+        self.late = 0
+
+    def push(self, row):
+        """
+        Adds a record to the buffer
+        @param row: a (time, src_ip, section) row
+        @return: None
+        """
+        if row[0] < self.last_released:
+            self.late += 1
+            row = (self.last_released,) + row[1:]
+        heapq.heappush(self.heap, (row[0], next(self.counter), row))
+
+    def pop_ready(self, now):
+        """
+        Takes the records that are old enough to be certain of their order
+        out of the buffer.
+        @param now: the current time.time()
+        @return: a list of rows, oldest first
+        """
+        ready = []
+        horizon = now - self.slack
+        while self.heap and self.heap[0][0] <= horizon:
+            ready.append(heapq.heappop(self.heap)[2])
+        if ready:
+            self.last_released = ready[-1][0]
+        return ready
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class BatchingSender:
+    """
+    The sniffer's end of the batched transport.
+
+    It looks like a queue to the sniffers, but instead of sending each
+    record on its own, (a pickle, a pipe write and a lock per request), it
+    collects them and sends them on as a single list of compact rows once
+    there are batch_size of them, or the oldest has waited flush_interval
+    seconds.
+
+    A quiet sniffer blocks in its socket and never gets back here, so a
+    background thread flushes the last partial batch once it's old enough.
+    The thread and its lock are made on the first put(), so they belong to
+    the sniffer process rather than the one that created this.
+    """
+
+    def __init__(self, batch_queue, batch_size=256, flush_interval=0.05):
+        """
+        @param batch_queue: the multiprocessing.Queue to send the batches on
+        @param batch_size: the most records to put in one batch
+        @param flush_interval: in seconds, the longest a record waits
+        """
+        self.queue = batch_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch = []
+        self.batch_started = 0
+        self.lock = None
+
+    def put(self, record):
+        """
+        Adds a record to the current batch, and sends the batch if it's full
+        or old enough.
+        @param record: a dict with the 'time', 'src_ip' and 'path'
+        @return: None
+        """
+        if self.lock is None:
+            self.start_flush_thread()
+        with self.lock:
+            if not self.batch:
+                self.batch_started = time.time()
+            self.batch.append((record['time'], ip_to_int(record['src_ip']),
+                               record['path']))
+            if len(self.batch) >= self.batch_size or \
+                    time.time() - self.batch_started >= self.flush_interval:
+                self.flush_locked()
+
+    def flush(self):
+        """
+        Sends whatever is in the current batch
+        @return: None
+        """
+        if self.lock is None:
+            return
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        """
+        Sends the current batch, the caller holds the lock
+        @return: None
+        """
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def start_flush_thread(self):
+        """
+        Sets up the lock and idle flushing thread, in the sniffer process
+        @return: None
+        """
+        self.lock = threading.Lock()
+        flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        flusher.start()
+
+    def flush_loop(self):
+        """
+        Sends partial batches that have waited long enough, for when the
+        sniffer is idle.
+        @return: None
+        """
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if self.batch and \
+                        time.time() - self.batch_started >= self.flush_interval:
+                    self.flush_locked()
+
+
+class BatchReceiver:
+    """
+    The main process's end of the batched transport. It hands over the
+    batches from the BatchingSenders, and keeps the numbers needed to tune
+    the batch size and flush interval under load.
+    """
+
+    # how much weight the newest batch gets in the running average
+    smoothing = 0.05
+
+    def __init__(self, batch_queue):
+        """
+        @param batch_queue: the multiprocessing.Queue the senders put
+        batches on
+        """
+        self.queue = batch_queue
+        self.batches = 0
+        self.records = 0
+        self.max_batch = 0
+        self.average_batch = 0
+
+    def get(self, timeout=None):
+        """
+        Waits for the next batch
+        @param timeout: in seconds, or None to wait forever
+        @return: the batch's rows, oldest first
+        @raise queue.Empty: if the timeout passed without a batch
+        """
+        batch = self.queue.get(timeout=timeout)
+        size = len(batch)
+        self.batches += 1
+        self.records += size
+        self.max_batch = max(self.max_batch, size)
+        if self.batches == 1:
+            self.average_batch = size
+        else:
+            self.average_batch += self.smoothing * (size - self.average_batch)
+        return batch
+
+    def stats(self):
+        """
+        The transport's numbers, for the view
+        @return: a dict with the queue 'depth' in batches, (None where the
+        platform can't tell), the total 'batches' and 'records' received,
+        and the recent 'avg batch' and all-time 'max batch' sizes.
+        """
+        try:
+            depth = self.queue.qsize()
+        except NotImplementedError:
+            # macOS has no sem_getvalue()
+            depth = None
+        return {'depth': depth,
+                'batches': self.batches,
+                'records': self.records,
+                'avg batch': round(self.average_batch, 1),
+                'max batch': self.max_batch}
+
+    def close(self):
+        """
+        Nothing to release for a queue, this is for symmetry with
+        SharedMemoryReceiver
+        @return: None
+        """
+        pass
+
+
+class SharedMemoryRing:
+    """
+    A single-producer, single-consumer ring of fixed width records in a
+    multiprocessing.shared_memory block, so records get from a sniffer to
+    the main process with no pickling, pipes or locks at all.
+
+    Each record is a float64 timestamp, the uint32 IPv4 source address and
+    a uint32 section id. The section names themselves are interned by the
+    sender, and each new one is announced once over a side queue. Only the
+    first max_sections names get an id, the records for any after that are
+    all under OTHER_SECTION, and counted.
+
+    The layout is a header of four uint64 counters, each on its own cache
+    line: the write index, (only ever written by the producer), the read
+    index, (only ever written by the consumer), the overflow count and the
+    count of records sent as OTHER_SECTION. The records follow. The indexes
+    only ever grow, and a slot is index % size. The producer writes a
+    record before it moves the write index past it, and aligned 8 byte
+    stores are atomic, which is enough on x86. The indexes are read and
+    written through a memoryview cast to uint64s, which does a single 8 byte
+    store. (struct.pack_into() can't be used for them, it zero-fills the
+    bytes before packing, so the other side can catch an index at 0.) A
+    full ring drops the record and counts an overflow rather than blocking
+    the capture loop.
+    """
+
+    record_format = struct.Struct('=dII')
+    # the indexes' positions in the header, in uint64s
+    write_slot = 0
+    read_slot = 8
+    overflow_slot = 16
+    unnamed_slot = 24
+    header_size = 256
+
+    # see MAX_SECTIONS
+    max_sections = MAX_SECTIONS
+
+    def __init__(self, capacity):
+        """
+        Creates the shared memory, in the main process, before the sniffer
+        processes are forked off.
+        @param capacity: the number of records the ring holds, rounded up to
+        a power of two
+        """
+        self.capacity = 1 << max(capacity - 1, 1).bit_length()
+        self.mask = self.capacity - 1
+        self.shm = shared_memory.SharedMemory(
+            create=True,
+            size=self.header_size + self.capacity * self.record_format.size)
+        self.shm.buf[:self.header_size] = bytes(self.header_size)
+        self.indexes = self.shm.buf[:self.header_size].cast('Q')
+        self.announcements = multiprocessing.Queue()
+
+        # the producer's state
+        self.sections = {}
+        self.write_index = 0
+
+        # the consumer's state
+        self.section_names = {OTHER_SECTION_ID: OTHER_SECTION}
+        self.read_index = 0
+
+    def put(self, record):
+        """
+        The sniffer's side - writes a record into the ring, or counts an
+        overflow if it's full. This looks like a queue to the sniffers.
+        @param record: a dict with the 'time', 'src_ip' and 'path'
+        @return: None
+        """
+        indexes = self.indexes
+        if self.write_index - indexes[self.read_slot] >= self.capacity:
+            indexes[self.overflow_slot] += 1
+            return
+
+        section_id = self.sections.get(record['path'])
+        if section_id is None:
+            if len(self.sections) < self.max_sections:
+                section_id = len(self.sections)
+                self.sections[record['path']] = section_id
+                self.announcements.put((section_id, record['path']))
+            else:
+                section_id = OTHER_SECTION_ID
+                indexes[self.unnamed_slot] += 1
+
+        src_ip = ip_to_int(record['src_ip'])
+        slot = self.header_size + \
+            (self.write_index & self.mask) * self.record_format.size
+        self.record_format.pack_into(self.shm.buf, slot, record['time'],
+                                     src_ip, section_id)
+        self.write_index += 1
+        indexes[self.write_slot] = self.write_index
+
+    def flush(self):
+        """
+        Records are visible to the consumer as soon as they're written, so
+        there's nothing to do here. It's for symmetry with BatchingSender.
+        @return: None
+        """
+        pass
+
+    def read_available(self):
+        """
+        The main process's side - takes everything waiting in the ring.
+        @return: a list of (time, src_ip, section id) tuples, oldest first.
+        src_ip is the address as an integer.
+        """
+        buf = self.shm.buf
+        write_index = self.indexes[self.write_slot]
+        if write_index == self.read_index:
+            return []
+
+        size = self.record_format.size
+        start = self.read_index & self.mask
+        count = write_index - self.read_index
+        # the waiting records may wrap around the end of the ring
+        first = min(count, self.capacity - start)
+        chunks = [buf[self.header_size + start * size:
+                      self.header_size + (start + first) * size]]
+        if count > first:
+            chunks.append(buf[self.header_size:
+                              self.header_size + (count - first) * size])
+        records = []
+        for chunk in chunks:
+            records.extend(self.record_format.iter_unpack(chunk))
+            chunk.release()
+
+        self.read_index = write_index
+        self.indexes[self.read_slot] = self.read_index
+        return records
+
+    def section_name(self, section_id):
+        """
+        Looks up an interned section name, waiting for its announcement if
+        it hasn't come through yet.
+        @param section_id: the id from a record
+        @return: the section name
+        """
+        while section_id not in self.section_names:
+            announced_id, name = self.announcements.get()
+            self.section_names[announced_id] = name
+        return self.section_names[section_id]
+
+    def depth(self):
+        """
+        @return: the number of records waiting in the ring
+        """
+        return self.indexes[self.write_slot] - self.read_index
+
+    def overflows(self):
+        """
+        @return: the number of records dropped because the ring was full
+        """
+        return self.indexes[self.overflow_slot]
+
+    def unnamed(self):
+        """
+        @return: the number of records sent as OTHER_SECTION, because
+        max_sections names had ids already
+        """
+        return self.indexes[self.unnamed_slot]
+
+    def close(self):
+        """
+        Releases the shared memory, from the main process on the way out
+        @return: None
+        """
+        # the view has to go before the memory can be unmapped
+        self.indexes.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedMemoryReceiver:
+    """
+    The main process's end of the shared memory transport, with one ring
+    per sniffer worker. It has the same get() and stats() as BatchReceiver,
+    so the main loop doesn't care which transport it's reading from.
+    """
+
+    # How long to sleep, in seconds, when all the rings are empty. There's
+    # nothing to block on without taking a lock, so the rings are polled.
+    poll_interval = 0.001
+
+    def __init__(self, rings):
+        """
+        @param rings: a list of SharedMemoryRings, one per sniffer worker
+        """
+        self.rings = rings
+        self.batches = 0
+        self.records = 0
+
+    def get(self, timeout=None):
+        """
+        Waits for records in any of the rings
+        @param timeout: in seconds, or None to wait forever
+        @return: the waiting rows. They are in order for each ring, but not
+        across rings.
+        @raise queue.Empty: if the timeout passed without a record
+        """
+        give_up = None if timeout is None else time.time() + timeout
+        while True:
+            records = []
+            for ring in self.rings:
+                section_name = ring.section_name
+                records.extend((t, src_ip, section_name(section_id))
+                               for t, src_ip, section_id
+                               in ring.read_available())
+            if records:
+                self.batches += 1
+                self.records += len(records)
+                return records
+            if give_up is not None and time.time() >= give_up:
+                raise queue.Empty
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        """
+        The transport's numbers, for the view
+        @return: a dict with the records waiting in the rings, ('depth'),
+        the total 'records' received, the records dropped because a ring
+        was full, ('overflows'), and the records that came as OTHER_SECTION
+        because a ring had run out of section ids, ('unnamed').
+        """
+        return {'depth': sum(ring.depth() for ring in self.rings),
+                'records': self.records,
+                'overflows': sum(ring.overflows() for ring in self.rings),
+                'unnamed': sum(ring.unnamed() for ring in self.rings)}
+
+    def close(self):
+        """
+        Releases the rings' shared memory
+        @return: None
+        """
+        for ring in self.rings:
+            ring.close()
+
+
+def make_transport(kind, workers, batch_size=256, flush_interval=0.05,
+                   ring_size=65536):
+    """
+    Sets up the transport from the sniffer workers to the main process.
+
+    @param kind: 'queue' for batches over a multiprocessing.Queue, or 'shm'
+    for shared memory rings
+    @param workers: the number of sniffer workers
+    @param batch_size: for 'queue', the most records per batch
+    @param flush_interval: for 'queue', the longest a record waits, in seconds
+    @param ring_size: for 'shm', the records each worker's ring holds
+    @return: (senders, receiver). senders has one entry per worker, to pass
+    to the sniffer as its queue.
+    """
+    if kind == 'queue':
+        incoming_data_queue = multiprocessing.Queue()
+        sender = BatchingSender(incoming_data_queue, batch_size,
+                                flush_interval)
+        return [sender] * workers, BatchReceiver(incoming_data_queue)
+    elif kind == 'shm':
+        rings = [SharedMemoryRing(ring_size) for _ in range(workers)]
+        return rings, SharedMemoryReceiver(rings)
+    else:
+        raise NotImplementedError(f"Unknown transport, {kind}, please choose"
+                                  " 'queue' or 'shm'")
@@ -1,4 +1,10 @@
 import multiprocessing
+import os
+import queue
+import sys
+import time
+
+from screen import Screen
 
 
 class ViewManager:
@@ -12,27 +18,50 @@ class ViewManager:
 
     # In cases where more than one instance of the same function is sending
     # updates, record where each instance id is to be displayed on the screen
-    # "id" : (indent, lines from top)
+    # "id" : (indent, lines from top), negative lines count up from the bottom
     offsets = {"VW_SA_1": (6, 4),
                "VW_SA_2": (38, 4),
+               "VW_CL_1": (72, 4),
+               "VW_LT_1": (6, 12),
+               "VW_LT_2": (38, 12),
                "VW_TFC_1": (4, 0),
-               "VW_RATE_1": (40, 0)}
+               "VW_RATE_1": (40, 0),
+               "VW_CAP_1": (0, 1),
+               "VW_PIPE_1": (0, -3)}
+
+    # the 'Top Clients' panel is the furthest right, 28 wide from column 72,
+    # and the pipeline readout sits 3 up from the bottom, under the alerts
+    min_width = 100
+    min_height = 24
 
-    def __init__(self, terminal):
+    def __init__(self, terminal, frame_rate=10):
+        """
+        @param terminal: a blessed Terminal
+        @param frame_rate: the most times a second the screen is redrawn
+        """
         self.term = terminal
+        self.frame_time = 1 / frame_rate
+        # the updates write into this, and it's sent to the terminal a frame
+        # at a time by the update loop
+        self.screen = Screen(terminal)
+        # below the 'Long Term' panels, on a short terminal
+        self.alerts_row = max(terminal.height // 2 - 2, 18)
+        # and they stop short of the pipeline line
+        self.alerts_end = terminal.height + self.offsets["VW_PIPE_1"][1]
         self.setup_screen()
 
     def setup_screen(self):
-        with self.term.location(0, 2):
-            print(self.term.underline(f"Most Popular Sections"))
-        with self.term.location(4, 3):
-            print("Last 10 Seconds:")
-        with self.term.location(36, 3):
-            print("Last 10 Minutes:")
-        with self.term.location(0, self.term.height // 2 - 2):
-            print(self.term.underline("Alerts:"))
-        with self.term.location(0, self.term.height - 2):
-            print("Ctrl-C to exit...")
+        write = self.screen.write
+        write(0, 2, "Most Popular Sections", style='underline')
+        write(4, 3, "Last 10 Seconds:")
+        write(36, 3, "Last 10 Minutes:")
+        write(66, 2, "Top Clients", style='underline')
+        write(70, 3, "Last 10 Minutes:")
+        write(0, 10, "Long Term", style='underline')
+        write(4, 11, "Last Hour:")
+        write(36, 11, "Last Day:")
+        write(0, self.alerts_row, "Alerts:", style='underline')
+        write(0, self.term.height - 2, "Ctrl-C to exit...")
 
     def update_listening_info(self, port, ip):
         """
@@ -42,11 +71,22 @@ class ViewManager:
         @return: None
         """
         if ip:
-            with self.term.location(0, 0):
-                print(f"Listening on {ip}:{port}...")
+            self.screen.write(0, 0, f"Listening on {ip}:{port}...")
         else:
-            with self.term.location(0, 0):
-                print(f"Listening on port {port}...")
+            self.screen.write(0, 0, f"Listening on port {port}...")
+
+    def update_replay_info(self, path, port, ip):
+        """
+            Updates the readout for the capture file being replayed, in
+        place of the listening info
+        @param path: the capture file
+        @param port: a port number
+        @param ip: an ip, may be None if all ips are being monitored
+        @return: None
+        """
+        target = f"{ip}:{port}" if ip else f"port {port}"
+        self.screen.write(0, 0,
+                          f"Replaying {os.path.basename(path)}, {target}...")
 
     def update_section_activity(self, popular_list, id):
         """
@@ -63,44 +103,73 @@ class ViewManager:
         # this is to force the content clear if there are fewer total popular
         # sections on this iteration than there were during the last 10s
         # interval
+        while len(popular_list) < max_lines_to_show:
+            popular_list.append(" ")
+        for i, section in enumerate(popular_list[:max_lines_to_show]):
+            # padded out to clear whatever was there before
+            self.screen.write(indent, down_from_terminal_top + i, section,
+                              width=20)
+
+    def update_top_clients(self, client_activity, id):
+        """
+            This displays the busiest clients, and how many different
+            clients there were
+
+        @param client_activity: a tuple of the number of unique clients, and
+            a list of strings of the top clients and their hits
+        @return: None
+        """
+        unique, top_list = client_activity
+        indent = self.offsets[id][0]
+        down_from_terminal_top = self.offsets[id][1]
+        self.screen.write(indent - 2, down_from_terminal_top - 1,
+                          f"Last 10 Minutes, ~{unique} unique:", width=32)
+        max_lines_to_show = 5
+        top_list = top_list[:max_lines_to_show]
+        while len(top_list) < max_lines_to_show:
+            top_list.append(" ")
+        for i, client in enumerate(top_list):
+            self.screen.write(indent, down_from_terminal_top + i, client,
+                              width=28)
+
+    def update_long_term(self, long_term, id):
+        """
+            This displays the request rate and the most popular sections
+            over a long time, (the last hour or day), from the rollups
+
+        @param long_term: a tuple of the label, (like "Last Hour"), the
+            requests per second, and a list of strings of the sections and
+            their hits
+        @return: None
+        """
+        label, rate, popular_list = long_term
+        indent = self.offsets[id][0]
+        down_from_terminal_top = self.offsets[id][1]
+        self.screen.write(indent - 2, down_from_terminal_top - 1,
+                          f"{label}, {rate:.1f} / Sec:", width=32)
+        max_lines_to_show = 5
+        popular_list = popular_list[:max_lines_to_show]
         while len(popular_list) < max_lines_to_show:
             popular_list.append(" ")
         for i, section in enumerate(popular_list):
-            with self.term.location(indent, down_from_terminal_top + i):
-                # since we're not re-drawing the entire screen on every update,
-                # clear the previous contents.
-                print(" " * 20)
-
-            # Have to place the beginning of the print statement at the
-            # beginning of the cleared line, since the insertion point is now
-            # at the beginning of the next line. (Ending the above with a
-            # '\r' ignores the indent, and then you're manually re-adding it,
-            # this is cleaner)
-            with self.term.location(indent, down_from_terminal_top + i):
-                print(section, flush=True)
-
-            if i > max_lines_to_show - 1:
-                break
+            self.screen.write(indent, down_from_terminal_top + i, section,
+                              width=30)
 
     def update_traffic_alert(self, msg_deque, id):
         """
         This updates the traffic alerting section
 
         @param msg_deque: A deque by default but allowed to be any iterator -
-         contains the alert text to display
+         contains the alert text to display. Only the newest that fit above
+         the pipeline line are shown.
         @return: None
         """
         indent = self.offsets[id][0]
-        for i, the_msg in enumerate(reversed(msg_deque)):
-            # We're not clearing the screen on every data update,
-            # so simply overwrite the last alert with space, and write
-            # over it
-            with self.term.location(indent, self.term.height // 2 - 1 + i):
-                print(" " * (self.term.width - indent))
-            # Jump to the same space we just overwrote and write the new
-            # line.
-            with self.term.location(indent, self.term.height // 2 - 1 + i):
-                print("- " + the_msg)
+        rows = max(self.alerts_end - self.alerts_row - 1, 0)
+        for i, the_msg in zip(range(rows), reversed(msg_deque)):
+            # padded to the edge, over the last alert shown on this line
+            self.screen.write(indent, self.alerts_row + 1 + i,
+                              "- " + the_msg, width=self.term.width - indent)
 
     def update_request_rate(self, rate, id):
         """
@@ -109,30 +178,95 @@ class ViewManager:
         @return: None
         """
         indent = self.offsets[id][0]
-        with self.term.location(indent, 0, ):
-            print(" " * 20)
-        with self.term.location(indent, 0, ):
-            print(f'{rate} Requests / Sec')
+        self.screen.write(indent, 0, f'{rate} Requests / Sec', width=20)
+
+    def update_capture_stats(self, stats, id):
+        """
+        Updates the sniffer's capture counters line, for the backends that
+        keep them
+        @param stats: A dict of counter names to values
+        @return: None
+        """
+        indent = self.offsets[id][0]
+        line = "Capture: " + ", ".join(f"{value} {name}"
+                                       for name, value in stats.items())
+        self.screen.write(indent, self.offsets[id][1], line,
+                          width=self.term.width - indent)
+
+    def update_pipeline_stats(self, stats, id):
+        """
+        Updates the line of internal numbers from the sniffer-to-main process
+        transport, just above the exit message
+        @param stats: A dict of counter names to values
+        @return: None
+        """
+        indent = self.offsets[id][0]
+        down_from_terminal_top = self.term.height + self.offsets[id][1]
+        line = "Pipeline: " + ", ".join(f"{name} {value}"
+                                        for name, value in stats.items())
+        self.screen.write(indent, down_from_terminal_top, line,
+                          width=self.term.width - indent)
+
+    def next_frame(self, last_frame):
+        """
+        Waits for updates, then gathers up everything else that comes in
+        before the next frame is due, and works the frame out. When the
+        same id has sent more than one update in that time, only its newest
+        is used.
+
+        Each message on the queue is a list of updates, all of one analytics
+        tick's, so they're always drawn in the same frame.
+        @param last_frame: the time.monotonic() the last frame was drawn
+        @return: the text to send the terminal, (empty when nothing
+        changed)
+        """
+        # the first updates, waiting as long as it takes
+        pending = {}
+        view_updates = self.view_queue.get()
+        due = last_frame + self.frame_time
+        while True:
+            for view_update in view_updates:
+                pending[view_update[0]] = view_update
+            wait = due - time.monotonic()
+            try:
+                if wait > 0:
+                    view_updates = self.view_queue.get(timeout=wait)
+                else:
+                    view_updates = self.view_queue.get_nowait()
+            except queue.Empty:
+                break
+        # index 0 has the update job id,
+        # index 1 has an update method reference,
+        # index 2 has the new vals
+        for id, update_method, values in pending.values():
+            update_method(self, values, id)
+        return self.screen.render()
 
     def start_view_update_loop(self):
         """
         To save time and possible flicker, the display only updates when
-        there's a change to be shown.
+        there's a change to be shown, and no more than frame_rate times a
+        second, with all the updates in between drawn at once.
 
-        So this code runs in a tight loop, updating the appropriate section
-        when a new message comes off the queue with values to update.
+        So this code runs in a loop, drawing a frame whenever updates have
+        come off the queue, with only the cells that changed in one write.
         @return: None
         """
+        # the screen as set up so far
+        sys.stdout.write(self.screen.render())
+        sys.stdout.flush()
+        last_frame = time.monotonic()
         while True:
-            view_update = self.view_queue.get()
-            # index 1 has an update method reference,
-            # index 2 has the new vals
-            # index 3 has the update job id
-            view_update[1](self, view_update[2], view_update[0])
+            frame = self.next_frame(last_frame)
+            last_frame = time.monotonic()
+            if frame:
+                sys.stdout.write(frame)
+                sys.stdout.flush()
 
     def get_view_queue(self):
         """
-        Simple getter so the decorator can get the multiprocess.Queue instance.
+        Simple getter so the analytics tick can get the multiprocess.Queue
+        instance.
         @return: The multiprocess.Queue which provides data to the view code
         """
         return self.view_queue